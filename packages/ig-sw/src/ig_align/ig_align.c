@@ -138,8 +138,50 @@ typedef struct {
   int max_drop;
   int min_score;
   unsigned bandwidth;
+  bool per_read_scores; /* read match, mismatch and gap open from each read's fasta comment */
+  int32_t match;
+  int32_t mismatch;
 } align_config_t;
 
+// fill the 5x5 scoring matrix <mat> for genome sequences
+static void init_score_matrix(int8_t *mat, const int32_t match,
+                              const int32_t mismatch) {
+  int32_t j, k, l;
+  for (l = k = 0; LIKELY(l < 4); ++l) {
+    for (j = 0; LIKELY(j < 4); ++j)
+      mat[k++] =
+          l == j ? match : -mismatch; /* weight_match : -weight_mismatch */
+    mat[k++] = 0;                     // ambiguous base
+  }
+  for (j = 0; LIKELY(j < 5); ++j)
+    mat[k++] = 0;
+}
+
+// Copy <conf> to <read_conf>, replacing the scores with any that are set in the read's comment, e.g. ">name match=5,mismatch=3,gap-open=30" (unset ones keep the command line value).
+// The matrix is only 25 entries, so it's cheaper to rebuild it for each read than to keep track of which ones we've already made.
+static void set_read_config(const kseq_t *read, const align_config_t *conf,
+                            align_config_t *read_conf, int8_t *read_mat) {
+  *read_conf = *conf;
+  if (read->comment.l > 0) {
+    const char *c = read->comment.s;
+    while (*c) {
+      int val, n_read = 0;
+      if (sscanf(c, "match=%d%n", &val, &n_read) == 1 && n_read > 0)
+        read_conf->match = val;
+      else if (sscanf(c, "mismatch=%d%n", &val, &n_read) == 1 && n_read > 0)
+        read_conf->mismatch = val;
+      else if (sscanf(c, "gap-open=%d%n", &val, &n_read) == 1 && n_read > 0)
+        read_conf->gap_o = val;
+      const char *next = strchr(c, ',');
+      if (next == NULL)
+        break;
+      c = next + 1;
+    }
+  }
+  init_score_matrix(read_mat, read_conf->match, read_conf->mismatch);
+  read_conf->mat = read_mat;
+}
+
 static aln_t align_read_against_one(kseq_t *target, const int read_len,
                                     uint8_t *read_num, kswq_t **qry,
                                     const align_config_t *conf,
@@ -404,8 +446,15 @@ static void *worker(void *data) {
   worker_t *w = (worker_t *)data;
   for (size_t i = w->start; i < w->n; i += w->step) {
     kseq_t *s = &kv_A(w->reads, i);
+    const align_config_t *conf = w->config;
+    align_config_t read_conf;
+    int8_t read_mat[25];
+    if (conf->per_read_scores) {
+      set_read_config(s, conf, &read_conf, read_mat);
+      conf = &read_conf;
+    }
     aln_v result = align_read(s, w->ref_seqs, w->n_extra_refs,
-                              w->extra_ref_seqs, w->config);
+                              w->extra_ref_seqs, conf);
 
     kstring_t str = {0, 0, NULL};
 
@@ -432,10 +481,10 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
                     const int min_score,                          /* 0 */
                     const unsigned bandwidth,                     /* 150 */
                     const uint8_t n_threads,                      /* 1 */
+                    const bool per_read_scores,                   /* false */
                     const char *read_group, const char *read_group_id) {
   gzFile read_fp, ref_fp;
   FILE *out_fp;
-  int32_t j, k, l;
   const int m = 5;
   kseq_t *seq;
   int8_t *mat = (int8_t *)calloc(25, sizeof(int8_t));
@@ -450,14 +499,7 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
                         4, 4, 3, 0, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4};
 
   // initialize scoring matrix for genome sequences
-  for (l = k = 0; LIKELY(l < 4); ++l) {
-    for (j = 0; LIKELY(j < 4); ++j)
-      mat[k++] =
-          l == j ? match : -mismatch; /* weight_match : -weight_mismatch */
-    mat[k++] = 0;                     // ambiguous base
-  }
-  for (j = 0; LIKELY(j < 5); ++j)
-    mat[k++] = 0;
+  init_score_matrix(mat, match, mismatch);
 
   // Read reference sequences
   ref_fp = gzopen(ref_path, "r");
@@ -490,8 +532,9 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
   out_fp = fopen(output_path, "w");
   fprintf(out_fp, "@HD\tVN:1.4\tSO:unsorted\n");
   fprintf(out_fp, "@PG\tID:ig_align\tPN:ig_align\tCL:match=%d,mismatch=%d,go=%"
-                  "d,ge=%d\tVN:%s\n",
-          match, mismatch, gap_o, gap_e, xstr(VDJALIGN_VERSION));
+                  "d,ge=%d%s\tVN:%s\n",
+          match, mismatch, gap_o, gap_e, per_read_scores ? ",per-read-scores" : "",
+          xstr(VDJALIGN_VERSION));
   for (size_t i = 0; i < kv_size(ref_seqs); i++) {
     seq = &kv_A(ref_seqs, i);
     fprintf(out_fp, "@SQ\tSN:%s\tLN:%d\n", seq->name.s, (int32_t)seq->seq.l);
@@ -516,6 +559,9 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
   conf.table = table;
   conf.mat = mat;
   conf.bandwidth = bandwidth;
+  conf.per_read_scores = per_read_scores;
+  conf.match = match;
+  conf.mismatch = mismatch;
 
   read_fp = gzopen(qry_path, "r");
   assert(read_fp != NULL && "Failed to open query");
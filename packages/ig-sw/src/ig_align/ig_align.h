@@ -1,11 +1,15 @@
 #ifndef IG_ALIGN_H
 #define IG_ALIGN_H
 
+#include <stdbool.h>
 #include <stdint.h>
 
 /**
  * If n_extra_refs is > 0,
  * it should be in order D, J.
+ * If per_read_scores is set, match, mismatch, and gap_o are defaults that can
+ * be overridden for each read in its fasta comment, e.g.
+ * ">name match=5,mismatch=3,gap-open=30".
  */
 void ig_align_reads(const char *ref_path,
                     const uint8_t n_extra_refs,
@@ -20,6 +24,7 @@ void ig_align_reads(const char *ref_path,
                     const int min_score,     /* 0 */
                     const unsigned bandwidth,
                     const uint8_t n_threads,
+                    const bool per_read_scores, /* false */
                     const char *read_group,
                     const char *read_group_id);
 
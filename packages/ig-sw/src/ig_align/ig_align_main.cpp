@@ -89,6 +89,14 @@ int main(int argc, const char *argv[]) {
         "j", "threads", "Number of threads: default 1", false, 1, "int");
     cmd.add(n_threads_opt);
 
+    TCLAP::SwitchArg per_read_scores_opt(
+        "r", "per-read-scores",
+        "Read match, mismatch and gap open scores from each query's fasta "
+        "comment (e.g. \">name match=5,mismatch=3,gap-open=30\"), falling back "
+        "to the command line values for any that are missing",
+        false);
+    cmd.add(per_read_scores_opt);
+
     std::vector<std::string> options;
     options.push_back("IGH");
     options.push_back("IGK");
@@ -135,6 +143,8 @@ int main(int argc, const char *argv[]) {
     int bandwidth = bandwidth_opt.getValue();
     // n_threads
     uint8_t n_threads = n_threads_opt.getValue();
+    // per_read_scores
+    bool per_read_scores = per_read_scores_opt.getValue();
     // locus
     std::string locus = locus_opt.getValue();
     // vdj_dir
@@ -156,7 +166,8 @@ int main(int argc, const char *argv[]) {
 
     ig_align_reads(ref_path, n_extra_refs, extra_ref_paths, qry_path,
                    output_path, match, mismatch, gap_o, gap_e, max_drop,
-                   min_score, bandwidth, n_threads, NULL, NULL);
+                   min_score, bandwidth, n_threads, per_read_scores, NULL,
+                   NULL);
 
   } catch (TCLAP::ArgException &e) // catch any exception
   {
@@ -1,9 +1,11 @@
 import itertools
+import heapq
 import os
 import sys
 import math
 import csv
 import time
+import numpy
 
 import utils
 from clusterpath import ClusterPath
@@ -20,56 +22,74 @@ class Glomerator(object):
     def naive_seq_glomerate(self, naive_seqs, n_clusters, debug=False):
         """ Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters> """
         start = time.time()
-        clusters = [[names,] for names in naive_seqs.keys()]
-
-        seqs_per_cluster = float(len(clusters)) / n_clusters
+        seqs_per_cluster = float(len(naive_seqs)) / n_clusters
         max_per_cluster = int(math.ceil(seqs_per_cluster))
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
-
+        # Single-linkage agglomeration in which, at each step, we merge the two clusters that contain the closest pair of sequences, skipping pairs whose merged size would be bigger than <max_per_cluster> (until there's nothing left that isn't too big, at which point we merge whatever's closest regardless of size).
+        # Since clusters only ever get bigger, a pair of sequences that's too far apart to be the closest pair, or whose clusters are too big to merge, never becomes useful later on, so we can get the same merges by going through all sequence pairs (from the condensed distance matrix) once in order of increasing distance.
+        # Clusters get integer ids in the order they'd appear in the old list-based implementation (initial clusters in <naive_seqs> order, merged clusters appended at the end), and among equally-close pairs we merge the one that comes first in that order, so ties are broken the same way as before.
+        uids = list(naive_seqs)
+        n_seqs = len(uids)
+        cluster_ids = numpy.arange(n_seqs)  # id of the cluster that each sequence is in
+        cluster_members = {i : [i] for i in range(n_seqs)}  # (indices in <uids> of) members of each current cluster, keyed by cluster id
+        cluster_sizes = numpy.ones(2 * n_seqs, dtype=numpy.int64)  # we'll never need more than 2n-1 cluster ids
+        if n_seqs > n_clusters:
+            condensed_distances = utils.hamming_distance_matrix([naive_seqs[u] for u in uids], return_fractions=True, condensed=True)
+            sorted_ipairs = numpy.argsort(condensed_distances, kind='mergesort')
+            sorted_distances = condensed_distances[sorted_ipairs]
+            del condensed_distances
+            level_bounds = numpy.concatenate(([0], numpy.nonzero(numpy.diff(sorted_distances))[0] + 1, [len(sorted_distances)]))  # start/stop indices in <sorted_ipairs> of each set of pairs with the same distance
+            del sorted_distances
+            row_starts = numpy.array([i * n_seqs - i * (i + 1) // 2 for i in range(n_seqs)], dtype=numpy.int64)  # index in the condensed matrix of the pair (i, i+1)
+            if debug:
+                print '    %d pairs with %d distinct distances' % (len(sorted_ipairs), len(level_bounds) - 1)
         # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
-                    continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+        def get_pairs(istart, istop):  # sequence indices of the pairs between <istart> and <istop> in the sorted pair list
+            ipairs = sorted_ipairs[istart : istop]
+            ifirsts = numpy.searchsorted(row_starts, ipairs, side='right') - 1
+            return ifirsts, ipairs - row_starts[ifirsts] + ifirsts + 1
 
         # ----------------------------------------------------------------------------------------
-        def glomerate():
+        def merge(id_a, id_b):
             if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
-            if clusters_to_merge is None:  # if we didn't find a suitable pair
-                if debug:
-                    print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                print '    merging', len(cluster_members[id_a]), len(cluster_members[id_b])
+            new_id = glomerate.next_id
+            glomerate.next_id += 1
+            cluster_members[new_id] = cluster_members.pop(id_a) + cluster_members.pop(id_b)
+            cluster_sizes[new_id] = cluster_sizes[id_a] + cluster_sizes[id_b]
+            cluster_ids[cluster_members[new_id]] = new_id
+
+        # ----------------------------------------------------------------------------------------
+        def usable(id_a, id_b):  # works on either single ids or arrays of them
+            is_usable = id_a != id_b
+            if not glomerate.merge_whatever_you_got:
+                is_usable &= cluster_sizes[id_a] + cluster_sizes[id_b] <= max_per_cluster
+            return is_usable
+
+        # ----------------------------------------------------------------------------------------
+        def glomerate():  # go through all pairs in order of increasing distance, merging as we go, until we either get down to <n_clusters> or run out of pairs
+            for ilevel in range(len(level_bounds) - 1):
+                ifirsts, iseconds = get_pairs(level_bounds[ilevel], level_bounds[ilevel + 1])
+                ids_a, ids_b = cluster_ids[ifirsts], cluster_ids[iseconds]
+                is_usable = usable(ids_a, ids_b)  # pairs that aren't usable now never will be (within this pass), so we can throw them out all at once
+                ifirsts, iseconds, ids_a, ids_b = ifirsts[is_usable], iseconds[is_usable], ids_a[is_usable], ids_b[is_usable]
+                keys = numpy.minimum(ids_a, ids_b) * 2 * n_seqs + numpy.maximum(ids_a, ids_b)  # ordering of cluster pairs in the old list (i.e. the order in which itertools.combinations() would've seen them)
+                isorted = numpy.argsort(keys, kind='mergesort')
+                pairheap = zip(keys[isorted].tolist(), ifirsts[isorted].tolist(), iseconds[isorted].tolist())  # already sorted, so it's already a heap
+                while len(pairheap) > 0 and len(cluster_members) > n_clusters:  # since merged clusters get new (bigger) ids, a pair's key can only increase, so we can update keys lazily when we pop them
+                    key, ifirst, isecond = heapq.heappop(pairheap)
+                    id_a, id_b = cluster_ids[ifirst], cluster_ids[isecond]
+                    if not usable(id_a, id_b):
+                        continue
+                    current_key = min(id_a, id_b) * 2 * n_seqs + max(id_a, id_b)
+                    if current_key != key:
+                        heapq.heappush(pairheap, (current_key, ifirst, isecond))
+                        continue
+                    merge(min(id_a, id_b), max(id_a, id_b))
+                if len(cluster_members) <= n_clusters:
+                    return
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -90,11 +110,17 @@ class Glomerator(object):
 
         # ----------------------------------------------------------------------------------------
         # da bizniz
+        glomerate.next_id = n_seqs
         glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
-
-        while len(clusters) > n_clusters:
+        if n_seqs > n_clusters:
             glomerate()
-        
+            if len(cluster_members) > n_clusters:  # didn't find enough pairs that wouldn't make a cluster that's too big
+                if debug:
+                    print '    didn\'t find shiznitz'
+                glomerate.merge_whatever_you_got = True  # so merge whatever's best regardless of size
+                glomerate()
+        clusters = [[uids[i] for i in cluster_members[cid]] for cid in sorted(cluster_members)]
+
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
@@ -7,12 +7,14 @@ import itertools
 import math
 import os
 import glob
+import mmap
 import csv
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
 from collections import OrderedDict
 from subprocess import Popen, check_call, PIPE, CalledProcessError, check_output
 import copy
+import heapq
 import multiprocessing
 import operator
 import traceback
@@ -61,6 +63,7 @@ class PartitionDriver(object):
 
         self.hmm_infname = self.args.workdir + '/hmm_input.csv'
         self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
+        self.hmm_cache_index = None  # map from uid string to byte offsets in <self.hmm_cachefname> (see get_hmm_cache_index())
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
         self.cpath_progress_dir = '%s/cluster-path-progress' % self.args.workdir  # write the cluster paths for each clustering step to separate files in this dir
 
@@ -117,7 +120,11 @@ class PartitionDriver(object):
         self.all_actions = actions
         for tmpaction in actions:
             self.current_action = tmpaction  # NOTE gets changed on the fly below, I think just in self.get_cluster_annotations() (which is kind of hackey, but I can't figure out a way to improve on it that wouldn't involve wasting a foolish amount of time rewriting things. Bottom line is that the control flow for different actions is really complicated, and that complexity is going to show up somewhere)
-            self.action_fcns[tmpaction]()
+            utils.set_resource_profile_context(action=tmpaction)  # label any external commands we run for --resource-profile-fname (the steps get set below)
+            if utils.python_profile is None:
+                self.action_fcns[tmpaction]()
+            else:
+                utils.profiled_stage(tmpaction)(self.action_fcns[tmpaction])()
 
     # ----------------------------------------------------------------------------------------
     def clean(self):
@@ -154,6 +161,9 @@ class PartitionDriver(object):
                 os.remove(cpfname)
             os.rmdir(self.cpath_progress_dir)
 
+        if self.args.profile:
+            print '  leaving workdir %s in place, since it has the --profile reports' % self.args.workdir
+            return
         try:
             os.rmdir(self.args.workdir)
         except OSError:
@@ -187,6 +197,7 @@ class PartitionDriver(object):
     def run_waterer(self, count_parameters=False, write_parameters=False, write_cachefile=False, look_for_cachefile=False, require_cachefile=False, dbg_str=''):
         print 'smith-waterman%s' % (('  (%s)' % dbg_str) if dbg_str != '' else '')
         sys.stdout.flush()
+        utils.set_resource_profile_context(action=utils.resource_profile_context['action'], step='sw%s' % (('-' + dbg_str.replace(' ', '-')) if dbg_str != '' else ''))
 
         self.vs_info = None  # should already be None, but we want to make sure (if --no-sw-vsearch is set we need it to be None, and if we just removed unlikely alleles we need to rerun vsearch with the likely alleles)
         if not self.args.no_sw_vsearch:
@@ -317,11 +328,12 @@ class PartitionDriver(object):
             seqfileopener.read_input_metafo(self.args.input_metafname, annotation_list, debug=True)
         if self.args.seed_unique_id is not None:  # restrict to seed cluster in the best partition (clusters from non-best partition have duplicate uids, which then make fasttree barf, and it doesn't seem worth the trouble to fix it now)
             annotation_dict = OrderedDict([(uidstr, line) for uidstr, line in annotation_dict.items() if self.args.seed_unique_id in line['unique_ids'] and line['unique_ids'] in cpath.partitions[cpath.i_best]])
+        utils.set_resource_profile_context(action=utils.resource_profile_context['action'], step='tree-metrics')
         # treeutils.get_trees_for_annotations(annotation_dict, cpath=cpath, workdir=self.args.workdir, min_cluster_size=self.args.min_selection_metric_cluster_size, cluster_indices=self.args.cluster_indices, debug=self.args.debug)  # NOTE this is not tested, but might be worth using in the future
         treeutils.calculate_tree_metrics(annotation_dict, self.args.lb_tau, lbr_tau_factor=self.args.lbr_tau_factor, cpath=cpath, reco_info=self.reco_info, treefname=self.args.treefname,
                                          use_true_clusters=self.reco_info is not None, base_plotdir=self.args.plotdir, ete_path=self.args.ete_path, workdir=self.args.workdir, dont_normalize_lbi=self.args.dont_normalize_lbi,
                                          only_csv=self.args.only_csv_plots, min_cluster_size=self.args.min_selection_metric_cluster_size, dtr_path=self.args.dtr_path, add_aa_consensus_distance=True, include_relative_affy_plots=self.args.include_relative_affy_plots,
-                                         cluster_indices=self.args.cluster_indices, outfname=self.args.selection_metric_fname, glfo=self.glfo, debug=self.args.debug)
+                                         cluster_indices=self.args.cluster_indices, outfname=self.args.selection_metric_fname, glfo=self.glfo, n_procs=self.args.n_procs, debug=self.args.debug)
 
     # ----------------------------------------------------------------------------------------
     def parse_existing_annotations(self, annotation_list, ignore_args_dot_queries=False, process_csv=False):
@@ -450,6 +462,7 @@ class PartitionDriver(object):
 
         annotation_list = []
         cpath = None
+        headerfo = None
         tmpact = self.current_action  # just a shorthand for brevity
         if utils.getsuffix(outfname) == '.csv':  # old way
             if tmpact == 'view-partitions' or tmpact == 'plot-partitions' or tmpact == 'view-output' or tmpact == 'get-selection-metrics' or read_partitions:
@@ -463,11 +476,29 @@ class PartitionDriver(object):
         elif utils.getsuffix(outfname) == '.yaml':  # new way
             # NOTE replaces <self.glfo>, which is definitely what we want (that's the point of putting glfo in the yaml file), but it's still different behavior than if reading a csv
             assert self.glfo is None  # make sure bin/partis successfully figured out that we would be reading the glfo from the yaml output file
-            self.glfo, annotation_list, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)  # add implicit info below, so we can skip some of 'em
+            headerfo = {}
+            def stream_annotations():  # read one event at a time, so we only keep in memory the ones that parse_existing_annotations() keeps
+                for line in utils.iter_yaml_annotations(outfname, headerfo=headerfo, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True):  # add implicit info below, so we can skip some of 'em
+                    if self.glfo is None:  # parse_existing_annotations() needs the germline info, which should come before the events in the file (but if not, we have to read it separately)
+                        if 'germline-info' not in headerfo:
+                            headerfo.update(utils.read_yaml_output_header(outfname))
+                        self.glfo = headerfo['germline-info']
+                    yield line
+            annotation_list = stream_annotations()
+        elif utils.getsuffix(outfname) == '.npz':  # columnar (same deal with <self.glfo> as for yaml)
+            assert self.glfo is None
+            self.glfo, annotation_list, cpath = utils.read_npz_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)  # add implicit info below, so we can skip some of 'em
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
-        annotation_list = self.parse_existing_annotations(annotation_list, ignore_args_dot_queries=ignore_args_dot_queries, process_csv=utils.getsuffix(outfname) == '.csv')  # NOTE modifies <annotation_list>
+        annotation_stream = annotation_list
+        annotation_list = self.parse_existing_annotations(annotation_stream, ignore_args_dot_queries=ignore_args_dot_queries, process_csv=utils.getsuffix(outfname) == '.csv')  # NOTE modifies the lines in <annotation_stream>
+        if headerfo is not None:
+            utils.fill_yaml_output_header(outfname, headerfo)  # iter_yaml_annotations() fills in <headerfo> when it reads the first event, so this only does anything if parse_existing_annotations() didn't get that far
+            self.glfo = headerfo['germline-info']
+            cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+            if len(headerfo['partitions']) > 0:
+                cpath.readlines(headerfo['partitions'])
         annotation_dict = utils.get_annotation_dict(annotation_list)  # returns none type if there's duplicate annotations
 
         if tmpact == 'get-linearham-info':
@@ -584,7 +615,10 @@ class PartitionDriver(object):
         next_n_procs = last_n_procs
 
         factor = 1.3
-        if self.shall_we_reduce_n_procs(last_n_procs, n_proc_list):
+        costfo = self.fit_step_cost_model() if self.args.adaptive_n_procs else None
+        if costfo is not None:
+            next_n_procs = self.choose_n_procs_with_cost_model(costfo, n_proc_list, cpath)
+        elif self.shall_we_reduce_n_procs(last_n_procs, n_proc_list):
             next_n_procs = int(next_n_procs / float(factor))
 
         def time_to_remove_some_seqs(n_proc_threshold):
@@ -599,6 +633,51 @@ class PartitionDriver(object):
 
         return next_n_procs, cpath
 
+    # ----------------------------------------------------------------------------------------
+    def get_proc_work(self, n_clusters, n_seqs):  # relative amount of work we expect from a bcrham partition process with <n_clusters> clusters containing <n_seqs> total seqs, i.e. roughly the number of cluster pairs it needs to compare, weighted by the number of seqs in each pair (which is what each vtb/fwd calculation scales with)
+        return n_clusters * n_seqs
+
+    # ----------------------------------------------------------------------------------------
+    def fit_step_cost_model(self):  # use the per-process times and vtb/fwd counts from the last clustering step to estimate the time per unit of work (see get_proc_work()) and the per-process overhead (returns None if we don't have the info we need)
+        tinfo = self.timing_info[-1]
+        if tinfo.get('proc_sizes') is None or self.bcrham_proc_info is None or len(tinfo['proc_sizes']) != len(self.bcrham_proc_info):
+            return None
+        try:
+            proc_times = [float(pinfo['time']['bcrham']) for pinfo in self.bcrham_proc_info]
+            proc_calcd = [pinfo['calcd']['vtb'] + pinfo['calcd']['fwd'] for pinfo in self.bcrham_proc_info]
+        except (KeyError, TypeError):  # probably lost some stdout somewhere (get_n_calculated_per_process() warns about this)
+            return None
+        total_work = sum(self.get_proc_work(n_clusters, n_seqs) for n_clusters, n_seqs in tinfo['proc_sizes'])
+        if total_work == 0:
+            return None
+        costfo = {'time-per-work' : sum(proc_times) / total_work,  # equivalently, (vtb + fwd calcs per unit work) * (time per calc), but we don't need to separate them
+                  'calcs-per-work' : sum(proc_calcd) / float(total_work),
+                  'overhead-per-proc' : max(0., tinfo['exec'] - max(proc_times)) / len(proc_times),  # time spent starting, waiting for, and cleaning up after processes, beyond what bcrham itself reports
+                  'last-exec-time' : tinfo['exec']}
+        if self.args.debug:
+            print '          cost model: %.2e s per unit work (%.2g vtb + fwd calcs per unit work)   %.2f s overhead per proc   (per-proc work: %s)' % (costfo['time-per-work'], costfo['calcs-per-work'], costfo['overhead-per-proc'], ' '.join(str(self.get_proc_work(nc, ns)) for nc, ns in tinfo['proc_sizes']))
+        return costfo
+
+    # ----------------------------------------------------------------------------------------
+    def choose_n_procs_with_cost_model(self, costfo, n_proc_list, cpath):
+        # Use the cost model from the last step to predict the time the next step would take with each possible number of procs, and choose the smallest number of procs that won't take longer than the last step.
+        # We want as few procs as possible since clusters can only merge if they're in the same proc (and we're only finished when we get to one proc), whereas a step with more procs than necessary would finish a bit faster but then need more steps afterwards.
+        last_n_procs = n_proc_list[-1]
+        partition = cpath.partitions[cpath.i_best_minus_x]
+        n_clusters, n_seqs = len(partition), sum(len(c) for c in partition)
+        def predicted_time(n_procs):  # assumes split_input() balances the work among procs
+            return costfo['overhead-per-proc'] * n_procs + costfo['time-per-work'] * self.get_proc_work(n_clusters / float(n_procs), n_seqs / float(n_procs))
+        max_time = max(self.args.min_hmm_step_time, costfo['last-exec-time'])
+        next_n_procs = last_n_procs
+        for n_procs in range(1, last_n_procs + 1):
+            if predicted_time(n_procs) <= max_time:
+                next_n_procs = n_procs
+                break
+        if next_n_procs == last_n_procs and n_proc_list.count(last_n_procs) >= max(4, last_n_procs):  # if we've already milked this number of procs for most of what it's worth, reduce it anyway (same as in shall_we_reduce_n_procs())
+            next_n_procs = int(last_n_procs / 1.3)
+        print '        cost model: %d clusters (%d seqs) predicted to take %.1fs with %d proc%s (vs %.1fs with %d, max %.1fs)' % (n_clusters, n_seqs, predicted_time(max(1, next_n_procs)), next_n_procs, utils.plural(next_n_procs), predicted_time(last_n_procs), last_n_procs, max_time)
+        return next_n_procs
+
     # ----------------------------------------------------------------------------------------
     def get_n_calculated_per_process(self):
         assert self.bcrham_proc_info is not None
@@ -624,44 +703,7 @@ class PartitionDriver(object):
             print 'merging shared clusters'
             cpath.print_partitions()
 
-        # find every pair of clusters that has some overlap
-        cluster_groups = []
-        if debug:
-            print ' making cluster_groups'
-        for iclust in range(len(partition)):
-            for jclust in range(iclust + 1, len(partition)):
-                if len(set(partition[iclust]) & set(partition[jclust])) > 0:
-                    if debug:
-                        print '  %d %d' % (iclust, jclust)
-                    cluster_groups.append(set([iclust, jclust]))
-
-        # merge these pairs of clusters into groups
-        while True:
-            no_more_merges = True
-            for cp1, cp2 in itertools.combinations(cluster_groups, 2):
-                if len(cp1 & cp2) > 0:
-                    if debug:
-                        print '  merging %s and %s' % (cp1, cp2)
-                    cluster_groups.append(cp1 | cp2)
-                    cluster_groups.remove(cp1)
-                    cluster_groups.remove(cp2)
-                    no_more_merges = False
-                    break  # we've modified it now, so we have to go back and remake the iterator
-            if no_more_merges:
-                break
-
-        # actually merge the groups of clusters
-        new_clusters = []
-        for cgroup in cluster_groups:
-            new_clusters.append(list(set([uid for iclust in cgroup for uid in partition[iclust]])))
-        if debug:
-            print ' removing'
-        for iclust in sorted([i for cgroup in cluster_groups for i in cgroup], reverse=True):
-            if debug:
-                print '    %d' % iclust
-            partition.pop(iclust)
-        for nclust in new_clusters:
-            partition.append(nclust)
+        partition[:] = utils.merge_overlapping_clusters(partition, debug=debug)  # modify in place, since other things may be holding a reference to it
 
         if debug:
             cpath.print_partitions()
@@ -750,14 +792,19 @@ class PartitionDriver(object):
         n_proc_list = []
         self.istep = 0
         start = time.time()
-        while n_procs > 0:
-            print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
-            cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
-            n_proc_list.append(n_procs)
-            if self.are_we_finished_clustering(n_procs, cpath):
-                break
-            n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
-            self.istep += 1
+        if self.args.pipelined_clustering and n_procs > 1 and self.args.seed_unique_id is None and self.args.small_clusters_to_ignore is None:
+            cpath = self.run_pipelined_clustering(cpath, n_procs)
+        else:
+            if self.args.pipelined_clustering:
+                print '  %s --pipelined-clustering requires --n-procs greater than 1, and isn\'t compatible with --seed-unique-id or --small-clusters-to-ignore, so running regular clustering steps' % utils.color('yellow', 'warning')
+            while n_procs > 0:
+                print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
+                cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
+                n_proc_list.append(n_procs)
+                if self.are_we_finished_clustering(n_procs, cpath):
+                    break
+                n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
+                self.istep += 1
 
         if self.args.max_cluster_size is not None:
             print '   --max-cluster-size (partitiondriver): merging shared clusters'
@@ -768,6 +815,113 @@ class PartitionDriver(object):
         print '      loop time: %.1f' % (time.time()-start)
         return cpath
 
+    # ----------------------------------------------------------------------------------------
+    def run_pipelined_clustering(self, cpath, n_procs):
+        # Instead of running each clustering step as a barrier (where every proc has to finish before we merge their output and re-split for the next step), we start with <n_procs> procs, and as soon as any two have finished we combine their output clusters and start a new proc on them.
+        # So it's a tree of procs rather than a series of steps: a slow proc only holds up the one proc that depends on it, and the final proc (the root, which sees every cluster) is run just like the last, single-proc step in regular clustering.
+        start = time.time()
+        partition = cpath.partitions[cpath.i_best_minus_x]
+        n_leaves = max(1, min(n_procs, len(partition) / 2))  # make sure each initial proc has at least a couple clusters
+        pipeline_dir = self.args.workdir + '/pipeline'
+        self.subworkdirs.append(pipeline_dir)
+        glutils.write_glfo(self.my_gldir, self.glfo)
+        utils.set_resource_profile_context(action=utils.resource_profile_context['action'], step='hmm-pipelined-clustering')
+
+        tasks, pending, running, results = [], [], [], []  # all tasks, tasks waiting for a free core, tasks that are running, and output partitions (and number of leaves) of finished tasks that we haven't yet combined (note that tasks start in the order we add them, so each task's index in <tasks> is also its index in utils.iter_finished_cmds())
+        def add_task(clusters, n_task_leaves):
+            workdir = '%s/task-%d' % (pipeline_dir, len(tasks))
+            utils.prep_dir(workdir)
+            task = {'itask' : len(tasks), 'workdir' : workdir, 'clusters' : clusters, 'n_leaves' : n_task_leaves, 'is_root' : n_task_leaves == n_leaves,
+                    'infname' : workdir + '/' + os.path.basename(self.hmm_infname), 'outfname' : workdir + '/' + os.path.basename(self.hmm_outfname), 'cachefname' : workdir + '/' + os.path.basename(self.hmm_cachefname)}
+            self.write_to_single_input_file(task['infname'], copy.deepcopy(clusters), self.sub_param_dir, shuffle_input=True)
+            tasks.append(task)
+            pending.append(task)
+        def launch(islot):  # start the next pending task (if there is one) on core <islot>
+            if len(pending) == 0:
+                return None
+            task = pending.pop(0)
+            cmd_str = self.get_hmm_cmd_str('forward', task['infname'], task['outfname'], parameter_dir=self.sub_param_dir, precache_all_naive_seqs=False, n_procs=1 if task['is_root'] else n_procs)
+            if not task['is_root']:  # non-root procs only write newly-calculated cache info, to their own cache file (which we merge into the main one when they finish), whereas the root proc works just like a single-proc clustering step
+                strlist = cmd_str.split()
+                strlist[strlist.index('--output-cachefname') + 1] = task['cachefname']
+                cmd_str = ' '.join(strlist)
+            task['cmdfo'] = {'cmd_str' : cmd_str, 'workdir' : task['workdir'], 'logdir' : task['workdir'], 'outfname' : task['outfname'], 'dbgfo' : {}}
+            task['islot'] = islot
+            running.append(task)
+            if self.args.debug:
+                print '        starting proc %d on core %d with %d clusters%s' % (task['itask'], islot, len(task['clusters']), ' (root)' if task['is_root'] else '')
+            return task['cmdfo']
+        def write_progress_cpath(progress_cpath):  # write the cpath progress file for each finished task, so merge_cpaths_from_previous_steps() can stitch together the partition history (it expects one file per step)
+            if os.path.exists(self.get_cpath_progress_fname(self.istep)):
+                self.istep += 1
+            progress_cpath.write(self.get_cpath_progress_fname(self.istep), self.args.is_data, reco_info=self.reco_info, true_partition=utils.get_true_partition(self.reco_info) if not self.args.is_data else None)
+
+        # split the initial clusters among the leaf tasks (same methods as split_input(), but we write each task's input file directly)
+        initial_clusters = copy.deepcopy(partition)
+        random.shuffle(initial_clusters)
+        proc_lines = [[] for _ in range(n_leaves)]
+        self.distribute_input_lines(proc_lines, [{'names' : ':'.join(c), 'cdr3_length' : self.sw_info[c[0]]['cdr3_length']} for c in initial_clusters])
+        for lines in proc_lines:
+            add_task([l['names'].split(':') for l in lines], 1)
+        print '%d clusters with pipelined procs on %d core%s (%d initial procs)' % (len(partition), n_procs, utils.plural(n_procs), n_leaves)
+
+        final_cpath = None
+        for itask, procfo in utils.iter_finished_cmds(launch, n_slots=n_procs, batch_system=self.args.batch_system, batch_options=self.args.batch_options, debug='print' if self.args.debug else None):
+            task = tasks[itask]
+            task['start'], task['end'] = procfo['start'] - start, procfo['end'] - start
+            running.remove(task)
+            task_cpath = self.read_pipelined_task_output(task)
+            if self.args.debug:
+                print '        finished proc %d on core %d: %d --> %d clusters in %.1fs' % (task['itask'], task['islot'], len(task['clusters']), len(task_cpath.partitions[task_cpath.i_best_minus_x]), task['end'] - task['start'])
+            if task['is_root']:
+                final_cpath = task_cpath
+                break
+            results.append((task_cpath.partitions[task_cpath.i_best_minus_x], task['n_leaves']))
+            progress_cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+            progress_cpath.add_partition([c for rpartition, _ in results for c in rpartition] + [c for t in running + pending for c in t['clusters']], float('-inf'), n_procs)  # best guess at the current overall partition
+            write_progress_cpath(progress_cpath)
+            while len(results) > 1:  # combine any pairs of output partitions into a new task
+                (partition_a, n_leaves_a), (partition_b, n_leaves_b) = results.pop(0), results.pop(0)
+                add_task(partition_a + partition_b, n_leaves_a + n_leaves_b)
+        write_progress_cpath(final_cpath)
+        glutils.remove_glfo_files(self.my_gldir, self.args.locus)
+        total_time = time.time() - start
+        self.timing_info.append({'exec' : total_time, 'total' : total_time, 'proc_sizes' : None})
+        self.print_pipeline_trace(tasks, n_procs, total_time)
+        return final_cpath
+
+    # ----------------------------------------------------------------------------------------
+    def read_pipelined_task_output(self, task):  # read the output partition(s) from a finished pipelined clustering task, merge its new cache info into the main cache file, and clean up its workdir
+        if not task['is_root'] and os.path.exists(task['cachefname']):
+            tmpfname = self.hmm_cachefname + '.tmp'  # other procs may be starting up and reading the main cache file, so we have to replace it atomically rather than appending to it
+            if utils.merge_csv_lines([self.hmm_cachefname, task['cachefname']], tmpfname) is not None:
+                os.rename(tmpfname, self.hmm_cachefname)
+            os.remove(task['cachefname'])
+        glomerer = Glomerator(self.reco_info, seed_unique_id=self.args.seed_unique_id)
+        task_cpath = glomerer.read_cached_agglomeration([task['outfname']], debug=self.args.debug)
+        for fname in [task['infname'], task['outfname']]:
+            if os.path.exists(fname):
+                os.remove(fname)
+        os.rmdir(task['workdir'])
+        return task_cpath
+
+    # ----------------------------------------------------------------------------------------
+    def print_pipeline_trace(self, tasks, n_slots, total_time, width=60):  # print a timeline of which tasks were running on each core, and the fraction of the time that each core was busy
+        print '      pipeline trace: %d procs on %d core%s in %.1fs (each column is %.2fs, alternating # and = for successive procs)' % (len(tasks), n_slots, utils.plural(n_slots), total_time, total_time / width)
+        busy_fractions = []
+        for islot in range(n_slots):
+            slot_tasks = sorted([t for t in tasks if t.get('islot') == islot and 'end' in t], key=lambda t: t['start'])
+            busy_fractions.append(sum(t['end'] - t['start'] for t in slot_tasks) / total_time if total_time > 0. else 0.)
+            if n_slots > 30 and not self.args.debug:  # too many lines
+                continue
+            timeline = ['.' for _ in range(width)]
+            for itask, task in enumerate(slot_tasks):
+                istart = min(width - 1, int(width * task['start'] / total_time))
+                for icol in range(istart, max(istart + 1, int(width * task['end'] / total_time))):
+                    timeline[icol] = '#' if itask % 2 == 0 else '='
+            print '        core %3d  %5.1f%%  %s' % (islot, 100 * busy_fractions[-1], ''.join(timeline))
+        print '        mean core utilization: %.1f%%' % (100 * numpy.mean(busy_fractions))
+
     # ----------------------------------------------------------------------------------------
     def check_partition(self, partition):
         uids = set([uid for cluster in partition for uid in cluster])
@@ -880,30 +1034,59 @@ class PartitionDriver(object):
             self.print_results(cpath, all_annotations.values())
 
     # ----------------------------------------------------------------------------------------
-    def get_cached_hmm_naive_seqs(self, queries=None):
-        # would be nice to merge this with self.read_hmm_cachefile()
-        expected_queries = self.sw_info['queries'] if queries is None else queries
-        cached_naive_seqs = {}
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                if ':' in line['unique_ids']:  # if it's a cache file left over from a previous partitioning, there'll be clusters in it, too
-                    continue
-                if line['unique_ids'] not in expected_queries:  # probably can only happen if self.args.persistent_cachefname is set
+    def get_hmm_cache_index(self):  # NOTE bcrham reads and writes the csv cache file, so we can't change its format, but we can at least avoid csv-parsing the whole thing whenever we need a few lines from it
+        """ Return map from each uid string in the hmm cache file to the byte offsets of its lines (there can be more than one line for a uid string, e.g. if we calculated its naive seq and logprob in different steps). """
+        fstat = os.stat(self.hmm_cachefname)
+        filekey = (fstat.st_ino, fstat.st_size, fstat.st_mtime)  # rebuild the index if the file has changed since we last indexed it
+        if self.hmm_cache_index is None or self.hmm_cache_index['filekey'] != filekey:
+            offsets = {}
+            with open(self.hmm_cachefname, 'rb') as cachefile:
+                offset = len(cachefile.readline())  # skip header
+                for line in cachefile:
+                    uidstr = line[ : line.find(',')]
+                    if uidstr not in offsets:
+                        offsets[uidstr] = []
+                    offsets[uidstr].append(offset)
+                    offset += len(line)
+            self.hmm_cache_index = {'filekey' : filekey, 'offsets' : offsets}
+        return self.hmm_cache_index['offsets']
+
+    # ----------------------------------------------------------------------------------------
+    def read_hmm_cache_lines(self, uidstrs=None):
+        """ Return dict (keyed by uid string) of hmm cache file lines for each of <uidstrs> (all of 'em, if it isn't set) that's in the cache file, using the index to only read the lines we need. """
+        cache_index = self.get_hmm_cache_index()
+        if uidstrs is None:
+            uidstrs = cache_index.keys()
+        cache_lines = {}
+        if os.stat(self.hmm_cachefname).st_size == 0:  # can't mmap an empty file
+            return cache_lines
+        with open(self.hmm_cachefname, 'rb') as cachefile:
+            cachemap = mmap.mmap(cachefile.fileno(), 0, access=mmap.ACCESS_READ)  # read-only, so the os can share the pages with the bcrham subprocs reading the same file
+            for uidstr in uidstrs:
+                if uidstr not in cache_index:
                     continue
-                cached_naive_seqs[line['unique_ids']] = line['naive_seq']
-                if len(cached_naive_seqs) == len(expected_queries):  # already got everybody
-                    break
+                line = None
+                for offset in cache_index[uidstr]:
+                    end = cachemap.find('\n', offset)
+                    vals = cachemap[offset : end if end >= 0 else len(cachemap)].rstrip('\r').split(',')  # bcrham doesn't quote anything, and commas aren't allowed in uids, so we don't need the csv module
+                    if line is None:
+                        line = dict(zip(utils.partition_cachefile_headers, vals))
+                    else:  # same as bcrham: later lines only replace values that are actually set
+                        line.update({k : v for k, v in zip(utils.partition_cachefile_headers, vals) if v != ''})
+                cache_lines[uidstr] = line
+            cachemap.close()
+        return cache_lines
+
+    # ----------------------------------------------------------------------------------------
+    def get_cached_hmm_naive_seqs(self, queries=None):
+        expected_queries = set(self.sw_info['queries'] if queries is None else queries)
+        cached_naive_seqs = {uid : line['naive_seq'] for uid, line in self.read_hmm_cache_lines(expected_queries).items() if line['naive_seq'] != ''}  # NOTE if it's a cache file left over from a previous partitioning, there'll be clusters in it, too, but we only look up singletons
 
-        if set(cached_naive_seqs) != set(expected_queries):  # can happen if hmm can't find a path for a sequence for which sw *did* have an annotation (but in that case the annotation is almost certainly garbage)
-            extra = set(cached_naive_seqs) - set(expected_queries)
-            missing = set(expected_queries) - set(cached_naive_seqs)
-            if len(extra) > 0:
-                print '    %s read %d extra queries from hmm cache file %s' % (utils.color('yellow', 'warning:'), len(extra), ' '.join(extra))
-            if len(missing) > 0:
-                print '    %s missing %d queries from hmm cache file (using sw naive sequence instead): %s' % (utils.color('yellow', 'warning:'), len(missing), ' '.join(missing))
-                for uid in missing:
-                    cached_naive_seqs[uid] = self.sw_info[uid]['naive_seq']
+        if set(cached_naive_seqs) != expected_queries:  # can happen if hmm can't find a path for a sequence for which sw *did* have an annotation (but in that case the annotation is almost certainly garbage)
+            missing = expected_queries - set(cached_naive_seqs)
+            print '    %s missing %d queries from hmm cache file (using sw naive sequence instead): %s' % (utils.color('yellow', 'warning:'), len(missing), ' '.join(missing))
+            for uid in missing:
+                cached_naive_seqs[uid] = self.sw_info[uid]['naive_seq']
 
         return cached_naive_seqs
 
@@ -923,6 +1106,7 @@ class PartitionDriver(object):
         all_naive_seqs, naive_seq_hashes = utils.collapse_naive_seqs_with_hashes(naive_seq_list, self.sw_info)
 
         print '    using hfrac bound for vsearch %.3f' % threshold
+        utils.set_resource_profile_context(action=utils.resource_profile_context['action'], step='vsearch-clustering')
 
         partition = []
         print '    running vsearch %d times (once for each cdr3 length class):' % len(all_naive_seqs),
@@ -994,7 +1178,7 @@ class PartitionDriver(object):
         cmd_str += ' --outfile ' + csv_outfname
         cmd_str += ' --locus ' + self.args.locus
         cmd_str += ' --random-seed ' + str(self.args.seed)
-        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (initial cache file is copied to each subdir)
+        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (all subprocs read the initial cache file from the main workdir)
             cmd_str += ' --only-cache-new-vals'
 
         if self.args.dont_rescale_emissions:
@@ -1072,6 +1256,9 @@ class PartitionDriver(object):
             print '                     time:  %.1f sec' % summaryfo['time']['bcrham'][0]
         else:
             print '             min-max time:  %.1f - %.1f sec' % (summaryfo['time']['bcrham'][0], summaryfo['time']['bcrham'][1])
+        rsfos = [pinfo['resources'] for pinfo in self.bcrham_proc_info if pinfo.get('resources', {}).get('maxrss') is not None]  # from utils.run_cmds()
+        if len(rsfos) > 0:
+            print '                resources:  cpu %.1f sec (user + sys, summed over procs)   max rss %.0f MB' % (sum(r['user'] + r['sys'] for r in rsfos), max(r['maxrss'] for r in rsfos))
 
     # ----------------------------------------------------------------------------------------
     def check_wait_times(self, wait_time):
@@ -1080,14 +1267,16 @@ class PartitionDriver(object):
             print '    spent much longer waiting for bcrham (%.1fs) than bcrham reported taking (max per-proc time %.1fs)' % (wait_time, max_bcrham_time)
 
     # ----------------------------------------------------------------------------------------
-    def execute(self, cmd_str, n_procs):
+    def execute(self, cmd_str, n_procs, proc_sizes=None):
         # ----------------------------------------------------------------------------------------
         def get_outfname(iproc):
             return self.hmm_outfname.replace(self.args.workdir, self.subworkdir(iproc, n_procs))
         # ----------------------------------------------------------------------------------------
-        def get_cmd_str(iproc):  # all this does at this point is replace workdir with sub-workdir in hmm input, output, and cache file arguments
+        def get_cmd_str(iproc):  # all this does at this point is replace workdir with sub-workdir in hmm input, output, and output cache file arguments
             strlist = cmd_str.split()
             for istr in range(len(strlist)):
+                if istr > 0 and strlist[istr - 1] == '--input-cachefname':  # all the subprocs read the same (read-only) input cache file in the main workdir, rather than each getting their own copy (they only write new info to their output cache files, so it doesn't get modified until we merge after they've all finished)
+                    continue
                 if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_cachefname or strlist[istr] == self.hmm_outfname:
                     strlist[istr] = strlist[istr].replace(self.args.workdir, self.subworkdir(iproc, n_procs))
             return ' '.join(strlist)
@@ -1104,6 +1293,8 @@ class PartitionDriver(object):
                   for iproc in range(n_procs)]
         utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
         self.print_partition_dbgfo()
+        if proc_sizes is not None and n_procs > 1 and (self.args.split_input_balancing != 'round-robin' or self.args.debug):
+            self.print_straggler_report(proc_sizes)
 
         self.check_wait_times(time.time()-start)
         sys.stdout.flush()
@@ -1126,12 +1317,16 @@ class PartitionDriver(object):
         glutils.write_glfo(self.my_gldir, self.glfo)
 
         cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
+        utils.set_resource_profile_context(action=utils.resource_profile_context['action'], step='hmm-%s%s' % ('precache-naive-seqs' if precache_all_naive_seqs else algorithm, ('-istep-%d' % self.istep) if self.current_action == 'partition' and algorithm == 'forward' else ''))
 
+        proc_sizes = None  # number of clusters and number of seqs that each proc gets (for the cost model)
         if n_procs > 1:
-            self.split_input(n_procs, self.hmm_infname)
+            proc_sizes = self.split_input(n_procs, self.hmm_infname)
+        elif partition is not None:
+            proc_sizes = [(len(partition), sum(len(c) for c in partition))]
 
         exec_start = time.time()
-        self.execute(cmd_str, n_procs)
+        self.execute(cmd_str, n_procs, proc_sizes=proc_sizes)
         exec_time = time.time() - exec_start
 
         glutils.remove_glfo_files(self.my_gldir, self.args.locus)
@@ -1153,21 +1348,18 @@ class PartitionDriver(object):
         if step_time - exec_time > 0.1:
             print '         infra time: %.1f' % (step_time - exec_time)  # i.e. time for non-executing, infrastructure time
         print '      hmm step time: %.1f' % step_time
-        self.timing_info.append({'exec' : exec_time, 'total' : step_time})  # NOTE in general, includes pre-cache step
+        self.timing_info.append({'exec' : exec_time, 'total' : step_time, 'proc_sizes' : proc_sizes})  # NOTE in general, includes pre-cache step
 
         return cpath, annotations, hmm_failures
 
     # ----------------------------------------------------------------------------------------
     def read_hmm_cachefile(self):
-        # would be nice to merge this with self.get_cached_hmm_naive_seqs()
         cachefo = {}
         if not os.path.exists(self.hmm_cachefname):
             return cachefo
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                utils.process_input_line(line)
-                cachefo[':'.join(line['unique_ids'])] = line
+        for uidstr, line in self.read_hmm_cache_lines().items():
+            utils.process_input_line(line)
+            cachefo[uidstr] = line
         return cachefo
 
     # ----------------------------------------------------------------------------------------
@@ -1390,45 +1582,123 @@ class PartitionDriver(object):
             return open(self.subworkdir(siproc, n_procs) + '/' + os.path.basename(infname), mode)
         def get_writer(sub_outfile):
             return csv.DictWriter(sub_outfile, reader.fieldnames, delimiter=' ')
-        def copy_cache_files(n_procs):
-            cmdfos = [{'cmd_str' : 'cp ' + self.hmm_cachefname + ' ' + self.subworkdir(iproc, n_procs) + '/',
-                       'workdir' : self.subworkdir(iproc, n_procs),
-                       'outfname' : self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)}
-                      for iproc in range(n_procs)]
-            utils.run_cmds(cmdfos)
-
-        # initialize output/cache files
-        for iproc in range(n_procs):
-            utils.prep_dir(self.subworkdir(iproc, n_procs))
-            sub_outfile = get_sub_outfile(iproc, 'w')
-            get_writer(sub_outfile).writeheader()
-            sub_outfile.close()  # can't leave 'em all open the whole time 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
-        if self.current_action == 'partition' and os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir (first clause is just for so when we're getting cluster annotations we don't copy over the cache files)
-            copy_cache_files(n_procs)
 
-        seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
-        for iproc in range(n_procs):
-            sub_outfile = get_sub_outfile(iproc, 'a')
-            writer = get_writer(sub_outfile)
-
-            # first deal with the seeded clusters
-            if separate_seeded_clusters:  # write the seed info line to each file
+        # first deal with the seeded clusters
+        proc_lines = [[] for _ in range(n_procs)]  # info lines for each proc
+        if separate_seeded_clusters:  # write the seed info line to each file
+            seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
+            for iproc in range(n_procs):
                 if len(seed_clusters_to_write) > 0:
                     if iproc < n_procs - 1:  # if we're not on the last proc, pop off and write the first one
-                        writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                        proc_lines[iproc].append(seeded_clusters[seed_clusters_to_write.pop(0)])
                     else:
                         while len(seed_clusters_to_write) > 0:  # keep adding 'em until we run out
-                            writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                            proc_lines[iproc].append(seeded_clusters[seed_clusters_to_write.pop(0)])
                 else:  # if we don't have any more that we *need* to write (i.e. that have other seqs in them), just write the shortest one (which will frequently be a singleton)
-                    writer.writerow(seeded_clusters[smallest_seed_cluster_str])
+                    proc_lines[iproc].append(seeded_clusters[smallest_seed_cluster_str])
 
-            # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
-                    continue
-                writer.writerow(info[iquery])
+        # then the non-seeded clusters
+        self.distribute_input_lines(proc_lines, info)
+
+        # NOTE we no longer copy the cache file to each subdir, since the subprocs all read the one in the main workdir (see execute())
+        for iproc in range(n_procs):
+            utils.prep_dir(self.subworkdir(iproc, n_procs))
+            sub_outfile = get_sub_outfile(iproc, 'w')  # only open one at a time, 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
+            writer = get_writer(sub_outfile)
+            writer.writeheader()
+            for line in proc_lines[iproc]:
+                writer.writerow(line)
             sub_outfile.close()
 
+        proc_sizes = [(len(lines), sum(self.get_input_line_cluster_size(l) for l in lines)) for lines in proc_lines]
+        if self.args.debug:
+            proc_work = [self.get_proc_work(n_clusters, n_seqs) for n_clusters, n_seqs in proc_sizes]
+            mean_work = numpy.mean(proc_work)
+            print '      split input (%s): expected work per proc relative to mean: %s' % (self.args.split_input_balancing if self.current_action == 'partition' else 'round-robin', ' '.join(('%.2f' % (w / mean_work)) if mean_work > 0 else '-' for w in proc_work))
+        return proc_sizes
+
+    # ----------------------------------------------------------------------------------------
+    def distribute_input_lines(self, proc_lines, info):  # add the hmm input lines in <info> to <proc_lines> according to --split-input-balancing
+        if self.current_action == 'partition' and self.args.split_input_balancing == 'cluster-size':
+            self.add_balanced_proc_lines(proc_lines, info)
+        elif self.current_action == 'partition' and self.args.split_input_balancing == 'naive-seq':
+            self.add_naive_seq_grouped_proc_lines(proc_lines, info)
+        else:  # round robin
+            for iproc in range(len(proc_lines)):
+                proc_lines[iproc] += [info[iquery] for iquery in range(iproc, len(info), len(proc_lines))]
+
+    # ----------------------------------------------------------------------------------------
+    def get_input_line_cluster_size(self, line):  # number of seqs in the cluster in a line from the hmm input file
+        return line['names'].count(':') + 1
+
+    # ----------------------------------------------------------------------------------------
+    def add_balanced_proc_lines(self, proc_lines, info):
+        # Add the hmm input lines in <info> to <proc_lines> such that each proc gets about the same amount of expected work (see get_proc_work()), rather than round robin (which can give several of the biggest clusters to the same proc).
+        # Greedy: go through clusters from largest to smallest, giving each to the proc with the least work so far.
+        proc_sizes = [[len(lines), sum(self.get_input_line_cluster_size(l) for l in lines)] for lines in proc_lines]  # number of clusters and number of seqs in each proc
+        work_heap = [(self.get_proc_work(n_clusters, n_seqs), iproc) for iproc, (n_clusters, n_seqs) in enumerate(proc_sizes)]
+        heapq.heapify(work_heap)
+        for line in sorted(info, key=self.get_input_line_cluster_size, reverse=True):  # sort is stable, so clusters of the same size stay in their (shuffled) order, which is what redistributes them among procs from step to step
+            _, iproc = heapq.heappop(work_heap)
+            proc_lines[iproc].append(line)
+            proc_sizes[iproc][0] += 1
+            proc_sizes[iproc][1] += self.get_input_line_cluster_size(line)
+            heapq.heappush(work_heap, (self.get_proc_work(*proc_sizes[iproc]), iproc))
+
+    # ----------------------------------------------------------------------------------------
+    def get_input_line_naive_seqs(self, info):  # naive seq for each hmm input line's cluster, from the hmm cache file if possible (if the cluster itself isn't there, we use its first seq's naive seq, and if that's not there either, the sw naive seq)
+        first_uids = {line['names'] : line['names'].split(':')[0] for line in info}
+        cache_lines = self.read_hmm_cache_lines(set(first_uids) | set(first_uids.values())) if os.path.exists(self.hmm_cachefname) else {}
+        naive_seqs = {}
+        for uidstr, first_uid in first_uids.items():
+            for cstr in [uidstr, first_uid]:
+                if cstr in cache_lines and cache_lines[cstr]['naive_seq'] != '':
+                    naive_seqs[uidstr] = cache_lines[cstr]['naive_seq']
+                    break
+            else:
+                naive_seqs[uidstr] = self.sw_info[first_uid]['naive_seq']
+        return naive_seqs
+
+    # ----------------------------------------------------------------------------------------
+    def add_naive_seq_grouped_proc_lines(self, proc_lines, info):
+        # Like add_balanced_proc_lines(), but also try to put clusters that are likely to merge in the same proc.
+        # We sort by cdr3 length (clusters with different cdr3 lengths never merge) and then by naive seq (so clusters with similar naive seqs are mostly near each other), then cut the sorted list into contiguous chunks with about the same expected work.
+        naive_seqs = self.get_input_line_naive_seqs(info)
+        sorted_lines = sorted(info, key=lambda l: (int(l['cdr3_length']), naive_seqs[l['names']]))
+        n_clusters_left, n_seqs_left = len(sorted_lines), sum(self.get_input_line_cluster_size(l) for l in sorted_lines)
+        iproc, n_clusters, n_seqs = 0, 0, 0  # proc we're currently filling, and how many clusters and seqs we've given it so far
+        for line in sorted_lines:
+            csize = self.get_input_line_cluster_size(line)
+            if n_clusters > 0 and iproc < len(proc_lines) - 1:  # if there's already something in this proc, and it isn't the last one, see if it's closer to its target work with or without this line
+                n_procs_left = len(proc_lines) - iproc
+                target_work = self.get_proc_work((n_clusters + n_clusters_left) / float(n_procs_left), (n_seqs + n_seqs_left) / float(n_procs_left))  # re-evaluated for each proc, so an over- or under-full proc doesn't throw off the rest of 'em
+                if n_clusters_left < n_procs_left:  # no more clusters left (including this one) than procs after this one, so we have to move on, or else some procs at the end will be empty
+                    iproc, n_clusters, n_seqs = iproc + 1, 0, 0
+                elif abs(self.get_proc_work(n_clusters + 1, n_seqs + csize) - target_work) > abs(self.get_proc_work(n_clusters, n_seqs) - target_work):
+                    iproc, n_clusters, n_seqs = iproc + 1, 0, 0
+            proc_lines[iproc].append(line)
+            n_clusters += 1
+            n_seqs += csize
+            n_clusters_left -= 1
+            n_seqs_left -= csize
+
+    # ----------------------------------------------------------------------------------------
+    def print_straggler_report(self, proc_sizes):  # compare the expected work (from split_input()) for each proc to how long it actually took, to see if one proc held up all the others
+        try:
+            proc_times = [float(pinfo['time']['bcrham']) for pinfo in self.bcrham_proc_info]
+        except (KeyError, TypeError):  # probably lost some stdout
+            return
+        proc_work = [self.get_proc_work(n_clusters, n_seqs) for n_clusters, n_seqs in proc_sizes]
+        mean_time, mean_work = numpy.mean(proc_times), float(numpy.mean(proc_work))
+        if mean_time == 0. or mean_work == 0.:
+            return
+        islowest = proc_times.index(max(proc_times))
+        print '          straggler: proc %d took %.1fs (%.1fx the mean of %.1fs) with %.2fx the mean expected work (%d clusters, %d seqs)' % (islowest, proc_times[islowest], proc_times[islowest] / mean_time, mean_time, proc_work[islowest] / mean_work, proc_sizes[islowest][0], proc_sizes[islowest][1])
+        if self.args.debug:
+            print '             iproc   clusters   seqs   expected work   time (s)   (both relative to mean)'
+            for iproc, ((n_clusters, n_seqs), work, ptime) in enumerate(zip(proc_sizes, proc_work, proc_times)):
+                print '             %3d     %6d   %6d       %5.2f          %5.2f    %s' % (iproc, n_clusters, n_seqs, work / mean_work, ptime / mean_time, utils.color('red', '<--') if iproc == islowest else '')
+
     # ----------------------------------------------------------------------------------------
     def merge_subprocess_files(self, fname, n_procs, include_outfile=False):
         subfnames = []
@@ -1445,55 +1715,16 @@ class PartitionDriver(object):
         NOTE that <outfname> is overwritten with the zero-length file if it exists, otherwise it is created.
         Some of <infnames> may not exist.
         """
-        # check_call(['wc', ] + [fn for fn in infnames if fn != outfname])
-        # if os.path.exists(outfname):
-        #     check_call(['wc', outfname])
-        # else:
-        #     print '  outfname d.n.e.'
-
-        header = ''
-        outfile = None
-        one_real_file = False
-        if outfname not in infnames or not os.path.exists(outfname):  # if it *is* in <infnames> we assume we can just tack the other infnames onto the end of it and use <outfname>'s header
-            outfile = open(outfname, 'w')
-        for fname in infnames:
-            if not os.path.exists(fname) or os.stat(fname).st_size == 0:
-                continue
-            one_real_file = True
-            with open(fname) as headfile:
-                reader = csv.DictReader(headfile)
-                header = ','.join(reader.fieldnames)
-                if outfile is not None:
-                    writer = csv.DictWriter(outfile, reader.fieldnames)
-                    writer.writeheader()
-            break  # kinda weird to do it this way, but we just need one of the infiles to get the header info (and some may be zero length)
-        if outfile is not None:
-            outfile.close()
-        if not one_real_file:
-            print '    nothing to merge into %s' % outfname
-            return
-
-        assert header != ''
-
-        non_out_infnames = [fn for fn in infnames if fn != outfname]
-        if len(non_out_infnames) == 0:
+        if len([fn for fn in infnames if fn != outfname]) == 0:
             raise Exception('merge_files() called with <infnames> consisting only of <outfname>')
-        cmd = 'cat ' + ' '.join(non_out_infnames) + ' | grep -v \'' + header + '\''
-        cmd += ' >>' + outfname
-        try:
-            check_call(cmd, shell=True)
-        except CalledProcessError:
-            print '    nothing to merge into %s' % outfname
-            # raise Exception('only read headers from %s', ' '.join([fn for fn in infnames if fn != outfname]))
 
-        if dereplicate:
-            tmpfname = outfname + '.tmp'
-            check_call('echo ' + header + ' >' + tmpfname, shell=True)
-            check_call('grep -v \'' + header + '\' ' + outfname + ' | sort | uniq >>' + tmpfname, shell=True)  # NOTE there can be multiple lines with the same uid string, but this is ok -- the c++ handles it
-            check_call(['mv', tmpfname, outfname])
+        n_lines = utils.merge_csv_lines(infnames, outfname, dereplicate=dereplicate)  # streams through each file once, rather than shelling out to cat/grep (and sort/uniq when dereplicating)
+        if n_lines is None:
+            print '    nothing to merge into %s' % outfname
+            return
 
         for infname in infnames:
-            if infname != outfname:
+            if infname != outfname and os.path.exists(infname):
                 os.remove(infname)
 
     # ----------------------------------------------------------------------------------------
@@ -1840,6 +2071,7 @@ class PartitionDriver(object):
             print '  %s couldn\'t account for %d missing input uid%s%s' % (utils.color('red', 'warning'), len(missing_input_keys), utils.plural(len(missing_input_keys)), ': %s' % ' '.join(missing_input_keys) if len(missing_input_keys) < 15 else '')
 
     # ----------------------------------------------------------------------------------------
+    @utils.profiled_stage('read-annotation-output')
     def read_annotation_output(self, annotation_fname, count_parameters=False, parameter_out_dir=None, print_annotations=False):
         """ Read bcrham annotation output """
         def check_invalid(line, hmm_failures):
@@ -2018,13 +2250,14 @@ class PartitionDriver(object):
             outfile.close()
 
     # ----------------------------------------------------------------------------------------
+    @utils.profiled_stage('write-output')
     def write_output(self, annotation_list, hmm_failures, cpath=None, dont_write_failed_queries=False, write_sw=False, outfname=None):
         if outfname is None:
             outfname = self.args.outfname
 
         if write_sw:
             assert annotation_list is None
-            annotation_list = [self.sw_info[q] for q in self.input_info if q in self.sw_info['queries']]
+            annotation_list = (self.sw_info[q] for q in self.input_info if q in self.sw_info['queries'])  # the writers only go through it once, so no need to make a list
 
         failed_queries = None
         if not dont_write_failed_queries:  # write empty lines for seqs that failed either in sw or the hmm
@@ -2047,6 +2280,7 @@ class PartitionDriver(object):
             partition_lines = cpath.get_partition_lines(self.args.is_data, reco_info=self.reco_info, true_partition=true_partition, n_to_write=self.args.n_partitions_to_write, calc_missing_values=('all' if (len(annotation_list) < 500) else 'best'))
 
         if self.args.extra_annotation_columns is not None and 'linearham-info' in self.args.extra_annotation_columns:  # it would be nice to do this in utils.add_extra_column(), but it requires sw info, which would then have to be passed through all the output infrastructure
+            annotation_list = list(annotation_list)  # in case it's a generator, since we go through it twice
             utils.add_linearham_info(self.sw_info, annotation_list, self.args.min_selection_metric_cluster_size)
 
         headers = utils.add_lists(utils.annotation_headers if not write_sw else utils.sw_cache_headers, self.args.extra_annotation_columns)
@@ -2055,7 +2289,7 @@ class PartitionDriver(object):
                 cpath.write(outfname, self.args.is_data, partition_lines=partition_lines)  # don't need to pass in reco_info/true_partition since we passed them when we got the partition lines
             annotation_fname = outfname if cpath is None else self.args.cluster_annotation_fname
             utils.write_annotations(annotation_fname, self.glfo, annotation_list, headers, failed_queries=failed_queries)
-        elif utils.getsuffix(outfname) == '.yaml':
+        elif utils.getsuffix(outfname) in ['.yaml', '.npz']:
             utils.write_annotations(outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=self.args.write_full_yaml_output)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
@@ -187,6 +187,8 @@ def process(args):
             raise Exception('can\'t specify both --all-seqs-simultaneous and --simultaneous-true-clonal-seqs')
     if args.n_simultaneous_seqs is not None and args.all_seqs_simultaneous:
         raise Exception('doesn\'t make sense to set both --n-simultaneous-seqs and --all-seqs-simultaneous.')
+    if args.split_input_balancing is None:  # set default here so it can depend on --adaptive-n-procs
+        args.split_input_balancing = 'cluster-size' if args.adaptive_n_procs else 'round-robin'
 
     if args.no_indels:
         print 'forcing --gap-open-penalty to %d to prevent indels, since --no-indels was specified (you can also adjust this penalty directly)' % args.no_indel_gap_open_penalty
@@ -220,12 +222,12 @@ def process(args):
             print '%s --batch-options contains \'-e\' or \'-o\', but we add these automatically since we need to be able to parse each job\'s stdout and stderr. You can control the directory under which they\'re written with --workdir (which is currently %s).' % (utils.color('red', 'warning'), args.workdir)
 
     if args.outfname is not None and not args.presto_output and not args.airr_output:
-        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml']:
+        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml', '.npz']:
             raise Exception('unhandled --outfname suffix %s' % utils.getsuffix(args.outfname))
-        if utils.getsuffix(args.outfname) != '.yaml':
+        if utils.getsuffix(args.outfname) == '.csv':
             print '  %s --outfname uses deprecated file format %s. This will still mostly work ok, but the new default .yaml format doesn\'t have to do all the string conversions by hand (so is less buggy), and includes annotations, partitions, and germline info in the same file (so you don\'t get crashes or inconsistent results if you don\'t keep track of what germline info goes with what output file).' % (utils.color('yellow', 'note:'), utils.getsuffix(args.outfname))
-        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) == '.yaml':
-            raise Exception('have to use \'view-output\' action to view .yaml output files')
+        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) in ['.yaml', '.npz']:
+            raise Exception('have to use \'view-output\' action to view %s output files' % utils.getsuffix(args.outfname))
 
     if args.presto_output:
         if args.outfname is None:
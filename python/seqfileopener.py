@@ -67,7 +67,7 @@ def add_input_metafo(input_info, annotation_list, debug=False):  # transfer inpu
         print '  transferred input meta info (%s) for %d sequences from input_info' % (', '.join('\'%s\'' % k for k in added_keys), len(added_uids))
 
 # ----------------------------------------------------------------------------------------
-def post_process(input_info, reco_info, args, infname, found_seed, is_data, iline):
+def post_process(input_info, reco_info, args, infname, found_seed, is_data, iline, n_random_removed=None):  # <n_random_removed>: if set, --n-random-queries was already applied when reading the file (using the file index), and this is how many queries it skipped
     if args is None:
         return
 
@@ -104,7 +104,9 @@ def post_process(input_info, reco_info, args, infname, found_seed, is_data, ilin
         args.seed_unique_id = random.choice(input_info.keys())
         print '    chose random seed unique id %s' % args.seed_unique_id
 
-    if args.n_random_queries is not None:
+    if args.n_random_queries is not None and n_random_removed is not None:
+        print '  --n-random-queries: keeping %d / %d sequences from input file (removed %d)' % (len(input_info), len(input_info) + n_random_removed, n_random_removed)
+    elif args.n_random_queries is not None:
         included_queries = set()  # only for dbg printing
         uids_to_choose_from = input_info.keys()
         if args.seed_unique_id is not None:
@@ -129,6 +131,38 @@ def post_process(input_info, reco_info, args, infname, found_seed, is_data, ilin
             print '  --n-random-queries: keeping %d / %d sequences from input file (removed %d%s)' % (len(input_info), len(input_info) + len(uids_to_remove), len(uids_to_remove),
                                                                                                       (' and specifically kept %s' % ' '.join(included_queries)) if len(included_queries) > 0 else '')
 
+# ----------------------------------------------------------------------------------------
+def choose_indexed_records(infname, args, n_max_queries, more_input_info):
+    """
+    If the input file args only need a subset of the records in fasta/fastq file <infname> (--istartstop, --queries, --n-random-queries), and we can figure out which ones without parsing
+    the whole file, use the file's sidecar index (see utils.read_fastx_index()) to choose them. Returns (index, record indices to read, number of --n-random-queries records skipped),
+    or None if we need to read the whole file (e.g. if other args, like --abbreviate or --name-column, mean we can't know the uids ahead of time).
+    """
+    if args is None or all(a is None for a in [args.istartstop, args.queries, args.n_random_queries]):
+        return None
+    if n_max_queries > 0 or args.abbreviate or args.name_column is not None or args.reco_ids is not None or utils.is_gzipped(infname):
+        return None
+    if args.queries is not None and (args.istartstop is not None or args.n_random_queries is not None):  # the old-style interactions of these are weird enough that it's not worth reproducing them
+        return None
+    if args.n_random_queries is not None and (more_input_info is not None or any(a is not None for a in [args.seed_unique_id, args.seed_seq, args.queries_to_include]) or args.random_seed_seq):  # these all change the set of uids that post_process() chooses from
+        return None
+
+    findex = utils.read_fastx_index(infname, debug=True)
+    if findex['n-duplicates'] > 0 and (args.queries is not None or args.n_random_queries is not None):  # duplicate uids get renamed in the order we read them, so we'd get different names
+        return None
+    n_records = len(findex['uids'])
+    n_random_removed = None
+    if args.queries is not None:
+        irecords = utils.lookup_fastx_index(findex, args.queries)
+    else:
+        istart, istop = (0, n_records) if args.istartstop is None else (min(args.istartstop[0], n_records), min(args.istartstop[1], n_records))
+        irecords = numpy.arange(istart, istop)
+        if args.n_random_queries is not None and args.n_random_queries < len(irecords):  # make the same choice as post_process() (numpy.random.choice() on a list is the same as choosing indices)
+            iremove = numpy.random.choice(len(irecords), len(irecords) - args.n_random_queries, replace=False)
+            irecords = numpy.delete(irecords, iremove)
+            n_random_removed = len(iremove)
+    return findex, irecords, n_random_removed
+
 # ----------------------------------------------------------------------------------------
 def get_seqfile_info(x, is_data=False):
     raise Exception('renamed and changed returned vals (see below)')
@@ -137,14 +171,25 @@ def get_seqfile_info(x, is_data=False):
 def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=None, quiet=False, more_input_info=None):
     # NOTE renamed this from get_seqfile_info() since I'm changing the return values, but I don't want to update the calls everywhere (e.g. in compareutils)
     yaml_glfo = None
+    indexfo, n_random_removed = None, None
     suffix = utils.getsuffix(infname)
+    if suffix == '.gz':  # gzipped (or bgzipped) fasta/fastq, which read_fastx() decompresses on the fly
+        suffix = utils.getsuffix(infname[ : -len(suffix)])
+        if suffix not in ['.fa', '.fasta', '.fq', '.fastq', '.fastx']:
+            raise Exception('only fasta/fastq input files can be gzipped, but got %s' % infname)
     if suffix in delimit_info:
         seqfile = open(infname)  # closes on function exit. no, this isn't the best way to do this
         reader = csv.DictReader(seqfile, delimiter=delimit_info[suffix])
     elif suffix in ['.fa', '.fasta', '.fq', '.fastq', '.fastx']:
         add_info = args is not None and args.name_column is not None and 'fasta-info-index' in args.name_column
-        reader = utils.read_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=add_info, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
-                                  queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating
+        indexfo = choose_indexed_records(infname, args, n_max_queries, more_input_info)
+        if indexfo is not None:  # only read the records we need (the index already applied --istartstop and --queries, and maybe also --n-random-queries)
+            findex, irecords, n_random_removed = indexfo
+            print '  reading %d / %d records from %s using index %s' % (len(irecords), len(findex['uids']), infname, utils.get_fastx_index_fname(infname))
+            reader = utils.iter_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=add_info, sanitize=True, irecords=irecords, offsets=findex['offsets'])
+        else:
+            reader = utils.iter_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=add_info, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
+                                      queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating
     elif suffix == '.yaml':
         yaml_glfo, reader, _ = utils.read_yaml_output(infname, n_max_queries=n_max_queries, synth_single_seqs=True, dont_add_implicit_info=True)  # not really sure that long term I want to synthesize single seq lines, but for backwards compatibility it's nice a.t.m.
         if not is_data:
@@ -166,7 +211,7 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
     for line in reader:
         iline += 1
         if args is not None:
-            if args.istartstop is not None:
+            if args.istartstop is not None and indexfo is None:
                 if iline < args.istartstop[0]:
                     continue
                 if iline >= args.istartstop[1]:
@@ -267,7 +312,9 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         input_info.update(more_input_info)
     if args is not None and args.input_metafname is not None:
         read_input_metafo(args.input_metafname, input_info.values(), debug=True)
-    post_process(input_info, reco_info, args, infname, found_seed, is_data, iline)
+    if indexfo is not None:  # post_process() uses this to check --istartstop against the number of records in the file
+        iline = len(findex['uids']) - 1
+    post_process(input_info, reco_info, args, infname, found_seed, is_data, iline, n_random_removed=n_random_removed)
 
     if len(input_info) == 0:
         raise Exception('didn\'t read any sequences from %s' % infname)
@@ -21,6 +21,8 @@ import json
 import pickle
 import warnings
 import traceback
+import multiprocessing
+import shutil
 if StrictVersion(dendropy.__version__) < StrictVersion('4.0.0'):  # not sure on the exact version I need, but 3.12.0 is missing lots of vital tree fcns
     raise RuntimeError("dendropy version 4.0.0 or later is required (found version %s)." % dendropy.__version__)
 
@@ -34,6 +36,8 @@ default_min_selection_metric_cluster_size = 10
 
 dummy_str = 'x-dummy-x'
 
+pool_info = None  # info for calculate_tree_metrics() pool processes, which they inherit when they're forked (so we don't have to pickle the annotations/cpath/dtr models for every cluster)
+
 # ----------------------------------------------------------------------------------------
 def add_cons_seqs(line, aa=False):
     ckey = 'consensus_seq'
@@ -272,7 +276,7 @@ def get_dendro_tree(treestr=None, treefname=None, taxon_namespace=None, schema='
         if taxon_namespace is not None:
             print '     and taxon namespace:  %s' % ' '.join([t.label for t in taxon_namespace])
     # dendropy doesn't make taxons for internal nodes by default, so it puts the label for internal nodes in node.label instead of node.taxon.label, but it crashes if it gets duplicate labels, so you can't just always turn off internal node taxon suppression
-    dtree = dendropy.Tree.get_from_string(treestr, schema, taxon_namespace=taxon_namespace, suppress_internal_node_taxa=(ignore_existing_internal_node_labels or suppress_internal_node_taxa), preserve_underscores=True, rooting='force-rooted')  # make sure the tree is rooted, to avoid nodes disappearing in remove_dummy_branches() (and proably other places as well)
+    dtree = dendropy.Tree.get_from_string(treestr, schema, taxon_namespace=taxon_namespace, suppress_internal_node_taxa=(ignore_existing_internal_node_labels or suppress_internal_node_taxa), preserve_underscores=True, rooting='force-rooted')  # make sure the tree is rooted, to avoid nodes disappearing when rerooting (and proably other places as well)
     label_nodes(dtree, ignore_existing_internal_node_labels=ignore_existing_internal_node_labels, suppress_internal_node_taxa=suppress_internal_node_taxa, debug=debug)  # set internal node labels to any found in <treestr> (unless <ignore_existing_internal_node_labels> is set), otherwise make some up (e.g. aa, ab, ac)
 
     # # uncomment for more verbosity:
@@ -576,13 +580,17 @@ def collapse_zero_length_leaves(dtree, sequence_uids, debug=False):  # <sequence
         # print get_ascii_tree(dendro_tree=dtree, extra_str='      ', width=350)
         # print dtree.as_string(schema='newick').strip()
 
+# ----------------------------------------------------------------------------------------
+def check_fasttree_uids(uid_list):
+    if len(set(uid_list)) < len(uid_list):
+        raise Exception('duplicate uid(s) in seqfos for FastTree, which\'ll make it crash: %s' % ' '.join(u for u in uid_list if uid_list.count(u) > 1))
+
 # ----------------------------------------------------------------------------------------
 def get_fasttree_tree(seqfos, naive_seq=None, naive_seq_name='XnaiveX', taxon_namespace=None, suppress_internal_node_taxa=False, debug=False):
     if debug:
         print '    running FastTree on %d sequences plus a naive' % len(seqfos)
     uid_list = [sfo['name'] for sfo in seqfos]
-    if any(uid_list.count(u) > 1 for u in uid_list):
-        raise Exception('duplicate uid(s) in seqfos for FastTree, which\'ll make it crash: %s' % ' '.join(u for u in uid_list if uid_list.count(u) > 1))
+    check_fasttree_uids(uid_list)
     with tempfile.NamedTemporaryFile() as tmpfile:
         if naive_seq is not None:
             tmpfile.write('>%s\n%s\n' % (naive_seq_name, naive_seq))
@@ -591,6 +599,59 @@ def get_fasttree_tree(seqfos, naive_seq=None, naive_seq_name='XnaiveX', taxon_na
         tmpfile.flush()  # BEWARE if you forget this you are fucked
         with open(os.devnull, 'w') as fnull:
             treestr = subprocess.check_output('./bin/FastTree -gtr -nt ' + tmpfile.name, shell=True, stderr=fnull)
+    return parse_fasttree_tree(treestr, uid_list, naive_seq_name=naive_seq_name, taxon_namespace=taxon_namespace, suppress_internal_node_taxa=suppress_internal_node_taxa, debug=debug)
+
+# ----------------------------------------------------------------------------------------
+def get_fasttree_treestrs(seqfo_lists, naive_seqs=None, naive_seq_name='XnaiveX', n_procs=1, workdir=None, debug=False):
+    """
+    Run FastTree on each list of seqfos in <seqfo_lists> (plus the corresponding naive sequence in <naive_seqs>, if set), returning a list of newick strings in the same order (convert each with parse_fasttree_tree() when you need it).
+    Instead of one FastTree process for each list, we split the lists into (at most) <n_procs> batches with about the same number of sequences, write each batch to one file of phylip
+    alignments, and run all the batches at once with FastTree's -n option (which reads many alignments from one file, and writes one tree per line).
+    """
+    if naive_seqs is None:
+        naive_seqs = [None for _ in seqfo_lists]
+    if len(seqfo_lists) == 0:
+        return []
+    batches, batch_sizes = [[] for _ in range(min(n_procs, len(seqfo_lists)))], [0 for _ in range(min(n_procs, len(seqfo_lists)))]
+    for ialign in sorted(range(len(seqfo_lists)), key=lambda i: len(seqfo_lists[i]), reverse=True):  # add the biggest ones first, each to whichever batch is currently smallest
+        ibatch = batch_sizes.index(min(batch_sizes))
+        batches[ibatch].append(ialign)
+        batch_sizes[ibatch] += len(seqfo_lists[ialign])
+    if debug:
+        print '    running FastTree on %d alignments in %d batch%s with sizes %s' % (len(seqfo_lists), len(batches), utils.plural(len(batches), prefix='e'), ' '.join(str(s) for s in batch_sizes))
+
+    batchdir = tempfile.mkdtemp(dir=workdir)
+    cmdfos = []
+    for ibatch, ialigns in enumerate(batches):
+        phyfname = '%s/batch-%d.phy' % (batchdir, ibatch)
+        with open(phyfname, 'w') as phyfile:
+            for ialign in ialigns:
+                seqfos = ([{'name' : naive_seq_name, 'seq' : naive_seqs[ialign]}] if naive_seqs[ialign] is not None else []) + seqfo_lists[ialign]
+                check_fasttree_uids([sfo['name'] for sfo in seqfos])
+                if len(set(len(sfo['seq']) for sfo in seqfos)) > 1:
+                    raise Exception('sequences for FastTree have different lengths: %s' % ' '.join(str(len(sfo['seq'])) for sfo in seqfos))
+                phyfile.write(' %d %d\n' % (len(seqfos), len(seqfos[0]['seq'])))  # relaxed phylip, i.e. name and sequence separated by whitespace (rather than fixed-width names)
+                for sfo in seqfos:
+                    phyfile.write('%s %s\n' % (sfo['name'], sfo['seq']))
+        cmdfos.append({'cmd_str' : './bin/FastTree -gtr -nt -quiet -nosupport -n %d -out %s/batch-%d.nwk %s' % (len(ialigns), batchdir, ibatch, phyfname),
+                       'outfname' : '%s/batch-%d.nwk' % (batchdir, ibatch),
+                       'workdir' : batchdir,
+                       'logdir' : '%s/log-%d' % (batchdir, ibatch)})
+    utils.run_cmds(cmdfos, ignore_stderr=True)  # there's at most <n_procs> batches, so we can start them all at once
+
+    treestrs = [None for _ in seqfo_lists]
+    for ialigns, cmdfo in zip(batches, cmdfos):
+        with open(cmdfo['outfname']) as treefile:
+            batch_treestrs = [l.strip() for l in treefile if l.strip() != '']
+        if len(batch_treestrs) != len(ialigns):
+            raise Exception('expected %d trees from FastTree but got %d in %s' % (len(ialigns), len(batch_treestrs), cmdfo['outfname']))
+        for ialign, treestr in zip(ialigns, batch_treestrs):
+            treestrs[ialign] = treestr
+    shutil.rmtree(batchdir)
+    return treestrs
+
+# ----------------------------------------------------------------------------------------
+def parse_fasttree_tree(treestr, uid_list, naive_seq_name='XnaiveX', taxon_namespace=None, suppress_internal_node_taxa=False, debug=False):  # convert FastTree output <treestr> to a dendro tree, rerooted at the naive sequence
     if debug:
         print '      converting FastTree newick string to dendro tree'
     dtree = get_dendro_tree(treestr=treestr, taxon_namespace=taxon_namespace, ignore_existing_internal_node_labels=not suppress_internal_node_taxa, suppress_internal_node_taxa=suppress_internal_node_taxa, debug=debug)
@@ -604,90 +665,66 @@ def get_fasttree_tree(seqfos, naive_seq=None, naive_seq_name='XnaiveX', taxon_na
     return dtree
 
 # ----------------------------------------------------------------------------------------
-# copied from https://github.com/nextstrain/augur/blob/master/base/scores.py
-# also see explanation here https://photos.app.goo.gl/gtjQziD8BLATQivR6
-def set_lb_values(dtree, tau, only_calc_metric=None, dont_normalize=False, multifo=None, debug=False):
+def get_tree_arrays(dtree):
     """
-    traverses <dtree> in postorder and preorder to calculate the up and downstream tree length exponentially weighted by distance, then adds them as LBI (and divides as LBR)
+    Return a flat array representation of <dtree>, with the nodes in preorder (so each node comes after its parent, and the root, at index 0, has parent -1):
+      - labels: list of node labels
+      - parents: index of each node's parent
+      - lengths: branch length to each node's parent (None is zero, as in dendropy's distance_from_root())
+      - depths: number of edges between each node and root
+      - root-distances: distance from root (including the root's own edge length, if it has one, also as in distance_from_root())
+      - is-leaf: boolean array
     """
-    def getmulti(node):  # number of reads with the same sequence
-        return multifo.get(node.taxon.label, 1) if multifo is not None else 1  # most all of them should be in there, but for instance I'm not adding the dummy branch nodes
-
-    metrics_to_calc = lb_metrics.keys() if only_calc_metric is None else [only_calc_metric]
-    if debug:
-        print '    setting %s values with tau %.4f' % (' and '.join(metrics_to_calc), tau)
-
-    initial_labels = set([n.taxon.label for n in dtree.preorder_node_iter()])
-    dtree = get_tree_with_dummy_branches(dtree, tau)  # this returns a new dtree, but the old tree is a subtree of the new one (or at least its collection of nodes are), and these nodes get modified by the process (hence the reversal fcn below)
-
-    # calculate clock length (i.e. for each node, the distance to that node's parent)
-    for node in dtree.postorder_node_iter():  # postorder vs preorder doesn't matter, but I have to choose one
-        if node.parent_node is None:  # root node
-            node.clock_length = 0.
-        for child in node.child_node_iter():
-            child.clock_length = child.distance_from_root() - node.distance_from_root()
+    nodes = list(dtree.preorder_node_iter())
+    inodes = {id(n) : i for i, n in enumerate(nodes)}
+    parents = [-1 if n.parent_node is None else inodes[id(n.parent_node)] for n in nodes]
+    lengths = [0. if n.edge.length is None else float(n.edge.length) for n in nodes]
+    depths, root_distances = [0 for _ in nodes], list(lengths)
+    for inode in range(1, len(nodes)):  # parents come before their children, so we only need one pass
+        depths[inode] = depths[parents[inode]] + 1
+        root_distances[inode] += root_distances[parents[inode]]
+    parents = numpy.array(parents, dtype=numpy.int64)
+    return {'labels' : [n.taxon.label for n in nodes], 'parents' : parents, 'lengths' : numpy.array(lengths), 'depths' : numpy.array(depths, dtype=numpy.int64),
+            'root-distances' : numpy.array(root_distances), 'is-leaf' : numpy.bincount(parents[1:], minlength=len(nodes)) == 0}
 
-    # lbi is the sum of <node.down_polarizer> (downward message from <node>'s parent) and its children's up_polarizers (upward messages)
-
-    # traverse the tree in postorder (children first) to calculate message to parents (i.e. node.up_polarizer)
-    for node in dtree.postorder_node_iter():
-        node.down_polarizer = 0  # used for <node>'s lbi (this probabably shouldn't be initialized here, since it gets reset in the next loop [at least I think they all do])
-        node.up_polarizer = 0  # used for <node>'s parent's lbi (but not <node>'s lbi)
-        for child in node.child_node_iter():
-            node.up_polarizer += child.up_polarizer
-        bl = node.clock_length / tau
-        node.up_polarizer *= numpy.exp(-bl)  # sum of child <up_polarizer>s weighted by an exponential decayed by the distance to <node>'s parent
-        node.up_polarizer += getmulti(node) * tau * (1 - numpy.exp(-bl))  # add the actual contribution (to <node>'s parent's lbi) of <node>: zero if the two are very close, increasing toward asymptote of <tau> for distances near 1/tau (integral from 0 to l of decaying exponential)
-
-    # traverse the tree in preorder (parents first) to calculate message to children (i.e. child1.down_polarizer)
-    for node in dtree.preorder_internal_node_iter():
-        for child1 in node.child_node_iter():  # calculate down_polarizer for each of <node>'s children
-            child1.down_polarizer = node.down_polarizer  # first sum <node>'s down_polarizer...
-            for child2 in node.child_node_iter():  # and the *up* polarizers of any other children of <node>
-                if child1 != child2:
-                    child1.down_polarizer += child2.up_polarizer  # add the contribution of <child2> to its parent's (<node>'s) lbi (i.e. <child2>'s contribution to the lbi of its *siblings*)
-            bl = child1.clock_length / tau
-            child1.down_polarizer *= numpy.exp(-bl)  # and decay the previous sum by distance between <child1> and its parent (<node>)
-            child1.down_polarizer += getmulti(child1) * tau * (1 - numpy.exp(-bl))  # add contribution of <child1> to its own lbi: zero if it's very close to <node>, increasing to max of <tau> (integral from 0 to l of decaying exponential)
-
-    returnfo = {m : {} for m in metrics_to_calc}
-    # go over all nodes and calculate lb metrics (can be done in any order)
-    for node in dtree.postorder_node_iter():
-        vals = {'lbi' : node.down_polarizer, 'lbr' : 0.}
-        for child in node.child_node_iter():
-            vals['lbi'] += child.up_polarizer
-            vals['lbr'] += child.up_polarizer
-        if node.down_polarizer > 0.:
-            vals['lbr'] /= node.down_polarizer  # it might make more sense to not include the branch between <node> and its parent in either the numerator or denominator (here it's included in the denominator), but this way I don't have to change any of the calculations above
-
-        if dummy_str in node.taxon.label:
-            continue
-        if node is dtree.seed_node or node.parent_node is dtree.seed_node:  # second clause is only because of dummy root addition (well, and if we are adding dummy root the first clause doesn't do anything)
-            vals['lbr'] = 0.
-        for metric in metrics_to_calc:
-            returnfo[metric][node.taxon.label] = float(vals[metric]) if dont_normalize else normalize_lb_val(metric, float(vals[metric]), tau)
-
-    if debug:
-        max_width = str(max([len(n.taxon.label) for n in dtree.postorder_node_iter()]))
-        print ('   %'+max_width+'s %s%s      multi') % ('node', ''.join('     %s' % m for m in metrics_to_calc), 16*' ' if 'lbr' in metrics_to_calc else '')
-        for node in dtree.preorder_node_iter():
-            if dummy_str in node.taxon.label:
-                continue
-            multi_str = str(getmulti(node)) if multifo is not None else ''
-            lbstrs = ['%8.3f' % returnfo[m][node.taxon.label] for m in metrics_to_calc]
-            if 'lbr' in metrics_to_calc:
-                lbstrs += [' = %-5.3f / %-5.3f' % (returnfo['lbr'][node.taxon.label] * node.down_polarizer, node.down_polarizer)]
-            print ('    %' + max_width + 's  %s    %3s') % (node.taxon.label, ''.join(lbstrs), multi_str)
-
-    # this is maybe time consuming, but I want to leave the tree that was passed in as unmodified as I can (especially since a.t.m. I'm running this fcn twice for lbi/lbr)
-    for node in dtree.postorder_node_iter():
-        delattr(node, 'clock_length')
-        delattr(node, 'up_polarizer')
-        delattr(node, 'down_polarizer')
-
-    remove_dummy_branches(dtree, initial_labels)
-
-    return returnfo
+# ----------------------------------------------------------------------------------------
+def calculate_lb_arrays(treearrays, taus, multis=None, n_tau_lengths=10):
+    """
+    Calculate lbi and lbr for all the nodes in <treearrays> (from get_tree_arrays()) with each tau in <taus> in a single pass, returning two arrays (lbi and lbr) of shape (n_nodes, n_taus).
+    Each level of the tree (i.e. all nodes at the same depth) is one vectorized step, first from the leaves up to get the upward messages, and then from the root down to get the downward messages.
+    The root gets a branch of length <n_tau_lengths> * tau above it, since otherwise we'd be assuming that (e.g.) the root node's fitness is zero.
+    <multis>: multiplicity of each node (number of reads with the same sequence), or None for all ones
+    """
+    parents, depths = treearrays['parents'], treearrays['depths']
+    n_nodes = len(parents)
+    taus = numpy.array(taus, dtype=float)
+    decays = numpy.exp(-treearrays['lengths'][:, None] / taus[None, :])  # exponential decay over each node's branch to its parent
+    decays[0, :] = numpy.exp(-n_tau_lengths)  # dummy branch above root
+    contributions = (numpy.ones(n_nodes) if multis is None else numpy.array(multis, dtype=float))[:, None] * taus[None, :] * (1 - decays)  # contribution of each node's branch to its parent's lbi (and vice versa): zero for zero length, increasing to an asymptote of tau (integral from 0 to length of decaying exponential)
+
+    order = numpy.argsort(depths, kind='mergesort')
+    level_bounds = numpy.searchsorted(depths[order], numpy.arange(depths.max() + 2))
+    levels = [order[level_bounds[i] : level_bounds[i + 1]] for i in range(len(level_bounds) - 1)]
+
+    up_messages = numpy.zeros((n_nodes, len(taus)))  # message from each node to its parent (i.e. contribution to its parent's lbi)
+    child_sums = numpy.zeros((n_nodes, len(taus)))  # sum of each node's children's up messages
+    for ilevel in range(len(levels) - 1, -1, -1):  # leaves first
+        inodes = levels[ilevel]
+        up_messages[inodes] = decays[inodes] * child_sums[inodes] + contributions[inodes]
+        if ilevel > 0:
+            numpy.add.at(child_sums, parents[inodes], up_messages[inodes])
+
+    down_messages = numpy.zeros((n_nodes, len(taus)))  # message from each node's parent to the node (i.e. contribution of everything that isn't below the node to its lbi)
+    down_messages[0] = contributions[0]  # the (dummy) root above the real root has nothing else attached to it
+    for inodes in levels[1 : ]:  # root first
+        iparents = parents[inodes]
+        down_messages[inodes] = decays[inodes] * (down_messages[iparents] + child_sums[iparents] - up_messages[inodes]) + contributions[inodes]  # parent's down message plus the up messages of the node's siblings
+
+    lbi = down_messages + child_sums
+    lbr = child_sums.copy()
+    numpy.divide(child_sums, down_messages, out=lbr, where=down_messages > 0)  # it might make more sense to not include the branch between the node and its parent in either the numerator or denominator (here it's included in the denominator), but this way it's the same as lbi
+    lbr[0] = 0.  # root has no parent branch (apart from the dummy one)
+    return lbi, lbr
 
 # ----------------------------------------------------------------------------------------
 def set_multiplicities(dtree, annotation, input_metafo, debug=False):
@@ -714,81 +751,6 @@ def set_multiplicities(dtree, annotation, input_metafo, debug=False):
         multifo[node.taxon.label] = get_multi(node.taxon.label)
     return multifo
 
-# ----------------------------------------------------------------------------------------
-def get_tree_with_dummy_branches(old_dtree, tau, n_tau_lengths=10, add_dummy_leaves=False, debug=False): # add long branches above root and/or below each leaf, since otherwise we're assuming that (e.g.) leaf node fitness is zero
-    # commenting this since I'm pretty sure I've fixed it, but not removing it since if a similar problem surfaces with dummy branch addition, deep copying is an easy way out
-    # zero_length_edges = [e for e in old_dtree.preorder_edge_iter() if e.length == 0 and not e.head_node.is_leaf()]
-    # if len(zero_length_edges) > 0:  # rerooting to remove dummy branches screws up the tree in some cases with zero length branches (see comment in that fcn)
-    #     old_dtree = copy.deepcopy(old_dtree)  # could maybe do this by default, but it'll probably be really slow on large trees (at least iterating through the trees is; although I suppose maybe deepcopy is smater than that)
-    #     print '    %s found %d zero length branches in tree, so deep copying before adding dummy branches (this is probably ok ish, but in general it\'s a bad idea to have zero length branches in your trees): %s' % (utils.color('yellow', 'warning'), len(zero_length_edges), ' '.join([e.head_node.taxon.label for e in zero_length_edges]))
-
-    dummy_edge_length = n_tau_lengths * tau
-
-    new_root_taxon = dendropy.Taxon(dummy_str + '-root')
-    old_dtree.taxon_namespace.add_taxon(new_root_taxon)
-    new_root_node = dendropy.Node(taxon=new_root_taxon)
-    new_dtree = dendropy.Tree(seed_node=new_root_node, taxon_namespace=old_dtree.taxon_namespace, is_rooted=True)
-
-    # then add the entire old tree under this new tree
-    new_root_node.add_child(old_dtree.seed_node)
-    for edge in new_root_node.child_edge_iter():
-        edge.length = dummy_edge_length
-
-    if add_dummy_leaves:  # add dummy child branches to each leaf
-        for lnode in new_dtree.leaf_node_iter():
-            new_label = '%s-%s' % (dummy_str, lnode.taxon.label)
-            tns.add_taxon(dendropy.Taxon(new_label))
-            new_child_node = lnode.new_child(taxon=tns.get_taxon(new_label), edge_length=dummy_edge_length)
-
-    # TODO commenting this because it gets triggered way too much, but I'm not actually sure that I can really just ignore the problem (but maybe I can)
-    # zero_len_edge_nodes = [e.head_node for n in new_dtree.preorder_node_iter() for e in n.child_edge_iter() if e.length == 0 and not e.head_node.is_leaf()]  # zero len edges above leaves are fine, since leaves don't count for lbr
-    # if len(zero_len_edge_nodes) > 0:
-    #     print '    %s found %d zero length internal edges in tree, which means lb ratio may mis-categorize branches: %s' % (utils.color('red', 'warning'), len(zero_len_edge_nodes), ' '.join([n.taxon.label for n in zero_len_edge_nodes]))
-    #     # for node in zero_len_edge_nodes:  # we don't really want to modify the tree this drastically here (and a.t.m. this causes a crash later on), but I'm leaving it as a placeholder for how to remove zero length edges
-    #     #     collapse_nodes(new_dtree, node.taxon.label, node.parent_node.taxon.label)  # keep the child, since it can be a leaf
-    #     # print utils.pad_lines(get_ascii_tree(dendro_tree=new_dtree))
-
-    new_dtree.update_bipartitions(suppress_unifurcations=False)  # not sure if I need this? (suppress_unifurcations is because otherwise it removes the branch between the old and new root nodes)
-
-    if debug:
-        print '    added dummy branches to tree:'
-        print get_ascii_tree(dendro_tree=new_dtree, extra_str='      ', width=350)
-
-    return new_dtree
-
-# ----------------------------------------------------------------------------------------
-def remove_dummy_branches(dtree, initial_labels, add_dummy_leaves=False, debug=False):
-    if add_dummy_leaves:
-        raise Exception('not implemented (shouldn\'t be too hard, but a.t.m. I don\'t think I\'ll need it)')
-
-    if len(dtree.seed_node.child_nodes()) != 1:
-        print '  %s root node has more than one child when removing dummy branches: %s' % (utils.color('yellow', 'warning'), ' '.join([n.taxon.label for n in dtree.seed_node.child_nodes()]))
-    new_root_node = dtree.seed_node.child_nodes()[0]
-    if debug:
-        print '  rerooting at %s' % new_root_node.taxon.label
-        print '            current children: %s' % ' '.join([n.taxon.label for n in new_root_node.child_node_iter()])
-    # NOTE if the new root has a child separated by a zero-length edge, this reroot call for some reason deletes that child from the tree (both with and without suppress_unifurcations set). After messing around a bunch to try to fix it, the message I'm taking is just that zero length branches (and unifurcations) are a bad idea and I should just forbid them
-    # UPDATE I think I was just missing the suppress_unifurcations=False in update_bipartitions(), but leaving these comments here in case there was another problem
-    # UPDATE actually the reroot still seems to eat a node sometimes if the tree is unrooted (so adding the extra reroot above)
-    # UPDATE this is more or less expectd, from dendropy's perspective; see https://github.com/jeetsukumaran/DendroPy/issues/118
-    assert dtree.is_rooted  # make sure it's rooted, to avoid unifurcations getting suppressed (even with the arg set to false)
-    dtree.reroot_at_node(new_root_node, suppress_unifurcations=False)  # reroot at old root node
-    if debug:
-        print '       children after reroot: %s' % ' '.join([n.taxon.label for n in new_root_node.child_node_iter()])
-    dtree.prune_taxa_with_labels([dummy_str + '-root'], suppress_unifurcations=False)
-    dtree.purge_taxon_namespace()  # I'm sure there's a good reason the previous line doesn't do this
-    dtree.update_bipartitions(suppress_unifurcations=False)
-    if debug:
-        print '        children after purge: %s' % ' '.join([n.taxon.label for n in new_root_node.child_node_iter()])
-
-    final_labels = set([n.taxon.label for n in dtree.preorder_node_iter()])
-    if initial_labels != final_labels:  # this was only happening with a zero-length node hanging off root (see above), which probably won't happen any more since I'm now removing zero length (non-leaf) branches in bcr-phylo simulator.py
-        print '    %s nodes after dummy branch addition and removal not the same as before:' % utils.color('red', 'error')
-        print '       missing: %s' % ' '.join(initial_labels - final_labels)
-        print '       extra:   %s' % ' '.join(final_labels - initial_labels)
-        print '       tree:'
-        print utils.pad_lines(get_ascii_tree(dendro_tree=dtree, width=400))
-
 # ----------------------------------------------------------------------------------------
 # check whether 1) node depth and 2) node pairwise distances are super different when calculated with tree vs sequences (not really sure why it's so different sometimes, best guess is fasttree sucks, partly because it doesn't put the root node anywhere near the root of the tree)
 def compare_tree_distance_to_shm(dtree, annotation, max_frac_diff=0.5, min_warn_frac=0.25, extra_str=None, debug=False):
@@ -842,7 +804,7 @@ def compare_tree_distance_to_shm(dtree, annotation, max_frac_diff=0.5, min_warn_
 def calculate_lb_values(dtree, tau, lbr_tau_factor=None, only_calc_metric=None, dont_normalize=False, annotation=None, input_metafo=None, use_multiplicities=False, extra_str=None, iclust=None, debug=False):
     # if <only_calc_metric> is None, we use <tau> and <lbr_tau_factor> to calculate both lbi and lbr (i.e. with different tau)
     #   - whereas if <only_calc_metric> is set, we use <tau> to calculate only the given metric
-    # note that it's a little weird to do all this tree manipulation here, but then do the dummy branch tree manipulation in set_lb_values(), but the dummy branch stuff depends on tau so it's better this way
+    # note that we don't modify <dtree> (apart from maybe rescaling it), since calculate_lb_arrays() handles the dummy branch above root without adding it to the tree
     # <iclust> is just to give a little more granularity in dbg
 
     if use_multiplicities:
@@ -852,11 +814,15 @@ def calculate_lb_values(dtree, tau, lbr_tau_factor=None, only_calc_metric=None,
     # if annotation is not None:  # check that the observed shm rate and tree depth are similar (we're still worried that they're different if we don't have the annotation, but we have no way to check it)
     #     compare_tree_distance_to_shm(dtree, annotation, extra_str=extra_str)
 
-    if max(get_leaf_depths(dtree).values()) > 1:  # should only happen on old simulation files
+    treearrays = get_tree_arrays(dtree)
+    if max(treearrays['root-distances'][treearrays['is-leaf']]) > 1:  # should only happen on old simulation files
         if annotation is None:
             raise Exception('tree needs rescaling in lb calculation (metrics will be wrong): found leaf depth greater than 1 (even when less than 1 they can be wrong, but we can be fairly certain that your BCR sequences don\'t have real mutation frequencty greater than 1, so this case we can actually check). If you pass in annotations we can rescale to the observed mutation frequencty.')
         print '  %s leaf depths greater than 1, so rescaling by sequence length' % utils.color('yellow', 'warning')
-        dtree.scale_edges(1. / numpy.mean([len(s) for s in annotation['seqs']]))  # using treeutils.rescale_tree() breaks, it seems because the update_bipartitions() call removes nodes near root on unrooted trees
+        scale_factor = 1. / numpy.mean([len(s) for s in annotation['seqs']])
+        dtree.scale_edges(scale_factor)  # using treeutils.rescale_tree() breaks, it seems because the update_bipartitions() call removes nodes near root on unrooted trees
+        treearrays['lengths'] *= scale_factor
+        treearrays['root-distances'] *= scale_factor
 
     if debug:
         print '   calculating %s%s with tree:' % (' and '.join(lb_metrics if only_calc_metric is None else [only_calc_metric]), '' if extra_str is None else ' for %s' % extra_str)
@@ -866,19 +832,31 @@ def calculate_lb_values(dtree, tau, lbr_tau_factor=None, only_calc_metric=None,
     if use_multiplicities:
         multifo = set_multiplicities(dtree, annotation, input_metafo, debug=debug)
 
-    treestr = dtree.as_string(schema='newick')  # get this before the dummy branch stuff to make more sure it isn't modified
+    treestr = dtree.as_string(schema='newick')
     normstr = 'unnormalized' if dont_normalize else 'normalized'
     if only_calc_metric is None:
         assert lbr_tau_factor is not None  # has to be set if we're calculating both metrics
         if iclust is None or iclust == 0:
             print '    calculating %s lb metrics%s with tau values %.4f (lbi) and %.4f * %d = %.4f (lbr)' % (normstr, '' if extra_str is None else ' for %s' % extra_str, tau, tau, lbr_tau_factor, tau*lbr_tau_factor)
-        lbvals = set_lb_values(dtree, tau, only_calc_metric='lbi', dont_normalize=dont_normalize, multifo=multifo, debug=debug)
-        tmpvals = set_lb_values(dtree, tau*lbr_tau_factor, only_calc_metric='lbr', dont_normalize=dont_normalize, multifo=multifo, debug=debug)
-        lbvals['lbr'] = tmpvals['lbr']
+        metric_taus = [('lbi', tau), ('lbr', tau*lbr_tau_factor)]
     else:
         if iclust is None or iclust == 0:
             print '    calculating %s %s with tau %.4f' % (normstr, only_calc_metric, tau)
-        lbvals = set_lb_values(dtree, tau, only_calc_metric=only_calc_metric, dont_normalize=dont_normalize, multifo=multifo, debug=debug)
+        metric_taus = [(only_calc_metric, tau)]
+
+    # both metrics (with their different taus) in one pass over the tree arrays
+    multis = None if multifo is None else [multifo.get(l, 1) for l in treearrays['labels']]
+    lbarrays = dict(zip(['lbi', 'lbr'], calculate_lb_arrays(treearrays, [t for _, t in metric_taus], multis=multis)))
+    lbvals = {}
+    for itau, (metric, mtau) in enumerate(metric_taus):
+        lbvals[metric] = {l : v if dont_normalize else normalize_lb_val(metric, v, mtau) for l, v in zip(treearrays['labels'], lbarrays[metric][:, itau].tolist()) if dummy_str not in l}
+    if debug:
+        max_width = str(max(len(l) for l in treearrays['labels']))
+        print ('   %'+max_width+'s %s      multi') % ('node', ''.join('     %s' % m for m, _ in metric_taus))
+        for inode, label in enumerate(treearrays['labels']):
+            if dummy_str in label:
+                continue
+            print ('    %' + max_width + 's  %s    %3s') % (label, ''.join('%8.3f' % lbvals[m][label] for m, _ in metric_taus), '' if multis is None else str(multis[inode]))
     lbvals['tree'] = treestr
 
     return lbvals
@@ -1373,29 +1351,39 @@ def plot_tree_metrics(base_plotdir, inf_lines_to_use, true_lines_to_use, ete_pat
     print '    selection metric plotting time: %.1f sec' % (time.time() - start)
 
 # ----------------------------------------------------------------------------------------
-def get_tree_for_line(line, treefname=None, cpath=None, annotations=None, use_true_clusters=False, debug=False):
-    # figure out how we want to get the inferred tree
+def get_tree_origin(line, treefname=None, cpath=None, use_true_clusters=False):  # figure out how we want to get the inferred tree
     if treefname is not None:
+        return 'treefname'
+    elif False:  # use_liberman_lonr_tree:  # NOTE see issues/notes in bin/lonr.r
+        return 'lonr'
+    elif cpath is not None and cpath.i_best is not None and not use_true_clusters and line['unique_ids'] in cpath.partitions[cpath.i_best]:  # if <use_true_clusters> is set, then the clusters in <inf_lines_to_use> won't correspond to the history in <cpath>, so this won't work NOTE now that I've added the direct check if the unique ids are in the best partition, i can probably remove the use_true_clusters check, but I don't want to mess with it a.t.m.
+        return 'cpath'
+    else:
+        return 'fasttree'
+
+# ----------------------------------------------------------------------------------------
+def get_tree_for_line(line, treefname=None, cpath=None, annotations=None, use_true_clusters=False, fasttree_treestr=None, debug=False):
+    # <fasttree_treestr>: FastTree output that was already made for this line (e.g. with get_fasttree_treestrs()), so we only have to parse it
+    origin = get_tree_origin(line, treefname=treefname, cpath=cpath, use_true_clusters=use_true_clusters)
+    if origin == 'treefname':
         dtree = get_dendro_tree(treefname=treefname, debug=debug)
-        origin = 'treefname'
         if len(set([n.taxon.label for n in dtree.preorder_node_iter()]) & set(line['unique_ids'])) == 0:  # if no nodes in common between line and tree in file (e.g. you passed in the wrong file or didn't set --cluster-indices)
             dtree = None
             origin = 'no-uids'
-    elif False:  # use_liberman_lonr_tree:  # NOTE see issues/notes in bin/lonr.r
+    elif origin == 'lonr':
         lonr_info = calculate_liberman_lonr(line=line, reco_info=reco_info, debug=debug)
         dtree = get_dendro_tree(treestr=lonr_info['tree'])
         # line['tree-info']['lonr'] = lonr_info
-        origin = 'lonr'
-    elif cpath is not None and cpath.i_best is not None and not use_true_clusters and line['unique_ids'] in cpath.partitions[cpath.i_best]:  # if <use_true_clusters> is set, then the clusters in <inf_lines_to_use> won't correspond to the history in <cpath>, so this won't work NOTE now that I've added the direct check if the unique ids are in the best partition, i can probably remove the use_true_clusters check, but I don't want to mess with it a.t.m.
+    elif origin == 'cpath':
         assert annotations is not None
         i_only_cluster = cpath.partitions[cpath.i_best].index(line['unique_ids'])
         cpath.make_trees(annotations=annotations, i_only_cluster=i_only_cluster, get_fasttrees=True, debug=False)
         dtree = cpath.trees[i_only_cluster]  # as we go through the loop, the <cpath> is presumably filling all of these in
-        origin = 'cpath'
+    elif fasttree_treestr is not None:
+        dtree = parse_fasttree_tree(fasttree_treestr, line['unique_ids'], debug=debug)
     else:
         seqfos = [{'name' : uid, 'seq' : seq} for uid, seq in zip(line['unique_ids'], line['seqs'])]
         dtree = get_fasttree_tree(seqfos, naive_seq=line['naive_seq'], debug=debug)
-        origin = 'fasttree'
 
     return {'tree' : dtree, 'origin' : origin}
 
@@ -1446,10 +1434,38 @@ def check_lb_values(line, lbvals):
 #     if n_already_there > 0:
 #         print '    %s overwriting %d / %d that already had trees' % (utils.color('yellow', 'warning'), n_already_there, n_after)
 
+# ----------------------------------------------------------------------------------------
+def calculate_inf_tree_metrics(iclust, line, lb_tau, lbr_tau_factor=None, treefname=None, cpath=None, annotations=None, use_true_clusters=False, dont_normalize_lbi=False, add_aa_consensus_distance=False,
+                               dtr_path=None, pmml_models=None, dtr_cfgvals=None, fasttree_treestr=None, debug=False):  # get tree and calculate selection metrics for inferred cluster <line>, putting them in <line['tree-info']> (returns the tree origin, which is 'no-uids' if there wasn't a tree for it)
+    if debug:
+        print '  %s sequence cluster' % utils.color('green', str(len(line['unique_ids'])))
+    treefo = get_tree_for_line(line, treefname=treefname, cpath=cpath, annotations=annotations, use_true_clusters=use_true_clusters, fasttree_treestr=fasttree_treestr, debug=debug)
+    if treefo['tree'] is None and treefo['origin'] == 'no-uids':
+        return treefo['origin']
+    if 'tree-info' in line:  # NOTE we used to continue here, but now I've decided we really want to overwrite what's there (although I'm a little worried that there was a reason I'm forgetting not to overwrite them)
+        if debug:
+            print '       %s overwriting selection metric info that was already in <line>' % utils.color('yellow', 'warning')
+    line['tree-info'] = {}  # NOTE <treefo> has a dendro tree, but what we put in the <line> (at least for now) is a newick string
+    line['tree-info']['lb'] = calculate_lb_values(treefo['tree'], lb_tau, lbr_tau_factor=lbr_tau_factor, annotation=line, dont_normalize=dont_normalize_lbi, extra_str='inf tree', iclust=iclust, debug=debug)
+    check_lb_values(line, line['tree-info']['lb'])  # would be nice to remove this eventually, but I keep runnining into instances where dendropy is silently removing nodes
+    if add_aa_consensus_distance:
+        add_cdists_to_lbfo(line, line['tree-info']['lb'], 'cons-dist-aa', debug=debug)  # this adds the values both directly to the <line>, and to <line['tree-info']['lb']>, but the former won't end up in the output file unless the corresponding keys are specified as extra annotation columns (this distinction/duplication is worth having, although it's not ideal)
+    if dtr_path is not None:  # NOTE only predicting here, since we don't want to train on data (i.e. inferred lines)
+        calc_dtr(False, line, line['tree-info']['lb'], treefo['tree'], None, pmml_models, dtr_cfgvals)  # adds predicted dtr values to lbfo (hardcoded False and None are to make sure we don't train on data)
+    return treefo['origin']
+
+# ----------------------------------------------------------------------------------------
+def run_inf_tree_metric_proc(iclust):  # run calculate_inf_tree_metrics() in a pool process, returning the origin and every key whose value it added or changed in the line (which is a copy, so the parent process has to update its line with them)
+    line = pool_info['lines'][iclust]
+    line_before = copy.deepcopy(line)  # have to compare values, not just look for new keys, since it also overwrites keys that may already be there (e.g. 'cons-dist-aa' from --extra-annotation-columns), and the parent has to end up with the same line as if we'd run it in serial
+    origin = calculate_inf_tree_metrics(iclust, line, fasttree_treestr=pool_info['fasttree-treestrs'].get(iclust), **pool_info['kwargs'])
+    return origin, {k : line[k] for k in line if k not in line_before or line[k] != line_before[k]}
+
 # ----------------------------------------------------------------------------------------
 def calculate_tree_metrics(annotations, lb_tau, lbr_tau_factor=None, cpath=None, treefname=None, reco_info=None, use_true_clusters=False, base_plotdir=None,
                            ete_path=None, workdir=None, dont_normalize_lbi=False, only_csv=False, min_cluster_size=default_min_selection_metric_cluster_size,
-                           dtr_path=None, train_dtr=False, dtr_cfg=None, add_aa_consensus_distance=False, true_lines_to_use=None, include_relative_affy_plots=False, cluster_indices=None, outfname=None, glfo=None, debug=False):
+                           dtr_path=None, train_dtr=False, dtr_cfg=None, add_aa_consensus_distance=False, true_lines_to_use=None, include_relative_affy_plots=False, cluster_indices=None, outfname=None, glfo=None, n_procs=1, debug=False):
+    # <n_procs>: if greater than 1, calculate the inferred clusters' trees and metrics in a pool of this many (forked) processes. The results (and <outfname>) are in the same order either way
     print 'getting selection metrics'
     if reco_info is not None:
         if not use_true_clusters:
@@ -1481,28 +1497,55 @@ def calculate_tree_metrics(annotations, lb_tau, lbr_tau_factor=None, cpath=None,
             print '      skipped all iclusts except %s (size%s %s)' % (' '.join(str(i) for i in cluster_indices), utils.plural(len(cluster_indices)), ' '.join(str(len(inf_lines_to_use[i]['unique_ids'])) for i in cluster_indices))
         n_already_there, n_skipped_uid = 0, 0
         final_inf_lines = []
-        for iclust, line in enumerate(inf_lines_to_use):
-            if cluster_indices is not None and iclust not in cluster_indices:
-                continue
-            if debug:
-                print '  %s sequence cluster' % utils.color('green', str(len(line['unique_ids'])))
-            treefo = get_tree_for_line(line, treefname=treefname, cpath=cpath, annotations=annotations, use_true_clusters=use_true_clusters, debug=debug)
-            if treefo['tree'] is None and treefo['origin'] == 'no-uids':
+        iclusts = [i for i in range(len(inf_lines_to_use)) if cluster_indices is None or i in cluster_indices]
+        iclusts_already_there = set(i for i in iclusts if 'tree-info' in inf_lines_to_use[i])  # have to check before we start, since the serial version modifies the lines as we go
+        kwargs = {'lb_tau' : lb_tau, 'lbr_tau_factor' : lbr_tau_factor, 'treefname' : treefname, 'cpath' : cpath, 'annotations' : annotations, 'use_true_clusters' : use_true_clusters, 'dont_normalize_lbi' : dont_normalize_lbi,
+                  'add_aa_consensus_distance' : add_aa_consensus_distance, 'dtr_path' : dtr_path if not train_dtr else None, 'debug' : debug}
+        if dtr_path is not None:
+            kwargs.update({'pmml_models' : pmml_models, 'dtr_cfgvals' : dtr_cfgvals})
+        fasttree_iclusts = [i for i in iclusts if get_tree_origin(inf_lines_to_use[i], treefname=treefname, cpath=cpath, use_true_clusters=use_true_clusters) == 'fasttree']
+        fasttree_treestrs = {}  # run FastTree for all the clusters that need it at once (in batches), so all we do for each cluster below is parse its tree
+        if len(fasttree_iclusts) > 1:
+            tmplines = [inf_lines_to_use[i] for i in fasttree_iclusts]
+            treestrs = get_fasttree_treestrs([[{'name' : u, 'seq' : s} for u, s in zip(l['unique_ids'], l['seqs'])] for l in tmplines], naive_seqs=[l['naive_seq'] for l in tmplines], n_procs=n_procs, workdir=workdir, debug=debug)
+            fasttree_treestrs = dict(zip(fasttree_iclusts, treestrs))
+        if n_procs > 1 and len(iclusts) > 1 and multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, and each forked process can end up with its own copy of everything
+            print '    %s not using %d procs for selection metrics since we\'re already using a lot of memory' % (utils.color('yellow', 'warning'), n_procs)
+            n_procs = 1
+        if n_procs > 1 and len(iclusts) > 1:  # forked processes inherit <pool_info>, so all we send them is the cluster index, and all they send back is what they added or changed in the line
+            global pool_info
+            pool_info = {'lines' : inf_lines_to_use, 'kwargs' : kwargs, 'fasttree-treestrs' : fasttree_treestrs}
+            pool = multiprocessing.Pool(processes=min(n_procs, len(iclusts)))
+            results = pool.imap(run_inf_tree_metric_proc, iclusts)  # clusters are sorted by decreasing size, so the biggest ones start first
+        else:
+            pool = None
+            results = ((calculate_inf_tree_metrics(iclust, inf_lines_to_use[iclust], fasttree_treestr=fasttree_treestrs.get(iclust), **kwargs), None) for iclust in iclusts)
+        ofile = None
+        if outfname is not None:  # write each cluster's tree info as soon as we have it (rather than all at the end)
+            print '  writing selection metrics to %s' % outfname
+            utils.prep_dir(None, fname=outfname, allow_other_files=True)
+            ofile = open(outfname, 'w')
+            ofile.write('[')
+        for iclust, (origin, new_linefo) in itertools.izip(iclusts, results):
+            line = inf_lines_to_use[iclust]
+            if origin == 'no-uids':
                 n_skipped_uid += 1
                 continue
-            tree_origin_counts[treefo['origin']]['count'] += 1
-            if 'tree-info' in line:  # NOTE we used to continue here, but now I've decided we really want to overwrite what's there (although I'm a little worried that there was a reason I'm forgetting not to overwrite them)
-                if debug:
-                    print '       %s overwriting selection metric info that was already in <line>' % utils.color('yellow', 'warning')
+            tree_origin_counts[origin]['count'] += 1
+            if iclust in iclusts_already_there:
                 n_already_there += 1
-            line['tree-info'] = {}  # NOTE <treefo> has a dendro tree, but what we put in the <line> (at least for now) is a newick string
-            line['tree-info']['lb'] = calculate_lb_values(treefo['tree'], lb_tau, lbr_tau_factor=lbr_tau_factor, annotation=line, dont_normalize=dont_normalize_lbi, extra_str='inf tree', iclust=iclust, debug=debug)
-            check_lb_values(line, line['tree-info']['lb'])  # would be nice to remove this eventually, but I keep runnining into instances where dendropy is silently removing nodes
-            if add_aa_consensus_distance:
-                add_cdists_to_lbfo(line, line['tree-info']['lb'], 'cons-dist-aa', debug=debug)  # this adds the values both directly to the <line>, and to <line['tree-info']['lb']>, but the former won't end up in the output file unless the corresponding keys are specified as extra annotation columns (this distinction/duplication is worth having, although it's not ideal)
-            if dtr_path is not None and not train_dtr:  # don't want to train on data
-                calc_dtr(False, line, line['tree-info']['lb'], treefo['tree'], None, pmml_models, dtr_cfgvals)  # adds predicted dtr values to lbfo (hardcoded False and None are to make sure we don't train on data)
+            if new_linefo is not None:
+                line.update(new_linefo)
+            if ofile is not None:
+                ofile.write((', ' if len(final_inf_lines) > 0 else '') + json.dumps(line['tree-info']))  # switching to json to avoid unicode bullshit (and ', ' is what json.dump() uses between list items, so it's the same as writing the whole list at once)
             final_inf_lines.append(line)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool_info = None
+        if ofile is not None:
+            ofile.write(']')
+            ofile.close()
         print '      tree origins: %s' % ',  '.join(('%d %s' % (nfo['count'], nfo['label'])) for n, nfo in tree_origin_counts.items() if nfo['count'] > 0)
         if n_skipped_uid > 0:
             print '    skipped %d/%d clusters that had no uids in common with tree in %s' % (n_skipped_uid, n_after, treefname)
@@ -1566,12 +1609,6 @@ def calculate_tree_metrics(annotations, lb_tau, lbr_tau_factor=None, cpath=None,
         assert ete_path is None or workdir is not None  # need the workdir to make the ete trees
         plot_tree_metrics(base_plotdir, inf_lines_to_use, true_lines_to_use, ete_path=ete_path, workdir=workdir, include_relative_affy_plots=include_relative_affy_plots, only_csv=only_csv, debug=debug)
 
-    if outfname is not None:
-        print '  writing selection metrics to %s' % outfname
-        utils.prep_dir(None, fname=outfname, allow_other_files=True)
-        with open(outfname, 'w') as tfile:
-            json.dump([l['tree-info'] for l in inf_lines_to_use if 'tree-info' in l], tfile) #, width=200, Dumper=yaml.CDumper, allow_unicode=False)  # switching to json to avoid unicode bullshit
-
 # ----------------------------------------------------------------------------------------
 def init_dtr(train_dtr, dtr_path, cfg_fname=None):
     # ----------------------------------------------------------------------------------------
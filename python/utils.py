@@ -1,6 +1,10 @@
 import yaml
 import platform
 import resource
+import signal
+import select
+import errno
+import fcntl
 import psutil
 import numpy
 import tempfile
@@ -20,7 +24,10 @@ import subprocess
 import multiprocessing
 import copy
 import traceback
+import cProfile
+import pstats
 import json
+import hashlib
 import types
 import collections
 import operator
@@ -56,6 +63,79 @@ def timeprinter(fcn):
         print '    %s: (%.1f sec)' % (fcn.__name__, time.time()-start)
     return wrapper
 
+# ----------------------------------------------------------------------------------------
+# Python-side profiling (--profile). Each stage (each action, plus any function decorated with profiled_stage()) gets its own cProfile.Profile, which is only enabled while we're inside that stage and not inside a stage nested
+# within it, so a stage's cProfile report doesn't include its sub-stages (although its wall time does). There's no tracemalloc in python 2, so for memory we instead keep track of the change in rss over each call, and how much it pushed up the process's peak rss.
+python_profile = None
+
+# ----------------------------------------------------------------------------------------
+def start_python_profile(outdir):
+    global python_profile
+    python_profile = {'outdir' : outdir, 'stages' : OrderedDict(), 'stack' : []}
+
+# ----------------------------------------------------------------------------------------
+def get_rss_mb(peak=False):  # current (or peak) resident memory of this process
+    if peak:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024. if platform.system() == 'Linux' else 1024.**2)  # linux reports kilobytes, mac bytes
+    return psutil.Process(os.getpid()).memory_info().rss / 1024.**2
+
+# ----------------------------------------------------------------------------------------
+def enter_profile_stage(name):
+    if name not in python_profile['stages']:
+        python_profile['stages'][name] = {'profiler' : cProfile.Profile(), 'n_calls' : 0, 'wall' : 0., 'rss_change' : 0., 'peak_rss_increase' : 0.}
+    if len(python_profile['stack']) > 0:
+        python_profile['stages'][python_profile['stack'][-1]['name']]['profiler'].disable()
+    python_profile['stack'].append({'name' : name, 'start' : time.time(), 'rss' : get_rss_mb(), 'peak_rss' : get_rss_mb(peak=True)})
+    python_profile['stages'][name]['profiler'].enable()
+
+# ----------------------------------------------------------------------------------------
+def exit_profile_stage():
+    sinfo = python_profile['stack'].pop()
+    sfo = python_profile['stages'][sinfo['name']]
+    sfo['profiler'].disable()
+    sfo['n_calls'] += 1
+    sfo['wall'] += time.time() - sinfo['start']
+    sfo['rss_change'] += get_rss_mb() - sinfo['rss']
+    sfo['peak_rss_increase'] = max(sfo['peak_rss_increase'], get_rss_mb(peak=True) - sinfo['peak_rss'])
+    if len(python_profile['stack']) > 0:
+        python_profile['stages'][python_profile['stack'][-1]['name']]['profiler'].enable()
+
+# ----------------------------------------------------------------------------------------
+def profiled_stage(name):  # decorator: profile each call to the decorated fcn as stage <name> (does nothing unless start_python_profile() has been called)
+    def decorator(fcn):
+        def wrapper(*args, **kwargs):
+            if python_profile is None:
+                return fcn(*args, **kwargs)
+            enter_profile_stage(name)
+            try:
+                return fcn(*args, **kwargs)
+            finally:
+                exit_profile_stage()
+        wrapper.__name__ = fcn.__name__
+        wrapper.__doc__ = fcn.__doc__
+        return wrapper
+    return decorator
+
+# ----------------------------------------------------------------------------------------
+def write_python_profile(n_functions=40):  # for each stage, write the full cProfile output to <stage>.prof (e.g. for pstats or snakeviz) and the top <n_functions> by cumulative time to <stage>.txt, then write a summary of all stages to summary.txt
+    outdir = python_profile['outdir']
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    summary_lines = ['%-30s  %8s  %10s  %10s  %12s  %15s' % ('stage', 'calls', 'wall (s)', 'per call', 'rss chg (MB)', 'peak incr (MB)')]
+    for name, sfo in python_profile['stages'].items():
+        summary_lines.append('%-30s  %8d  %10.2f  %10.4f  %12.1f  %15.1f' % (name, sfo['n_calls'], sfo['wall'], sfo['wall'] / sfo['n_calls'] if sfo['n_calls'] > 0 else 0., sfo['rss_change'], sfo['peak_rss_increase']))
+        sfo['profiler'].dump_stats('%s/%s.prof' % (outdir, name))
+        with open('%s/%s.txt' % (outdir, name), 'w') as outfile:
+            try:
+                pstats.Stats(sfo['profiler'], stream=outfile).sort_stats('cumulative').print_stats(n_functions)
+            except TypeError:  # pstats barfs if the profiler didn't see any function calls
+                outfile.write('no function calls\n')
+    with open(outdir + '/summary.txt', 'w') as outfile:
+        outfile.write('\n'.join(summary_lines) + '\n')
+    print '  wrote python profile reports for %d stages to %s/:' % (len(python_profile['stages']), outdir)
+    for line in summary_lines:
+        print '    %s' % line
+
 # ----------------------------------------------------------------------------------------
 # putting these up here so glutils import doesn't fail... I think I should be able to do it another way, though
 regions = ['v', 'd', 'j']
@@ -2296,6 +2376,79 @@ def hamming_fraction(seq1, seq2, extra_bases=None, also_return_distance=False, a
     else:
         return fraction
 
+# ----------------------------------------------------------------------------------------
+# vectorized versions of hamming_distance() and hamming_fraction() for when you need lots of distances among the same set of sequences (e.g. all-vs-all, or one-vs-many)
+#  - sequences are encoded once into a 2d uint8 array (one row per sequence), together with a boolean mask that's True at ambiguous/gap positions (i.e. the positions that hamming_distance() skips)
+#  - the <seqs> arguments below can either be a list of sequences, or the (seqarray, skipmask) tuple returned by encode_seqs_for_hamming(), so you can encode once and reuse it
+#  - results are identical to the scalar functions (checked in test/benchmark.py hamming)
+def encode_seqs_for_hamming(seqs, amino_acid=False):
+    if len(set(len(s) for s in seqs)) > 1:
+        raise Exception('unequal length sequences among %d seqs (lengths: %s)' % (len(seqs), ' '.join(str(l) for l in sorted(set(len(s) for s in seqs)))))
+    seq_len = len(seqs[0]) if len(seqs) > 0 else 0
+    if len(seqs) == 0 or seq_len == 0:
+        seqarray = numpy.zeros((len(seqs), seq_len), dtype=numpy.uint8)
+    else:
+        seqarray = numpy.frombuffer(str(''.join(seqs)), dtype=numpy.uint8).reshape(len(seqs), seq_len)  # str() in case they're unicode (e.g. from json)
+    skip_table = numpy.zeros(256, dtype=numpy.bool_)  # lookup table: True for characters that hamming_distance() skips
+    skip_table[[ord(c) for c in (ambiguous_amino_acids if amino_acid else ambiguous_bases) + gap_chars]] = True
+    return seqarray, skip_table[seqarray]
+
+# ----------------------------------------------------------------------------------------
+def get_encoded_seqs(seqs, amino_acid=False):  # return (seqarray, skipmask) for <seqs>, encoding it if it isn't already
+    if isinstance(seqs, tuple) and len(seqs) == 2 and isinstance(seqs[0], numpy.ndarray):
+        return seqs
+    return encode_seqs_for_hamming(seqs, amino_acid=amino_acid)
+
+# ----------------------------------------------------------------------------------------
+def hamming_distances_to_seq(seq, seqs, return_fractions=False, return_len_excluding_ambig=False, amino_acid=False):  # one-vs-many: distances (or fractions) between <seq> and each of <seqs>, as numpy arrays
+    seqarray, skipmask = get_encoded_seqs(seqs, amino_acid=amino_acid)
+    qarray, qmask = encode_seqs_for_hamming([seq], amino_acid=amino_acid)
+    if qarray.shape[1] != seqarray.shape[1] and seqarray.shape[0] > 0:
+        raise Exception('unequal length sequences %d %d:\n  %s' % (qarray.shape[1], seqarray.shape[1], seq))
+    valid = ~(skipmask | qmask)  # broadcasts the single query row against every row in <seqarray>
+    distances = numpy.count_nonzero((seqarray != qarray) & valid, axis=1)
+    lens = numpy.count_nonzero(valid, axis=1)
+    if return_fractions:
+        distances = distances / numpy.maximum(lens, 1).astype(numpy.float64)  # zero-length (after removing ambiguous) gives fraction 0, same as hamming_fraction()
+    return (distances, lens) if return_len_excluding_ambig else distances
+
+# ----------------------------------------------------------------------------------------
+def hamming_distance_matrix(seqs, return_fractions=False, return_len_excluding_ambig=False, condensed=False, amino_acid=False, chunk_size=2000):  # all-vs-all: square (or, if <condensed>, scipy-style condensed) array of distances (or fractions) among <seqs>
+    # For each non-skipped character c, with X_c the one-hot indicator matrix (n_seqs x seq_len), the number of positions at which seqs i and j are both c is (X_c X_c^T)_ij.
+    # Summing over characters gives the number of matching positions, and V V^T (with V the not-skipped indicator) gives the number of positions that hamming_distance() compares, so distance = VV^T - sum_c X_c X_c^T.
+    # Rows are done <chunk_size> at a time to keep the (float32, so exact up to 2^24 positions) temporaries from getting too big, and with <condensed> we never make the full square matrix (so memory is n(n-1)/2 values rather than n^2).
+    seqarray, skipmask = get_encoded_seqs(seqs, amino_acid=amino_acid)
+    n_seqs = seqarray.shape[0]
+    valid = (~skipmask).astype(numpy.float32)
+    any_skipped = skipmask.any()
+    chars = numpy.unique(seqarray[~skipmask])
+    onehots = [((seqarray == c) & ~skipmask).astype(numpy.float32) for c in chars]
+    outshape = (n_seqs * (n_seqs - 1) // 2, ) if condensed else (n_seqs, n_seqs)
+    distances = numpy.zeros(outshape, dtype=numpy.float64 if return_fractions else numpy.int32)
+    lens = numpy.zeros(outshape, dtype=numpy.int32)
+    for istart in range(0, n_seqs, chunk_size):
+        istop = min(n_seqs, istart + chunk_size)
+        if any_skipped:
+            clens = numpy.dot(valid[istart : istop], valid.T)
+        else:  # no ambiguous/gap characters, so we compare every position
+            clens = numpy.full((istop - istart, n_seqs), seqarray.shape[1], dtype=numpy.float32)
+        cmatches = numpy.zeros(clens.shape, dtype=numpy.float32)
+        for onehot in onehots:
+            cmatches += numpy.dot(onehot[istart : istop], onehot.T)
+        clens = numpy.rint(clens).astype(numpy.int32)
+        cdists = numpy.rint(clens - cmatches).astype(numpy.int32)
+        if return_fractions:
+            cdists = cdists / numpy.maximum(clens, 1).astype(numpy.float64)  # zero-length (after removing ambiguous) gives fraction 0, same as hamming_fraction()
+        if condensed:  # same ordering as scipy.spatial.distance.pdist() (i.e. upper triangle, row by row)
+            for iseq in range(istart, istop):
+                ioffset = iseq * n_seqs - iseq * (iseq + 1) // 2  # index in condensed array of (iseq, iseq + 1)
+                distances[ioffset : ioffset + n_seqs - iseq - 1] = cdists[iseq - istart, iseq + 1 :]
+                lens[ioffset : ioffset + n_seqs - iseq - 1] = clens[iseq - istart, iseq + 1 :]
+        else:
+            distances[istart : istop] = cdists
+            lens[istart : istop] = clens
+    return (distances, lens) if return_len_excluding_ambig else distances
+
 # ----------------------------------------------------------------------------------------
 def subset_sequences(line, restrict_to_region=None, exclusion_3p=None, iseq=None):
     # NOTE don't call with <iseq> directly, instead use subset_iseq() below
@@ -2704,6 +2857,47 @@ def merge_csvs(outfname, csv_list, cleanup=True):
 
     return n_event_list
 
+# ----------------------------------------------------------------------------------------
+def merge_csv_lines(infnames, outfname, dereplicate=False):
+    """
+    Stream the (non-header) lines from each of <infnames> into <outfname> (in a single pass, and without parsing them), such that <outfname> ends up with exactly one header line.
+    If <outfname> is among <infnames> and is non-empty, the other files are appended to it, except if <dereplicate> is set, in which case it's rewritten via a temporary file.
+    If <dereplicate> is set, lines identical to a previously-written line are skipped (we keep only a digest of each line, so memory usage is much smaller than the files).
+    Returns the number of lines written (not including the header), or None if all of <infnames> are empty or missing.
+    """
+    real_fnames = [fn for fn in infnames if os.path.exists(fn) and os.stat(fn).st_size > 0]
+    if len(real_fnames) == 0:
+        return None
+    with open(real_fnames[0]) as headfile:  # we just need one of the infiles to get the header (some may be zero length)
+        header = headfile.readline().rstrip('\r\n')
+
+    append_to_outfile = outfname in real_fnames and not dereplicate  # if we're not dereplicating, we can just tack the other infiles onto the end of <outfname>
+    fnames_to_read = [fn for fn in real_fnames if fn != outfname] if append_to_outfile else real_fnames
+    tmpfname = outfname + '.tmp' if outfname in real_fnames and not append_to_outfile else None  # can't write to <outfname> while we're reading from it
+    seen_digests = set()
+    n_lines_written = 0
+    with open(outfname if tmpfname is None else tmpfname, 'a' if append_to_outfile else 'w') as outfile:
+        if not append_to_outfile:
+            outfile.write(header + '\n')
+        for fname in fnames_to_read:
+            with open(fname) as infile:
+                for line in infile:
+                    if line.rstrip('\r\n') == header:
+                        continue
+                    if line[-1] != '\n':  # last line in a file without a trailing newline
+                        line += '\n'
+                    if dereplicate:  # NOTE there can be multiple lines with the same uid string, but this is ok -- the c++ handles it (we only remove exact duplicates)
+                        digest = hashlib.md5(line).digest()
+                        if digest in seen_digests:
+                            continue
+                        seen_digests.add(digest)
+                    outfile.write(line)
+                    n_lines_written += 1
+    if tmpfname is not None:
+        os.rename(tmpfname, outfname)
+
+    return n_lines_written
+
 # ----------------------------------------------------------------------------------------
 def merge_yamls(outfname, yaml_list, headers, cleanup=True, use_pyyaml=False):
     """ NOTE copy of merge_csvs(), which is (apparently) a copy of merge_hmm_outputs in partitiondriver, I should really combine the two functions """
@@ -2987,17 +3181,18 @@ def simplerun(cmd_str, shell=False, cmdfname=None, dryrun=False, return_out_err=
     sys.stdout.flush()
     if dryrun:
         return '', '' if return_out_err else None
-    if print_time is not None:
-        start = time.time()
+    start = time.time()
+    input_bytes = get_cmd_input_bytes(cmd_str) if resource_profile is not None else None
     if return_out_err:
         with tempfile.TemporaryFile() as fout, tempfile.TemporaryFile() as ferr:
-            subprocess.check_call(cmd_str if shell else cmd_str.split(), env=os.environ, shell=shell, stdout=fout, stderr=ferr)
+            rusage = check_call_with_rusage(cmd_str if shell else cmd_str.split(), env=os.environ, shell=shell, stdout=fout, stderr=ferr)
             fout.seek(0)
             ferr.seek(0)
             outstr = ''.join(fout.readlines())
             errstr = ''.join(ferr.readlines())
     else:
-        subprocess.check_call(cmd_str if shell else cmd_str.split(), env=os.environ, shell=shell)
+        rusage = check_call_with_rusage(cmd_str if shell else cmd_str.split(), env=os.environ, shell=shell)
+    add_resource_profile_record(cmd_str, start, time.time(), rusage, input_bytes=input_bytes)
     if cmdfname is not None:
         os.remove(cmdfname)
     if print_time is not None:
@@ -3127,18 +3322,232 @@ cmdfo_defaults = {  # None means by default it's absent
     'threads' : None,  # slurm cpus per task
 }
 
+# ----------------------------------------------------------------------------------------
+def install_sigchld_wakeup():
+    """
+    Install a SIGCHLD handler that writes to a pipe, so wait_for_child_exit() can sleep until a child process exits (rather than polling).
+    Returns the read end of the pipe and a function that restores the previous handler, or (None, None) if we can't install the handler (e.g. if we're not in the main thread).
+    """
+    rfd, wfd = os.pipe()
+    for fd in (rfd, wfd):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    def handler(signum, frame):
+        try:
+            os.write(wfd, 'x')
+        except OSError:  # pipe is full, which is fine since we only care that it's readable
+            pass
+    try:
+        old_handler = signal.signal(signal.SIGCHLD, handler)
+    except ValueError:  # signal handlers can only be set in the main thread
+        os.close(rfd)
+        os.close(wfd)
+        return None, None
+    signal.siginterrupt(signal.SIGCHLD, False)  # restart other system calls interrupted by the signal, so e.g. reads of log files don't fail with EINTR
+    def restore():
+        signal.signal(signal.SIGCHLD, old_handler if old_handler is not None else signal.SIG_DFL)
+        os.close(rfd)
+        os.close(wfd)
+    return rfd, restore
+
+# ----------------------------------------------------------------------------------------
+def wait_for_child_exit(wakeup_fd, timeout=1.):  # sleep until a child process exits (i.e. until <wakeup_fd> from install_sigchld_wakeup() is readable), or until <timeout> seconds have passed (in case we somehow miss a signal)
+    if wakeup_fd is None:  # no handler, so fall back to polling
+        time.sleep(0.01)
+        return
+    try:
+        readable, _, _ = select.select([wakeup_fd], [], [], timeout)
+    except select.error as err:  # select() is never restarted after a signal, so this happens if the signal arrives while we're waiting
+        if err.args[0] != errno.EINTR:
+            raise
+        return
+    if len(readable) > 0:
+        try:
+            while len(os.read(wakeup_fd, 4096)) > 0:  # drain the pipe
+                pass
+        except OSError:  # empty
+            pass
+
+# ----------------------------------------------------------------------------------------
+def reap_process(proc):
+    """
+    Non-blocking wait4() on the Popen object <proc>: if it has finished, set its returncode (so e.g. communicate() doesn't try to wait for it again) and return its resource usage, otherwise return None.
+    Resource usage is a dict with user and sys cpu time (seconds) and peak resident set size (MB), which includes any children that <proc> waited for (e.g. if it's a shell).
+    NOTE on linux the peak rss is never less than the rss of the parent (i.e. this python process) when it forked, so it's only meaningful for procs that use more memory than we do.
+    """
+    try:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except OSError as err:
+        if err.errno != errno.ECHILD:
+            raise
+        proc.poll()  # somebody else already waited for it, so we can't get its status or resource usage (poll() will set the return code to 0)
+        return {'user' : None, 'sys' : None, 'maxrss' : None}
+    if pid == 0:  # still running
+        return None
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)  # same convention as Popen
+    return {'user' : rusage.ru_utime, 'sys' : rusage.ru_stime, 'maxrss' : rusage.ru_maxrss / 1024. if platform.system() == 'Linux' else rusage.ru_maxrss / 1024.**2}  # linux reports kilobytes, mac bytes
+
+# ----------------------------------------------------------------------------------------
+def check_call_with_rusage(cmd, **kwargs):  # same as subprocess.check_call(), but returns the resource usage of the finished process (see reap_process())
+    proc = subprocess.Popen(cmd, **kwargs)
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return {'user' : rusage.ru_utime, 'sys' : rusage.ru_stime, 'maxrss' : rusage.ru_maxrss / 1024. if platform.system() == 'Linux' else rusage.ru_maxrss / 1024.**2}
+
+# ----------------------------------------------------------------------------------------
+# Resource accounting for external commands run with run_cmds() and simplerun(): if start_resource_profile() has been called, we add a record to <resource_profile> for each command that finishes,
+# labeled with the current action and step (which the caller sets with set_resource_profile_context()), and write_resource_profile() aggregates them and writes them to a json file.
+resource_profile = None  # list of records, or None if we're not keeping track
+resource_profile_context = {'action' : None, 'step' : None}
+resource_profile_keys = ['wall', 'user', 'sys', 'input_bytes', 'output_bytes', 'n_retries']  # keys that we sum over (for rss we instead take the max)
+
+# ----------------------------------------------------------------------------------------
+def start_resource_profile():
+    global resource_profile
+    resource_profile = []
+
+# ----------------------------------------------------------------------------------------
+def set_resource_profile_context(action=None, step=None):
+    resource_profile_context['action'] = action
+    resource_profile_context['step'] = step
+
+# ----------------------------------------------------------------------------------------
+def get_cmd_tool_name(cmd_str):  # short name for the program that <cmd_str> runs, e.g. 'bcrham' or 'ig-sw' (skipping any interpreter)
+    words = cmd_str.split()
+    while len(words) > 1 and words[1][0] != '-' and os.path.basename(words[0]).split('.')[0] in ['python', 'python2', 'python3', 'Rscript', 'perl', 'bash', 'sh']:
+        words = words[1:]
+    return os.path.basename(words[0]) if len(words) > 0 else None
+
+# ----------------------------------------------------------------------------------------
+def get_cmd_input_bytes(cmd_str, outfname=None):  # total size of the files that appear in <cmd_str> (other than <outfname>) and exist before we run it, i.e. more or less the size of its input
+    return sum(os.path.getsize(w) for w in set(cmd_str.split()[1:]) if w != outfname and os.path.isfile(w))
+
+# ----------------------------------------------------------------------------------------
+def add_resource_profile_record(cmd_str, start, end, rusage, n_tries=1, input_bytes=None, outfname=None):  # <start> and <end> are times, <rusage> is from reap_process()
+    if resource_profile is None:
+        return
+    resource_profile.append({'action' : resource_profile_context['action'], 'step' : resource_profile_context['step'], 'tool' : get_cmd_tool_name(cmd_str), 'cmd_str' : cmd_str,
+                             'start' : start, 'wall' : end - start, 'user' : rusage['user'], 'sys' : rusage['sys'], 'maxrss' : rusage['maxrss'], 'n_retries' : n_tries - 1,
+                             'input_bytes' : input_bytes, 'output_bytes' : os.path.getsize(outfname) if outfname is not None and os.path.isfile(outfname) else None})
+
+# ----------------------------------------------------------------------------------------
+def summarize_resource_records(records):  # aggregate a list of records from add_resource_profile_record()
+    def vals(key):
+        return [r[key] for r in records if r[key] is not None]
+    summary = {'n_cmds' : len(records), 'tools' : sorted(set(r['tool'] for r in records)),
+               'elapsed' : max(r['start'] + r['wall'] for r in records) - min(r['start'] for r in records),  # from the start of the first command to the end of the last one
+               'max_wall' : max(vals('wall')), 'max_maxrss' : max(vals('maxrss')) if len(vals('maxrss')) > 0 else None}
+    for key in resource_profile_keys:
+        summary['total_' + key] = sum(vals(key)) if len(vals(key)) > 0 else None
+    return summary
+
+# ----------------------------------------------------------------------------------------
+def write_resource_profile(outfname, debug=True):  # write all the records in <resource_profile>, plus summaries for each action, and each step within each action, to json file <outfname>
+    if resource_profile is None:
+        raise Exception('resource profile wasn\'t started (see start_resource_profile())')
+    def group_records(keyfcn):
+        groups = OrderedDict()  # keep them in the order they first ran
+        for record in sorted(resource_profile, key=operator.itemgetter('start')):
+            groups.setdefault(keyfcn(record), []).append(record)
+        return groups
+    profile = {'per-action' : [dict(summarize_resource_records(rlist), action=action) for action, rlist in group_records(operator.itemgetter('action')).items()],
+               'per-step' : [dict(summarize_resource_records(rlist), action=action, step=step) for (action, step), rlist in group_records(operator.itemgetter('action', 'step')).items()],
+               'commands' : sorted(resource_profile, key=operator.itemgetter('start'))}
+    if debug:
+        print '  writing resource profile for %d commands to %s' % (len(resource_profile), outfname)
+        print '       action            step                       cmds   elapsed (s)   cpu (s)   max rss (MB)'
+        for sfo in profile['per-step']:
+            print '      %-16s  %-25s %5d   %8.1f    %8.1f    %s' % (sfo['action'], sfo['step'], sfo['n_cmds'], sfo['elapsed'], (sfo['total_user'] or 0.) + (sfo['total_sys'] or 0.), '-' if sfo['max_maxrss'] is None else '%.0f' % sfo['max_maxrss'])
+    if not os.path.exists(os.path.dirname(os.path.abspath(outfname))):
+        os.makedirs(os.path.dirname(os.path.abspath(outfname)))
+    with open(outfname, 'w') as outfile:
+        json.dump(profile, outfile, indent=2)
+
+# ----------------------------------------------------------------------------------------
+def iter_finished_cmds(next_cmdfo, n_slots=None, n_max_tries=None, shell=False, batch_system=None, batch_options=None, debug=None, ignore_stderr=False, clean_on_success=False, allow_failure=False):
+    """
+    Start commands whenever there's a free slot, and yield each one once it's finished (after any retries), so the caller can decide what to run next based on its output.
+    <next_cmdfo>: fcn that we call with the index of a free slot (None if <n_slots> is None, i.e. if there's no limit) and that returns the cmdfo to start in that slot, or None if there's nothing to start right now. We return once nothing is running and it returns None.
+    Yields (icmd, procfo) for each finished command, where <icmd> is the order in which it was started, and <procfo> has its slot, number of tries, start and end times (of the last try), resource usage (see reap_process()), and finish_process() status.
+    Rather than polling each process, we sleep until we get a SIGCHLD (see install_sigchld_wakeup()), then wait4() each running process. If a cmdfo has a 'dbgfo', its 'resources' key is set to the resource usage, and if we're keeping a resource profile (see start_resource_profile()), we also add a record for each command.
+    """
+    if n_max_tries is None:
+        n_max_tries = 1 if batch_system is None else 3
+    cmdfos, procs, procfos = [], [], []  # indexed by the order in which we started them
+    free_slots = None if n_slots is None else range(n_slots)
+    def start_proc(icmd):
+        procs[icmd] = run_cmd(cmdfos[icmd], batch_system=batch_system, batch_options=batch_options, shell=shell)
+        procfos[icmd]['n_tries'] += 1
+        procfos[icmd]['start'] = time.time()
+
+    wakeup_fd, restore_sigchld = install_sigchld_wakeup()  # install this before starting any procs, so we don't miss any signals
+    try:
+        running = []  # indices of procs that are running
+        while True:
+            while free_slots is None or len(free_slots) > 0:  # start as many as we're allowed to
+                islot = None if free_slots is None else free_slots[0]
+                cmdfo = next_cmdfo(islot)
+                if cmdfo is None:
+                    break
+                if free_slots is not None:
+                    free_slots.remove(islot)
+                cmdfos.append(cmdfo)
+                procs.append(None)
+                procfos.append({'islot' : islot, 'n_tries' : 0, 'input_bytes' : get_cmd_input_bytes(cmdfo['cmd_str'], outfname=cmdfo['outfname']) if resource_profile is not None else None})  # have to get input size before it runs, since a lot of commands' input files get removed when they finish
+                start_proc(len(cmdfos) - 1)
+                running.append(len(cmdfos) - 1)
+            if len(running) == 0:
+                break
+            finished = []
+            for icmd in running:
+                rusage = reap_process(procs[icmd])
+                if rusage is not None:  # None means it's still running
+                    finished.append((icmd, rusage))
+            if len(finished) == 0:
+                wait_for_child_exit(wakeup_fd)
+                continue
+            for icmd, rusage in finished:
+                cmdfo, procfo = cmdfos[icmd], procfos[icmd]
+                procfo['end'] = time.time()
+                procfo['resources'] = dict(rusage, wall=procfo['end'] - procfo['start'], n_tries=procfo['n_tries'])
+                if cmdfo.get('dbgfo') is not None:
+                    cmdfo['dbgfo']['resources'] = procfo['resources']
+                procfo['status'] = 'ok'
+                try:
+                    procfo['status'] = finish_process(icmd, procs, procfo['n_tries'], cmdfo, n_max_tries, dbgfo=cmdfo.get('dbgfo'), batch_system=batch_system, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, allow_failure=allow_failure)
+                finally:  # add the record even if it failed
+                    if procfo['status'] != 'restart':
+                        add_resource_profile_record(cmdfo['cmd_str'], procfo['start'], procfo['end'], rusage, n_tries=procfo['n_tries'], input_bytes=procfo['input_bytes'], outfname=cmdfo['outfname'])
+                if procfo['status'] == 'restart':
+                    start_proc(icmd)
+                    continue
+                running.remove(icmd)
+                if free_slots is not None:
+                    free_slots = sorted(free_slots + [procfo['islot']])
+                yield icmd, procfo
+            sys.stdout.flush()
+    finally:
+        if restore_sigchld is not None:
+            restore_sigchld()
+
 # ----------------------------------------------------------------------------------------
 # notes:
 #  - set sleep to False if your commands are going to run really really really quickly
 #  - unlike everywhere else, <debug> is not a boolean, and is either None (swallow out, print err)), 'print' (print out and err), 'write' (write out and err to file called 'log' in logdir), or 'write:<log file name>' (same as 'write', but you set your own base name)
-#  - if both <n_max_procs> and <proc_limit_str> are set, it uses limit_procs() (i.e. a ps call) to count the total number of <proc_limit_str> running on the machine; whereas if only <n_max_procs> is set, it counts only subprocesses that it is itself running
+#  - if both <n_max_procs> and <proc_limit_str> are set, it uses limit_procs() (i.e. a ps call) to count the total number of <proc_limit_str> running on the machine; whereas if only <n_max_procs> is set, it only counts subprocesses that it is itself running, and starts the next one as soon as one finishes
 #  - debug: can be None (stdout mostly gets ignored), 'print' (printed), 'write' (written to file 'log' in logdir), or 'write:<logfname>' (same, but use <logfname>)
+#  - the actual scheduling (and retrying, and resource accounting) is in iter_finished_cmds(), so see there (or use it directly) if you need to decide what to run next based on the output of procs that have finished
 def run_cmds(cmdfos, shell=False, n_max_tries=None, clean_on_success=False, batch_system=None, batch_options=None, batch_config_fname=None,
              debug=None, ignore_stderr=False, sleep=True, n_max_procs=None, proc_limit_str=None, allow_failure=False):
     if len(cmdfos) == 0:
         raise Exception('zero length cmdfos')
-    if n_max_tries is None:
-        n_max_tries = 1 if batch_system is None else 3
     per_proc_sleep_time = 0.01 / max(1, len(cmdfos))
 
     # check cmdfos and set defaults
@@ -3154,27 +3563,18 @@ def run_cmds(cmdfos, shell=False, n_max_tries=None, clean_on_success=False, batc
     if batch_system == 'slurm' and batch_config_fname is not None:
         set_slurm_nodelist(cmdfos, batch_config_fname)
 
-    procs, n_tries_list = [], []
-    for iproc in range(len(cmdfos)):
-        procs += [run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)]
-        n_tries_list.append(1)
-        if sleep:
-            time.sleep(per_proc_sleep_time)
-        if n_max_procs is not None:
-            limit_procs(proc_limit_str, n_max_procs, procs=procs)  # NOTE now that I've added the <procs> arg, I should remove all the places where I'm using the old cmd str method (I mean, it works fine, but it's hackier/laggier, and in cases where several different parent procs are running a log of the same-named subprocs on the same machine, the old way will be wrong [i.e. limit_procs was originally intended as a global machine-wide limit, whereas in this fcn we usually call it wanting to set a specific number of subproces for this process])
-
-    while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-        for iproc in range(len(cmdfos)):
-            if procs[iproc] is None:  # already finished
-                continue
-            if procs[iproc].poll() is not None:  # it just finished
-                status = finish_process(iproc, procs, n_tries_list[iproc], cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc].get('dbgfo'), batch_system=batch_system, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, allow_failure=allow_failure)
-                if status == 'restart':
-                    procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)
-                    n_tries_list[iproc] += 1
-        sys.stdout.flush()
-        if sleep:
-            time.sleep(per_proc_sleep_time)
+    cmdfo_iter = iter(cmdfos)
+    def next_cmdfo(islot):
+        cmdfo = next(cmdfo_iter, None)
+        if cmdfo is not None:
+            if n_max_procs is not None and proc_limit_str is not None:
+                limit_procs(proc_limit_str, n_max_procs)  # wait until there's few enough matching procs on the whole machine
+            if sleep:
+                time.sleep(per_proc_sleep_time)
+        return cmdfo
+    for _ in iter_finished_cmds(next_cmdfo, n_slots=n_max_procs if proc_limit_str is None else None, n_max_tries=n_max_tries, shell=shell, batch_system=batch_system, batch_options=batch_options,  # if <proc_limit_str> is set, limit_procs() does the limiting
+                                debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, allow_failure=allow_failure):
+        pass
 
 # ----------------------------------------------------------------------------------------
 def pad_lines(linestr, padwidth=8):
@@ -3485,6 +3885,51 @@ def get_cluster_ids(uids, partition):
                 clids[uid].append(iclust)
     return clids
 
+# ----------------------------------------------------------------------------------------
+def merge_overlapping_clusters(partition, debug=False):
+    """
+    Return a new partition in which any clusters in <partition> that share a uid (either directly, or through a chain of other clusters) are merged together.
+    Uses a disjoint-set forest over the cluster indices (keyed by the first cluster in which we see each uid), so it's close to linear in the total number of uids.
+    Clusters that don't overlap with anything are returned as is, in their original order, followed by the merged clusters (in order of their first constituent cluster, and with uids in order of first appearance).
+    """
+    parents = range(len(partition))
+    sizes = [1 for _ in partition]  # number of clusters in each set (only meaningful for roots)
+    def find_root(iclust):
+        while parents[iclust] != iclust:
+            parents[iclust] = parents[parents[iclust]]  # path halving
+            iclust = parents[iclust]
+        return iclust
+
+    first_clusters = {}  # index of first cluster in which we saw each uid
+    for iclust, cluster in enumerate(partition):
+        for uid in cluster:
+            jclust = first_clusters.setdefault(uid, iclust)
+            if jclust == iclust:
+                continue
+            iroot, jroot = find_root(iclust), find_root(jclust)
+            if iroot == jroot:
+                continue
+            if sizes[iroot] < sizes[jroot]:  # union by size
+                iroot, jroot = jroot, iroot
+            parents[jroot] = iroot
+            sizes[iroot] += sizes[jroot]
+
+    cluster_groups = OrderedDict()  # map from each root to the indices of the clusters in its set (in order, so the groups are also ordered by their first cluster)
+    for iclust in range(len(partition)):
+        cluster_groups.setdefault(find_root(iclust), []).append(iclust)
+
+    new_partition, merged_clusters = [], []
+    for cgroup in cluster_groups.values():
+        if len(cgroup) == 1:
+            new_partition.append(partition[cgroup[0]])
+            continue
+        if debug:
+            print '  merging %s' % ' '.join(str(i) for i in cgroup)
+        merged_clusters.append(list(OrderedDict.fromkeys(uid for iclust in cgroup for uid in partition[iclust])))
+    if debug:
+        print '    merged %d clusters into %d' % (sum(len(g) for g in cluster_groups.values() if len(g) > 1), len(merged_clusters))
+    return new_partition + merged_clusters
+
 # ----------------------------------------------------------------------------------------
 def new_ccfs_that_need_better_names(partition, true_partition, reco_info, seed_unique_id=None, debug=False):
     if seed_unique_id is None:
@@ -4091,6 +4536,45 @@ def collapse_naive_seqs_with_hashes(naive_seq_list, sw_info):
     print '        collapsed %d sequences into %d unique naive sequences' % (len(naive_seq_list), len(naive_seq_hashes))
     return naive_seq_map, naive_seq_hashes
 
+# ----------------------------------------------------------------------------------------
+# Index for quickly finding, among a growing set of kept sequences, one that contains, or is contained in, a new sequence (optionally only looking at kept sequences in the same <group>, e.g. with the same cdr3 length).
+# We index each kept seq's k-mers at every <step>th position, and also its first <step> k-mers. If a new seq is contained in a kept seq, then one of the new seq's first <step> k-mers has to line up with one of the kept seq's every-<step>th
+# k-mers, and if a kept seq is contained in the new seq, one of the kept seq's first <step> k-mers has to line up with one of the new seq's every-<step>th k-mers. So each lookup is about <step> + len(seq) / <step> dict lookups, plus
+# a substring check for each kept seq that shares one of those k-mers. Sequences that are too short for this (less than <kmer_len> + <step> - 1) get checked by brute force.
+def init_containment_index(kmer_len=20, step=20):
+    return {'kmer_len' : kmer_len, 'step' : step, 'seqs' : [], 'strided' : {}, 'leading' : {}, 'short' : {}, 'groups' : {}}
+
+# ----------------------------------------------------------------------------------------
+def add_to_containment_index(cindex, seq, group=None):
+    k, step = cindex['kmer_len'], cindex['step']
+    iseq = len(cindex['seqs'])
+    cindex['seqs'].append(seq)
+    cindex['groups'].setdefault(group, []).append(iseq)
+    if len(seq) < k + step - 1:
+        cindex['short'].setdefault(group, []).append(iseq)
+        return
+    for istart in range(0, len(seq) - k + 1, step):
+        cindex['strided'].setdefault(hash((group, seq[istart : istart + k])), []).append(iseq)
+    for istart in range(step):
+        cindex['leading'].setdefault(hash((group, seq[istart : istart + k])), []).append(iseq)
+
+# ----------------------------------------------------------------------------------------
+def find_containing_or_contained_seq(cindex, seq, group=None):  # return the earliest-added kept seq in <group> that contains or is contained in <seq>, or None if there isn't one
+    k, step = cindex['kmer_len'], cindex['step']
+    candidates = set(cindex['short'].get(group, []))
+    if len(seq) < k + step - 1:  # too short to use the k-mers, so check everybody in the group
+        candidates |= set(cindex['groups'].get(group, []))
+    else:
+        for istart in range(step):  # <seq> contained in a kept seq
+            candidates.update(cindex['strided'].get(hash((group, seq[istart : istart + k])), []))
+        for istart in range(0, len(seq) - k + 1, step):  # kept seq contained in <seq>
+            candidates.update(cindex['leading'].get(hash((group, seq[istart : istart + k])), []))
+    for iseq in sorted(candidates):
+        kseq = cindex['seqs'][iseq]
+        if seq in kseq or kseq in seq:
+            return kseq
+    return None
+
 # ----------------------------------------------------------------------------------------
 def write_fasta(fname, seqfos, name_key='name', seq_key='seq'):  # should have written this a while ago -- there's tons of places where I could use this instead of writing it by hand, but I'm not going to hunt them all down now
     if not os.path.isdir(os.path.dirname(fname)):
@@ -4100,71 +4584,181 @@ def write_fasta(fname, seqfos, name_key='name', seq_key='seq'):  # should have w
             seqfile.write('>%s\n%s\n' % (sfo[name_key], sfo[seq_key]))
 
 # ----------------------------------------------------------------------------------------
-def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):
-    if ftype is None:
-        suffix = getsuffix(fname)
-        if suffix == '.fa' or suffix == '.fasta':
-            ftype = 'fa'
-        elif suffix == '.fq' or suffix == '.fastq':
-            ftype = 'fq'
-        else:
-            raise Exception('unhandled file type: %s' % suffix)
+def is_gzipped(fname):  # check for the gzip magic number (bgzip files are also gzip files, they're just multi-member)
+    with open(fname, 'rb') as tmpfile:
+        return tmpfile.read(2) == '\x1f\x8b'
 
-    finfo = []
-    iline = -1  # index of the query/seq that we're currently reading in the fasta
-    n_fasta_queries = 0  # number of queries so far added to <finfo> (I guess I could just use len(finfo) at this point)
-    missing_queries = set(queries) if queries is not None else None
-    already_printed_forbidden_character_warning = False
-    with open(fname) as fastafile:
-        startpos = None
-        while True:
-            if startpos is not None:  # rewind since the last time through we had to look to see when the next header line appeared
-                fastafile.seek(startpos)
-            headline = fastafile.readline()
-            if not headline:
-                break
-            if headline.strip() == '':  # skip a blank line
-                headline = fastafile.readline()
-
-            if ftype == 'fa':
-                if headline[0] != '>':
-                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('>')
-
-                seqlines = []
-                nextline = fastafile.readline()
-                while True:
-                    if not nextline:
-                        break
-                    if nextline[0] == '>':
-                        break
-                    else:
-                        startpos = fastafile.tell()  # i.e. very line that doesn't begin with '>' increments <startpos>
-                    seqlines.append(nextline)
-                    nextline = fastafile.readline()
-                seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
-            elif ftype == 'fq':
+# ----------------------------------------------------------------------------------------
+def open_fastx_file(fname):  # open <fname> for reading, transparently handling gzip/bgzip compression
+    if is_gzipped(fname):
+        import gzip
+        return gzip.open(fname, 'rb')
+    else:
+        return open(fname, 'rb')
+
+# ----------------------------------------------------------------------------------------
+def get_fastx_ftype(fname):
+    suffix = getsuffix(fname)
+    if suffix == '.gz':  # e.g. .fa.gz
+        suffix = getsuffix(fname[ : -len(suffix)])
+    if suffix == '.fa' or suffix == '.fasta':
+        return 'fa'
+    elif suffix == '.fq' or suffix == '.fastq':
+        return 'fq'
+    elif suffix == '.fastx':  # have to look at the first character
+        with open_fastx_file(fname) as fastxfile:
+            firstchar = fastxfile.read(1024).lstrip()[:1]
+        if firstchar in ['>', '@']:
+            return {'>' : 'fa', '@' : 'fq'}[firstchar]
+    raise Exception('unhandled file type: %s' % suffix)
+
+# ----------------------------------------------------------------------------------------
+def iter_fastx_blocks(fastxfile, n_bytes=None, blocksize=2**20):  # read big blocks (which is much faster than readline(), and never seeks), stopping after <n_bytes> if it's set
+    n_read = 0
+    while n_bytes is None or n_read < n_bytes:
+        block = fastxfile.read(blocksize if n_bytes is None else min(blocksize, n_bytes - n_read))
+        if not block:
+            break
+        n_read += len(block)
+        yield block
+
+# ----------------------------------------------------------------------------------------
+def iter_fastx_lines(fastxfile, n_bytes=None, blocksize=2**20):  # yield lists of complete lines (without newlines) from each block
+    leftover = ''
+    for block in iter_fastx_blocks(fastxfile, n_bytes=n_bytes, blocksize=blocksize):
+        lines = (leftover + block).split('\n')
+        leftover = lines.pop()
+        yield lines
+    if leftover != '':
+        yield [leftover]
+
+# ----------------------------------------------------------------------------------------
+def iter_fastx_records(fname, fastxfile, ftype, n_bytes=None, blocksize=2**20):  # yield (header line, sequence) for each record in <fastxfile> (header includes the newline, for backwards compatibility)
+    if ftype == 'fa':  # split each block on '\n>', keeping the last (maybe incomplete) record for the next block
+        leftover = '\n'  # so the first header also looks like '\n>'
+        blocks = iter_fastx_blocks(fastxfile, n_bytes=n_bytes, blocksize=blocksize)
+        while leftover is not None:
+            block = next(blocks, None)
+            if block is None:  # end of file, so whatever's left is complete
+                pieces, leftover = leftover.split('\n>'), None
+            else:
+                pieces = (leftover + block).split('\n>')
+                if len(pieces) == 1:  # no record boundaries yet
+                    leftover = pieces[0]
+                    continue
+                leftover = '\n>' + pieces.pop()
+            if pieces[0].strip() != '':  # this is whatever was before the first header in the file (after that, it's always empty)
+                raise Exception('invalid fasta header line in %s:\n    %s' % (fname, pieces[0].strip().split('\n')[0]))
+            for record in pieces[1 : ]:
+                headline, _, seqstr = record.partition('\n')
+                if ' ' in seqstr or '\r' in seqstr or '\t' in seqstr:  # strip each line (slower)
+                    yield headline.lstrip('>') + '\n', ''.join(l.strip() for l in seqstr.split('\n'))
+                else:
+                    yield headline.lstrip('>') + '\n', seqstr.replace('\n', '')
+    elif ftype == 'fq':  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
+        pending = []  # lines from the end of the previous block that weren't a complete record
+        for lines in iter_fastx_lines(fastxfile, n_bytes=n_bytes, blocksize=blocksize):
+            if len(pending) > 0:
+                lines = pending + lines
+            iline, n_lines = 0, len(lines)
+            while True:
+                while iline < n_lines and (lines[iline] == '' or lines[iline].isspace()):  # skip blank lines
+                    iline += 1
+                if iline + 4 > n_lines:
+                    break
+                headline, seqline, plusline = lines[iline], lines[iline + 1], lines[iline + 2]
                 if headline[0] != '@':
                     raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('@')
-
-                seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
-                plusline = fastafile.readline().strip()
-                if plusline[0] != '+':
+                if plusline.strip()[:1] != '+':
                     raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
-                qualityline = fastafile.readline()
-            else:
-                raise Exception('unhandled ftype %s' % ftype)
+                yield headline.lstrip('@') + '\n', seqline.strip()
+                iline += 4
+            pending = lines[iline : ]
+        if len(pending) > 0:  # incomplete record at end of file
+            if pending[0][0] != '@':
+                raise Exception('invalid fastq header line in %s:\n    %s' % (fname, pending[0]))
+            yield pending[0].lstrip('@') + '\n', pending[1].strip() if len(pending) > 1 else ''
+    else:
+        raise Exception('unhandled ftype %s' % ftype)
 
-            if not seqline:
-                break
+# ----------------------------------------------------------------------------------------
+def index_fastx(fname, ftype=None, blocksize=2**20):
+    """
+    Return a numpy array with the byte offset of the start of each record in (uncompressed) fasta/fastq file <fname>, with the file size appended at the end (so record i is in [offsets[i], offsets[i+1])).
+    This is one fast pass through the file (no parsing of the records), after which you can read any subset of records with iter_fastx(..., irecords=, offsets=).
+    """
+    if ftype is None:
+        ftype = get_fastx_ftype(fname)
+    if is_gzipped(fname):
+        raise Exception('can\'t index gzipped file %s (decompress it first)' % fname)
+    offsets = []
+    with open(fname, 'rb') as fastxfile:
+        if ftype == 'fa':  # record starts are exactly the '>' characters at the start of a line
+            blockstart, prevchar = 0, '\n'
+            while True:
+                block = fastxfile.read(blocksize)
+                if not block:
+                    break
+                if block[0] == '>' and prevchar == '\n':
+                    offsets.append(blockstart)
+                ipos = block.find('\n>')
+                while ipos >= 0:
+                    offsets.append(blockstart + ipos + 1)
+                    ipos = block.find('\n>', ipos + 1)
+                blockstart += len(block)
+                prevchar = block[-1]
+        elif ftype == 'fq':  # have to count lines, since '@' can be the first character in a quality line
+            offset, n_record_lines = 0, 0
+            for lines in iter_fastx_lines(fastxfile, blocksize=blocksize):
+                for line in lines:
+                    if n_record_lines > 0 or not (line == '' or line.isspace()):  # skip blank lines between records
+                        if n_record_lines == 0:
+                            offsets.append(offset)
+                        n_record_lines = (n_record_lines + 1) % 4
+                    offset += len(line) + 1
+        else:
+            raise Exception('unhandled ftype %s' % ftype)
+    offsets.append(os.path.getsize(fname))
+    return numpy.array(offsets, dtype=numpy.int64)
 
-            iline += 1
+# ----------------------------------------------------------------------------------------
+def iter_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, irecords=None, offsets=None):
+    """
+    Generator version of read_fastx(), yielding one seqfo at a time.
+    If <irecords> is set, only read those records (in that order), seeking directly to each of them with byte offsets <offsets> from index_fastx() (which we make if it isn't passed in).
+    """
+    if ftype is None:
+        ftype = get_fastx_ftype(fname)
+
+    missing_queries = set(queries) if queries is not None else None
+    already_printed_forbidden_character_warning = False
+    n_fasta_queries = 0  # number of queries so far yielded
+    with open_fastx_file(fname) as fastxfile:
+        if irecords is None:
+            records = iter_fastx_records(fname, fastxfile, ftype)
+        else:
+            if offsets is None:
+                offsets = index_fastx(fname, ftype=ftype)
+            def read_records():  # seek to the start of each run of consecutive records, and read the whole run at once
+                irecs = list(irecords)
+                istart = 0
+                while istart < len(irecs):
+                    iend = istart + 1
+                    while iend < len(irecs) and irecs[iend] == irecs[iend - 1] + 1:
+                        iend += 1
+                    fastxfile.seek(int(offsets[irecs[istart]]))
+                    for record in iter_fastx_records(fname, fastxfile, ftype, n_bytes=int(offsets[irecs[iend - 1] + 1] - offsets[irecs[istart]])):
+                        yield record
+                    istart = iend
+            records = read_records()
+        for iline, (headline, seqline) in enumerate(records):  # <iline> is index of the query/seq that we're currently reading in the fasta
+            if seqline == '':  # for backwards compatibility, stop at the first empty sequence
+                break
             if istartstop is not None:
                 if iline < istartstop[0]:
                     continue
                 elif iline >= istartstop[1]:
-                    continue
+                    break
 
             if dont_split_infostrs:  # if this is set, we let the calling fcn handle all the infostr parsing (e.g. for imgt germline fasta files)
                 infostrs = headline
@@ -4174,6 +4768,9 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
                     infostrs = [s1.split('=') for s1 in headline.strip().split(';')]
                     uid = infostrs[0][0]
                     infostrs = dict(s for s in infostrs if len(s) == 2)
+                elif ' ' not in headline and '\t' not in headline and '|' not in headline:  # nothing to split on (same result as the next line, but faster)
+                    infostrs = [headline.strip()]
+                    uid = infostrs[0]
                 else:
                     infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
                     uid = infostrs[0]
@@ -4188,10 +4785,10 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
                     continue
                 missing_queries.remove(uid)
 
-            seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
+            seqfo = {name_key : uid, seq_key : seqline.upper()}
             if add_info:
                 seqfo['infostrs'] = infostrs
-            finfo.append(seqfo)
+            yield seqfo
 
             n_fasta_queries += 1
             if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
@@ -4199,11 +4796,84 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
             if queries is not None and len(missing_queries) == 0:
                 break
 
+# ----------------------------------------------------------------------------------------
+def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):
+    kwargs = {'name_key' : name_key, 'seq_key' : seq_key, 'add_info' : add_info, 'dont_split_infostrs' : dont_split_infostrs, 'sanitize' : sanitize, 'ftype' : ftype}
+    if n_random_queries is not None and queries is None and n_max_queries <= 0 and not is_gzipped(fname):  # index the file, and then only parse the records we choose (we choose the same ones as the old way of reading everything and then choosing, i.e. numpy.random.choice(finfo, ...))
+        offsets = index_fastx(fname, ftype=ftype)
+        istart, istop = (0, len(offsets) - 1) if istartstop is None else (max(0, istartstop[0]), min(len(offsets) - 1, istartstop[1]))
+        irecords = istart + numpy.random.choice(max(0, istop - istart), n_random_queries, replace=False)
+        return list(iter_fastx(fname, irecords=irecords, offsets=offsets, **kwargs))
+
+    finfo = list(iter_fastx(fname, queries=queries, n_max_queries=n_max_queries, istartstop=istartstop, **kwargs))
     if n_random_queries is not None:
-        finfo = numpy.random.choice(finfo, n_random_queries, replace=False)
+        finfo = list(numpy.random.choice(finfo, n_random_queries, replace=False))
 
     return finfo
 
+# ----------------------------------------------------------------------------------------
+def get_fastx_index_fname(fname):
+    return fname + '.partis-index.npz'
+
+# ----------------------------------------------------------------------------------------
+def write_fastx_index(fname, ftype=None, index_fname=None, debug=False):
+    """
+    Make a sidecar index for (uncompressed) fasta/fastq file <fname>, write it to <index_fname> (if set), and return it (see read_fastx_index()).
+    The index has the byte offset of each record (from index_fastx()), each record's uid (as read_sequence_file() parses it, i.e. default header splitting plus sanitizing), the sorted uids
+    and their original indices (so we can look up uids with a binary search), and the file's size and modification time (so we can tell when it's out of date).
+    """
+    start = time.time()
+    if ftype is None:
+        ftype = get_fastx_ftype(fname)
+    fsize, mtime = os.path.getsize(fname), os.path.getmtime(fname)  # get these before reading, so if the file gets modified while we're reading it we'll notice next time
+    offsets = index_fastx(fname, ftype=ftype)
+    uids = [sfo['name'].translate(forbidden_character_translations) for sfo in iter_fastx(fname, add_info=False, ftype=ftype)]  # translate forbidden characters by hand, so we don't print the warning here (it'll get printed when we actually read the file)
+    offsets = offsets[ : len(uids) + 1]  # iter_fastx() stops at the first empty sequence, so we do too
+    uids = numpy.array(uids, dtype=numpy.string_)
+    isort = numpy.argsort(uids, kind='mergesort')
+    sorted_uids = uids[isort]
+    findex = {'offsets' : offsets, 'uids' : uids, 'sorted-uids' : sorted_uids, 'isort' : isort.astype(numpy.int64), 'n-duplicates' : int(numpy.sum(sorted_uids[1:] == sorted_uids[:-1])), 'fsize' : fsize, 'mtime' : mtime}
+    if index_fname is not None:
+        tmpfname = '%s.tmp-%d' % (index_fname, os.getpid())  # write to a temp file, then move it into place, so other processes never see a partially-written index
+        try:
+            with open(tmpfname, 'wb') as indexfile:  # pass a file object so numpy doesn't add another .npz suffix
+                numpy.savez(indexfile, **{k : numpy.array(v) for k, v in findex.items()})
+            os.rename(tmpfname, index_fname)
+        except (IOError, OSError) as err:
+            print '  %s couldn\'t write input file index %s (%s), so it\'ll be rebuilt next time' % (color('yellow', 'warning'), index_fname, err)
+            if os.path.exists(tmpfname):
+                os.remove(tmpfname)
+    if debug:
+        print '    indexed %d records in %s (%.1f sec)' % (len(uids), fname, time.time() - start)
+    return findex
+
+# ----------------------------------------------------------------------------------------
+def read_fastx_index(fname, ftype=None, debug=False):
+    """
+    Return the sidecar index for fasta/fastq file <fname> (see write_fastx_index()), reading it from disk if it exists and is up to date (in which case the arrays are memory mapped, so
+    looking up a few records is fast no matter how big the file is), and otherwise building it and writing it to disk for next time.
+    """
+    index_fname = get_fastx_index_fname(fname)
+    if os.path.exists(index_fname):
+        with numpy.load(index_fname) as npzfile:
+            findex = {k : npzfile[k].item() for k in ['n-duplicates', 'fsize', 'mtime']}
+        if findex['fsize'] == os.path.getsize(fname) and findex['mtime'] == os.path.getmtime(fname):
+            for key in ['offsets', 'uids', 'sorted-uids', 'isort']:
+                findex[key] = mmap_npz_array(index_fname, key)
+            return findex
+        if debug:
+            print '    input file index %s is out of date' % index_fname
+    return write_fastx_index(fname, ftype=ftype, index_fname=index_fname, debug=debug)
+
+# ----------------------------------------------------------------------------------------
+def lookup_fastx_index(findex, uids):  # return the (sorted) record indices of <uids> in index <findex> (uids that aren't in the file are ignored, and if there's duplicates we only return the first one)
+    uids = sorted(set(uids))
+    if len(uids) == 0 or len(findex['sorted-uids']) == 0:
+        return []
+    isorted = numpy.searchsorted(findex['sorted-uids'], numpy.array(uids, dtype=numpy.string_))
+    n_records = len(findex['sorted-uids'])
+    return sorted(int(findex['isort'][i]) for i, uid in zip(isorted, uids) if i < n_records and findex['sorted-uids'][i] == uid)
+
 # ----------------------------------------------------------------------------------------
 def output_exists(args, outfname, outlabel=None, offset=22, debug=True):
     outlabel = '' if outlabel is None else ('%s ' % outlabel)
@@ -4602,6 +5272,8 @@ def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=F
         write_csv_annotations(fname, headers, annotation_list, synth_single_seqs=synth_single_seqs, glfo=glfo, failed_queries=failed_queries)
     elif getsuffix(fname) == '.yaml':
         write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=use_pyyaml)
+    elif getsuffix(fname) == '.npz':
+        write_npz_output(fname, headers, glfo=glfo, annotation_list=annotation_list, failed_queries=failed_queries, partition_lines=partition_lines)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
@@ -4639,41 +5311,230 @@ def get_yamlfo_for_output(line, headers, glfo=None):
     return yamlfo
 
 # ----------------------------------------------------------------------------------------
-def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_single_seqs=False, failed_queries=None, partition_lines=None, use_pyyaml=False):
+def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_single_seqs=False, failed_queries=None, partition_lines=None, use_pyyaml=False):  # <annotation_list> can be any iterable (e.g. a generator), since we only go through it once
     if annotation_list is None:
         annotation_list = []
     if partition_lines is None:
         partition_lines = []
 
     version_info = {'partis-yaml' : 0.1}
-    yaml_annotations = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list]
+    yaml_annotations = (get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list)  # generator, so (with json) we only ever have one output line in memory at a time
     if failed_queries is not None:
-        yaml_annotations += failed_queries
-    yamldata = {'version-info' : version_info,
-                'germline-info' : glfo,
-                'partitions' : partition_lines,
-                'events' : yaml_annotations}
+        yaml_annotations = itertools.chain(yaml_annotations, failed_queries)
+    header_items = [('version-info', version_info), ('germline-info', glfo), ('partitions', partition_lines)]
     with open(fname, 'w') as yamlfile:
         if use_pyyaml:  # slower, but easier to read by hand for debugging (use this instead of the json version to make more human-readable files)
+            yamldata = dict(header_items + [('events', list(yaml_annotations))])
             yaml.dump(yamldata, yamlfile, width=400, Dumper=yaml.CDumper, default_flow_style=False, allow_unicode=False)  # set <allow_unicode> to false so the file isn't cluttered up with !!python.unicode stuff
         else:  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
-            json.dump(yamldata, yamlfile) #, sort_keys=True, indent=4)
+            # write the header info first (so stream_yaml_output() can get it without going through all the events), then write events one at a time (json.dumps() uses the c encoder, whereas json.dump() doesn't, so this is also faster than dumping everything at once)
+            yamlfile.write('{')
+            for key, val in header_items:
+                yamlfile.write('%s: %s, ' % (json.dumps(key), json.dumps(val)))
+            yamlfile.write('%s: [' % json.dumps('events'))
+            for ievent, yamlfo in enumerate(yaml_annotations):
+                yamlfile.write('%s%s' % (', ' if ievent > 0 else '', json.dumps(yamlfo)))
+            yamlfile.write(']}')
+
+# ----------------------------------------------------------------------------------------
+def get_npz_native_type(values):  # if all of <values> are the same sort of plain scalar (so they can go in a native numpy array), return that type, otherwise None
+    types = set(type(v) for v in values)
+    for ntypes in [(bool, ), (int, long), (float, ), (str, unicode)]:
+        if len(types) > 0 and types <= set(ntypes):
+            return ntypes[0]
+    return None
+
+# ----------------------------------------------------------------------------------------
+def write_npz_output(fname, headers, glfo=None, annotation_list=None, failed_queries=None, partition_lines=None):
+    """
+    Write annotations in columnar form to a (non-compressed) numpy .npz file, so readers that only need a few columns can load just those (see read_npz_columns()).
+    Each key in the output lines becomes one array: 'per-family:<key>' has one entry per event, while 'per-seq:<key>' is the concatenation over events of each event's per-sequence list, with
+    'seq-offsets' giving the index at which each event's sequences start (i.e. like an arrow list column).
+    Columns whose values are all plain numbers, bools, or strings get native numpy arrays (strings utf-8 encoded), which can be memory mapped; anything else (e.g. indelfos or per-gene support) is json-encoded, one string per entry.
+    Everything else (version, germline info, partitions, which columns are json, and which events are missing which keys) goes in 'metadata' as a json string.
+    """
+    if annotation_list is None:
+        annotation_list = []
+    if partition_lines is None:
+        partition_lines = []
+
+    yaml_annotations = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list]  # we need all the values for each key before we can make its column, so (unlike with yaml) we need them all at once
+    if failed_queries is not None:
+        yaml_annotations += failed_queries
+    seq_offsets = numpy.cumsum([0] + [len(l['unique_ids']) for l in yaml_annotations])
+    all_keys = sorted(set(k for l in yaml_annotations for k in l))
+    metadata = {'version-info' : {'partis-npz' : 0.1}, 'germline-info' : glfo, 'partitions' : partition_lines, 'n-events' : len(yaml_annotations), 'per-seq-keys' : [], 'json-columns' : [], 'missing' : {}}
+    columns = {'seq-offsets' : seq_offsets}
+    for key in all_keys:
+        ievents = [i for i, l in enumerate(yaml_annotations) if key in l]
+        per_seq = key in linekeys['per_seq'] and all(isinstance(yaml_annotations[i][key], list) and len(yaml_annotations[i][key]) == len(yaml_annotations[i]['unique_ids']) for i in ievents)
+        if per_seq:  # flatten, using <seq_offsets> to split back into events
+            metadata['per-seq-keys'].append(key)
+            values = [v for i in ievents for v in yaml_annotations[i][key]]
+        else:
+            values = [yaml_annotations[i][key] for i in ievents]
+        ntype = get_npz_native_type(values)
+        filler = None if ntype is None else {bool : False, int : 0, float : float('nan'), str : ''}[ntype]  # placeholder for events that don't have this key (e.g. failed queries)
+        if len(ievents) < len(yaml_annotations):
+            metadata['missing'][key] = sorted(set(range(len(yaml_annotations))) - set(ievents))
+            values = []
+            for line in yaml_annotations:
+                n_vals = len(line['unique_ids']) if per_seq else 1
+                if key in line:
+                    values += line[key] if per_seq else [line[key]]
+                else:
+                    values += [filler] * n_vals
+        if ntype is None:
+            metadata['json-columns'].append(key)
+            values = [json.dumps(v) for v in values]
+        if ntype in [None, str]:
+            values = numpy.array([v.encode('utf-8') if isinstance(v, unicode) else v for v in values], dtype=numpy.string_)
+        columns[('per-seq:' if per_seq else 'per-family:') + key] = numpy.array(values)
+    columns['metadata'] = numpy.array(json.dumps(metadata))
+    numpy.savez(fname, **columns)  # NOTE *not* savez_compressed, so columns can be memory mapped
+
+# ----------------------------------------------------------------------------------------
+yaml_header_keys = ['version-info', 'germline-info', 'partitions']  # top-level entries in yaml output files other than 'events' (which we write before the events, but older versions wrote 'partitions' after them)
+
+# ----------------------------------------------------------------------------------------
+def stream_yaml_output(fname, headerfo=None, skip_events=False, chunk_size=2**20):
+    """
+    Generator that yields the (raw) events from partis yaml output file <fname> one at a time, so you don't have to have the whole file in memory.
+    Any other top-level entries (version-info, germline-info, partitions) are added to <headerfo> (if it isn't None) as they're encountered. Note that in files written by older versions 'partitions' comes *after* 'events', so it'll only be there once you've gone through all the events.
+    If <skip_events> is set, events are parsed but thrown away, i.e. nothing is yielded (this is how to get just the header info).
+    Only json-style files are streamed: files written with <use_pyyaml> set are read all at once, since they're slow anyway and you should only be using them for small files.
+    """
+    if headerfo is None:
+        headerfo = {}
+    decoder = json.JSONDecoder()
+    with open(fname) as yamlfile:
+        bufo = {'buf' : '', 'pos' : 0, 'eof' : False}
+
+        # ----------------------------------------------------------------------------------------
+        def fill():  # read more of the file, dropping the part of the buffer that we've already parsed (we read at least as much as is already pending, so a really big value doesn't get re-parsed a huge number of times)
+            chunk = yamlfile.read(max(chunk_size, len(bufo['buf']) - bufo['pos']))
+            bufo['buf'] = bufo['buf'][bufo['pos'] : ] + chunk
+            bufo['pos'] = 0
+            bufo['eof'] = len(chunk) == 0
+
+        # ----------------------------------------------------------------------------------------
+        def next_char(consume=False):  # skip whitespace and return the next character (or '' at end of file)
+            while True:
+                while bufo['pos'] < len(bufo['buf']) and bufo['buf'][bufo['pos']] in string.whitespace:
+                    bufo['pos'] += 1
+                if bufo['pos'] < len(bufo['buf']) or bufo['eof']:
+                    break
+                fill()
+            char = bufo['buf'][bufo['pos'] : bufo['pos'] + 1]
+            if consume:
+                bufo['pos'] += len(char)
+            return char
+
+        # ----------------------------------------------------------------------------------------
+        def expect(chars):
+            char = next_char(consume=True)
+            if char not in chars:
+                raise Exception('expected one of \'%s\' but got \'%s\' at position %d in buffer while reading %s' % (chars, char, bufo['pos'], fname))
+            return char
+
+        # ----------------------------------------------------------------------------------------
+        def decode():  # decode the next json value (after skipping whitespace)
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(bufo['buf'], bufo['pos'])
+                    if end < len(bufo['buf']) or bufo['eof']:  # if it ran right up to the end of the buffer it could be a truncated number, so read more and try again
+                        bufo['pos'] = end
+                        return value
+                except ValueError:
+                    if bufo['eof']:
+                        raise
+                fill()
+
+        # ----------------------------------------------------------------------------------------
+        if next_char() != '{':  # not json, so it must've been written with pyyaml
+            yamlfile.seek(0)
+            yamlfo = yaml.load(yamlfile, Loader=yaml.CLoader)
+            headerfo.update((k, v) for k, v in yamlfo.items() if k != 'events')
+            if not skip_events:
+                for line in yamlfo['events']:
+                    yield line
+            return
+
+        expect('{')
+        while next_char() not in ['}', '']:
+            key = decode()
+            expect(':')
+            if key == 'events':
+                expect('[')
+                if next_char() == ']':
+                    expect(']')
+                else:
+                    while True:
+                        line = decode()
+                        if not skip_events:
+                            yield line
+                        if expect(',]') == ']':
+                            break
+            else:
+                headerfo[key] = decode()
+            if expect(',}') == '}':
+                break
+
+# ----------------------------------------------------------------------------------------
+def read_yaml_output_header(fname):  # everything but the events (parses the whole file, but only keeps one event at a time in memory)
+    headerfo = {}
+    for _ in stream_yaml_output(fname, headerfo=headerfo, skip_events=True):
+        pass
+    return headerfo
+
+# ----------------------------------------------------------------------------------------
+def fill_yaml_output_header(fname, headerfo):  # if <headerfo> (as filled by stream_yaml_output()) is missing any header keys, i.e. if they come after the events in <fname>, read the whole header (i.e. this does nothing for files that we write now, which have the header first)
+    if any(k not in headerfo for k in yaml_header_keys):
+        headerfo.update(read_yaml_output_header(fname))
+
+# ----------------------------------------------------------------------------------------
+def process_yaml_event(glfo, line, synth_single_seqs, dont_add_implicit_info):  # returns a list, since with <synth_single_seqs> one event can turn into several lines
+    if not line['invalid']:
+        transfer_indel_reversed_seqs(line)
+        if not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
+            add_implicit_info(glfo, line)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
+    if synth_single_seqs and len(line['unique_ids']) > 1:
+        return [synthesize_single_seq_line(line, iseq) for iseq in range(len(line['unique_ids']))]
+    else:
+        return [line]
+
+# ----------------------------------------------------------------------------------------
+def iter_yaml_annotations(fname, glfo=None, headerfo=None, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False):
+    """
+    Generator version of parse_yaml_annotations() that reads <fname> one event at a time, and stops parsing events once it's read <n_max_queries>.
+    If <glfo> isn't set we use the germline info from the file. If <headerfo> is set, we fill it with the file's top-level non-event info (see stream_yaml_output()). This is complete by the time we yield the first
+    event (and if there aren't any events, once we've finished), so the caller can stop iterating whenever it wants. For files with the header after the events (i.e. written by older versions), this means we have to parse through the
+    rest of the file when we get to the first event (see fill_yaml_output_header()).
+    """
+    want_header = headerfo is not None
+    if headerfo is None:
+        headerfo = {}
+    n_queries_read = 0
+    for line in stream_yaml_output(fname, headerfo=headerfo):
+        if n_queries_read == 0 and want_header:
+            fill_yaml_output_header(fname, headerfo)
+        if glfo is None and not dont_add_implicit_info:
+            if 'germline-info' not in headerfo:  # germline info is after the events in the file (shouldn't happen with files we write), so we have to read it separately
+                headerfo.update(read_yaml_output_header(fname))
+            glfo = headerfo['germline-info']
+        for outline in process_yaml_event(glfo, line, synth_single_seqs, dont_add_implicit_info):
+            yield outline
+        n_queries_read += len(line['unique_ids'])
+        if n_max_queries > 0 and n_queries_read >= n_max_queries:
+            break
 
 # ----------------------------------------------------------------------------------------
 def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info):
     annotation_list = []
     n_queries_read = 0
     for line in yamlfo['events']:
-        if not line['invalid']:
-            transfer_indel_reversed_seqs(line)
-            if not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
-                add_implicit_info(glfo, line)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
-        if synth_single_seqs and len(line['unique_ids']) > 1:
-            for iseq in range(len(line['unique_ids'])):
-                annotation_list.append(synthesize_single_seq_line(line, iseq))
-        else:
-            annotation_list.append(line)
-
+        annotation_list += process_yaml_event(glfo, line, synth_single_seqs, dont_add_implicit_info)
         n_queries_read += len(line['unique_ids'])
         if n_max_queries > 0 and n_queries_read >= n_max_queries:
             break
@@ -4709,6 +5570,9 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
     elif getsuffix(fname) == '.yaml':  # NOTE this replaces any <glfo> that was passed (well, only within the local name table of this fcn, unless the calling fcn replaces it themselves, since we return this glfo)
         glfo, annotation_list, cpath = read_yaml_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs,
                                                         dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
+    elif getsuffix(fname) == '.npz':  # same deal with <glfo> as for yaml
+        glfo, annotation_list, cpath = read_npz_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs,
+                                                       dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
@@ -4716,22 +5580,18 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
 
 # ----------------------------------------------------------------------------------------
 def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):
-    with open(fname) as yamlfile:
-        try:
-            yamlfo = json.load(yamlfile)  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
-        except ValueError:  # I wish i could think of a better way to do this, but I can't
-            yamlfile.seek(0)
-            yamlfo = yaml.load(yamlfile, Loader=yaml.CLoader)  # use this instead of the json version to make more human-readable files
-        if debug:
-            print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
-
-    glfo = yamlfo['germline-info']  # it would probably be good to run the glfo through the checks that glutils.read_glfo() does, but on the other hand since we're reading from our own yaml file, those have almost certainly already been done
-
+    headerfo = {}
     annotation_list = None
-    if not skip_annotations:  # may not really be worthwhile, but oh well
-        annotation_list = parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info)
+    if skip_annotations:  # may not really be worthwhile, but oh well
+        headerfo = read_yaml_output_header(fname)
+    else:  # we read one event at a time, so the only annotations in memory are the ones we keep
+        annotation_list = list(iter_yaml_annotations(fname, headerfo=headerfo, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs, dont_add_implicit_info=dont_add_implicit_info))
+    if debug:
+        print '  read yaml version %s from %s' % (headerfo['version-info']['partis-yaml'], fname)
 
-    partition_lines = yamlfo['partitions']
+    glfo = headerfo['germline-info']  # it would probably be good to run the glfo through the checks that glutils.read_glfo() does, but on the other hand since we're reading from our own yaml file, those have almost certainly already been done
+
+    partition_lines = headerfo['partitions']
     if cpath is None:   # allowing the caller to pass in <cpath> is kind of awkward, but it's used for backward compatibility in clusterpath.readfile()
         cpath = clusterpath.ClusterPath(seed_unique_id=seed_unique_id)  # NOTE I'm not sure if I really want to pass in the seed here -- it should be stored in the file -- but if it's in both places it should be the same. um, should.
     if len(partition_lines) > 0:  # *don't* combine this with the cluster path constructor, since then we won't modify the path passed in the arguments
@@ -4739,6 +5599,86 @@ def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_
 
     return glfo, annotation_list, cpath
 
+# ----------------------------------------------------------------------------------------
+def mmap_npz_array(fname, name):  # memory map array <name> from uncompressed .npz file <fname> (returns None if it can't be mapped, e.g. if it was compressed)
+    import zipfile
+    import struct
+    with zipfile.ZipFile(fname) as zfile:
+        zinfo = zfile.getinfo(name + '.npy')
+    if zinfo.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(fname, 'rb') as npzfile:
+        npzfile.seek(zinfo.header_offset)
+        local_header = npzfile.read(30)  # fixed-size part of the zip local file header, which is followed by the file name and extra field
+        name_len, extra_len = struct.unpack('<HH', local_header[26 : 30])
+        npzfile.seek(zinfo.header_offset + 30 + name_len + extra_len)
+        version = numpy.lib.format.read_magic(npzfile)
+        read_header = numpy.lib.format.read_array_header_1_0 if version == (1, 0) else numpy.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(npzfile)
+        offset = npzfile.tell()
+    if dtype.hasobject:
+        return None
+    return numpy.memmap(fname, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran_order else 'C')
+
+# ----------------------------------------------------------------------------------------
+def read_npz_columns(fname, keys=None, mmap=False):
+    """
+    Read metadata and the columns for <keys> (all of them if None) from .npz output file <fname> (see write_npz_output()), without loading any other columns.
+    Returns (metadata, seq_offsets, columns), where <columns> is keyed by line key (without the per-family/per-seq prefix): per-family columns have one entry per event, and per-seq columns
+    are flat, so the values for event i are in [seq_offsets[i] : seq_offsets[i+1]]. Native numeric columns are returned as numpy arrays (memory mapped if <mmap> is set), while string and json columns are decoded to lists.
+    """
+    with numpy.load(fname) as npzfile:
+        metadata = json.loads(npzfile['metadata'].item())
+        seq_offsets = npzfile['seq-offsets']
+        columns = {}
+        for name in npzfile.files:
+            if ':' not in name:
+                continue
+            key = name.split(':', 1)[1]
+            if keys is not None and key not in keys:
+                continue
+            column = mmap_npz_array(fname, name) if mmap else None
+            if column is None:
+                column = npzfile[name]
+            if key in metadata['json-columns']:
+                column = [json.loads(v) for v in column.tolist()]
+            elif column.dtype.kind == 'S':
+                column = [v.decode('utf-8') for v in column.tolist()]
+            columns[key] = column
+    return metadata, seq_offsets, columns
+
+# ----------------------------------------------------------------------------------------
+def read_npz_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):  # same as read_yaml_output(), but for columnar .npz files
+    metadata, seq_offsets, columns = read_npz_columns(fname, keys=[] if skip_annotations else None)
+    if debug:
+        print '  read npz version %s from %s' % (metadata['version-info']['partis-npz'], fname)
+    glfo = metadata['germline-info']
+
+    annotation_list = None
+    if not skip_annotations:
+        per_seq_keys = set(metadata['per-seq-keys'])
+        missing = {k : set(ievents) for k, ievents in metadata['missing'].items()}
+        annotation_list = []
+        n_queries_read = 0
+        for ievent in range(metadata['n-events']):
+            line = {}
+            for key, column in columns.items():
+                if key in missing and ievent in missing[key]:
+                    continue
+                value = column[seq_offsets[ievent] : seq_offsets[ievent + 1]] if key in per_seq_keys else column[ievent]
+                line[key] = value.tolist() if isinstance(value, (numpy.ndarray, numpy.generic)) else value  # convert numpy types back to python ones
+            annotation_list += process_yaml_event(glfo, line, synth_single_seqs, dont_add_implicit_info)
+            n_queries_read += len(line['unique_ids'])
+            if n_max_queries > 0 and n_queries_read >= n_max_queries:
+                break
+
+    if cpath is None:
+        cpath = clusterpath.ClusterPath(seed_unique_id=seed_unique_id)
+    if len(metadata['partitions']) > 0:
+        cpath.readlines(metadata['partitions'])
+
+    return glfo, annotation_list, cpath
+
 # ----------------------------------------------------------------------------------------
 def get_gene_counts_from_annotations(annotations, only_regions=None):
     gene_counts = {r : {} for r in (only_regions if only_regions is not None else regions)}
@@ -11,6 +11,10 @@ from collections import OrderedDict
 import csv
 import numpy
 import traceback
+import glob
+import hashlib
+import json
+import multiprocessing
 
 import utils
 import glutils
@@ -30,6 +34,12 @@ import seqfileopener
 # -: [...]
 # mfreq was I think the sequence-wide mfreq, but was close enough to the v value that it doesn't matter
 
+pool_waterer = None  # the Waterer for read_output() pool processes, which they inherit when they're forked (so we don't have to pickle it for each sam file)
+
+# ----------------------------------------------------------------------------------------
+def read_sam_file_proc(samfname):
+    return pool_waterer.read_sam_file(samfname)
+
 # ----------------------------------------------------------------------------------------
 class Waterer(object):
     """ Run smith-waterman on the query sequences in <infname> """
@@ -77,9 +87,15 @@ class Waterer(object):
         self.remaining_queries = set(self.input_info) - self.info['failed-queries']  # we remove queries from this set when we're satisfied with the current output (in general we may have to rerun some queries with different match/mismatch scores)
         self.vs_indels = set()
         self.indel_reruns = set()  # queries that either failed during indel handling, or had successful indel handling: in both cases we rerun them, with a super large gap open to prevent further indels
+        self.query_scores = {}  # with --batched-sw, the mismatch and gap open for each query that we're about to run (which we pass to ig-sw in the fasta header)
 
         self.skipped_unproductive_queries, self.kept_unproductive_queries = set(), set()
 
+        self.seq_cache_dir = None  # per-sequence cache dir (see read_seq_cache())
+        self.seq_cache_hits = set()  # queries whose sw info we got from the per-sequence cache
+        if self.args.sw_seq_cache_dir is not None:
+            self.seq_cache_dir = self.args.sw_seq_cache_dir + '/' + self.get_seq_cache_fingerprint()
+
         self.my_gldir = self.args.workdir + '/sw-' + glutils.glfo_dir
         glutils.write_glfo(self.my_gldir, self.glfo)  # NOTE gets overwritten by read_cachefile()
 
@@ -92,11 +108,19 @@ class Waterer(object):
         base_infname = 'query-seqs.fa'
         base_outfname = 'query-seqs.sam'
 
+        if self.seq_cache_dir is not None:
+            self.read_seq_cache()
+
         if self.vs_info is not None:  # if we're reading a cache file, we should make sure to read the exact same info from there
             self.add_vs_indels()
 
         itry = 0
-        while True:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences
+        processing_start = time.time()
+        self.ig_sw_time = 0.
+        if self.args.pipelined_sw and len(self.remaining_queries) > 0:
+            self.run_pipelined(base_infname, base_outfname)
+            processing_start = time.time()
+        while not self.args.pipelined_sw and len(self.remaining_queries) > 0:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences (the check on remaining queries is for when they were all in the per-sequence cache)
             mismatches, gap_opens, queries_for_each_proc = self.split_queries(self.args.n_procs)  # NOTE can tell us to run more than <self.args.n_procs> (we run at least one proc for each different mismatch score)
             self.write_input_files(base_infname, queries_for_each_proc)
 
@@ -111,9 +135,68 @@ class Waterer(object):
                 break
             itry += 1
 
+        if self.seq_cache_dir is not None:
+            self.write_seq_cache()
         self.finalize(cachefname)
         print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, time.time() - processing_start, self.ig_sw_time)
 
+    # ----------------------------------------------------------------------------------------
+    def run_pipelined(self, base_infname, base_outfname):
+        """
+        Same as the loop in run(), except that rather than waiting for all the ig-sw procs to finish before reading any of their output, we read (and summarize) each proc's output as soon as it finishes, and immediately start a new
+        proc for any of its queries that need an indel rerun (so alignment and processing overlap, and the reruns don't wait for the slowest proc).
+        Also unlike run(), we only rerun the queries that need an indel rerun, rather than all the remaining queries (the others would just fail again in the same way).
+        """
+        start = time.time()
+        tasks, pending = [], []  # all the procs that we've started, and (queries, mismatch, gap open, itry) for ones that we haven't started yet
+        queries_not_read = set()
+        processing_time = 0.
+        def launch(islot):  # start a proc for the next pending set of queries (if there is one)
+            if len(pending) == 0:
+                return None
+            queries, mismatch, gap_open, itry = pending.pop(0)
+            workdir = '%s/sw-%d' % (self.args.workdir, len(tasks))
+            utils.prep_dir(workdir)
+            self.write_input_file(workdir + '/' + base_infname, queries)
+            task = {'itask' : len(tasks), 'queries' : queries, 'mismatch' : mismatch, 'itry' : itry, 'workdir' : workdir,
+                    'cmdfo' : {'cmd_str' : self.get_ig_sw_cmd_str(workdir, base_infname, base_outfname, mismatch, gap_open), 'workdir' : workdir, 'logdir' : workdir, 'outfname' : workdir + '/' + base_outfname, 'dbgfo' : {}}}
+            tasks.append(task)  # we start them in the order that we call this, so each task's index in <tasks> is also its index in utils.iter_finished_cmds()
+            if self.debug:
+                print '        starting proc %d (try %d) with %d seq%s' % (task['itask'], itry, len(queries), utils.plural(len(queries)))
+            return task['cmdfo']
+
+        mismatches, gap_opens, queries_for_each_proc = self.split_queries(self.args.n_procs)  # NOTE can tell us to run more than <self.args.n_procs> (we run at least one proc for each different mismatch score)
+        print '    running %d proc%s for %d seq%s (pipelined)' % (len(mismatches), utils.plural(len(mismatches)), len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
+        sys.stdout.flush()
+        pending += [(queries, mismatch, gap_open, 0) for mismatch, gap_open, queries in zip(mismatches, gap_opens, queries_for_each_proc)]
+
+        for itask, _ in utils.iter_finished_cmds(launch, batch_system=self.args.batch_system, batch_options=self.args.batch_options):
+            task = tasks[itask]
+            os.remove(task['workdir'] + '/' + base_infname)
+
+            processing_start = time.time()
+            queries_read = set(qname for qname, _, _, _, _ in self.read_sam_file(task['cmdfo']['outfname']))
+            queries_not_read |= (set(task['queries']) - queries_read) & self.remaining_queries
+            os.remove(task['cmdfo']['outfname'])
+            os.rmdir(task['workdir'])
+            rerun_queries = [q for q in task['queries'] if q in self.indel_reruns]
+            self.indel_reruns -= set(rerun_queries)
+            processing_time += time.time() - processing_start
+
+            if self.debug:
+                print '        finished proc %d: %d / %d passed%s' % (task['itask'], len([q for q in task['queries'] if q in self.info['passed-queries']]), len(task['queries']), ('  (%d indel reruns)' % len(rerun_queries)) if len(rerun_queries) > 0 else '')
+            if len(rerun_queries) > 0 and task['itry'] < 2:  # same max number of tries as run()
+                if self.args.batched_sw:
+                    self.query_scores.update({q : (self.query_scores[q][0], self.args.no_indel_gap_open_penalty) for q in rerun_queries})
+                pending.append((rerun_queries, task['mismatch'], self.args.no_indel_gap_open_penalty, task['itry'] + 1))
+
+        if len(queries_not_read) > 0:  # see read_output()
+            print '\n%s didn\'t read %s from %s' % (utils.color('red', 'warning'), ' '.join(queries_not_read), self.args.workdir)
+        n_reruns = len([t for t in tasks if t['itry'] > 0])
+        print '        ran %d proc%s (%d for indel reruns) in %.1f sec, of which %.1f was processing output' % (len(tasks), utils.plural(len(tasks)), n_reruns, time.time() - start, processing_time)
+        sys.stdout.flush()
+        self.ig_sw_time = time.time() - start - processing_time
+
     # ----------------------------------------------------------------------------------------
     def clean_cache(self, cache_path):
         for suffix in ['.csv', '.yaml']:
@@ -124,6 +207,68 @@ class Waterer(object):
             print '  removing old sw cache glfo %s-glfo' % cache_path
             glutils.remove_glfo_files(cache_path + '-glfo', self.args.locus)
 
+    # ----------------------------------------------------------------------------------------
+    def get_seq_cache_fingerprint(self):  # hash of everything other than the query sequence that goes into a query's sw info (germline set, alignment parameters, and args that affect how we process the ig-sw output)
+        fpinfo = {'locus' : self.glfo['locus'],
+                  'seqs' : {r : sorted(self.glfo['seqs'][r].items()) for r in utils.regions},
+                  'codon-positions' : {c : sorted(self.glfo[c + '-positions'].items()) for c in utils.conserved_codons[self.glfo['locus']].values()},
+                  'match' : self.match_score, 'mismatch' : self.mismatch if self.vs_info is None else self.mfreq_mismatch_vals, 'default-mfreq' : None if self.vs_info is None else self.default_mfreq,
+                  'args' : [getattr(self.args, a) for a in ['gap_open_penalty', 'no_indel_gap_open_penalty', 'n_max_per_region', 'max_vj_mut_freq', 'skip_unproductive', 'no_indels']]}
+        return hashlib.md5(json.dumps(fpinfo, sort_keys=True)).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def get_seq_cache_key(self, seq):
+        return hashlib.md5(seq).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def read_seq_cache(self):
+        """
+        Look for each remaining query's sequence in the per-sequence cache (--sw-seq-cache-dir), and add any hits to self.info, so that only the misses get run through ig-sw.
+        The cache is a dir for each fingerprint (see get_seq_cache_fingerprint()), each of which has a yaml file for each run that added something. Since each run only adds a new file, runs on different samples can share the cache.
+        """
+        if not os.path.exists(self.seq_cache_dir):
+            return
+        start = time.time()
+        queries_for_each_key = {}
+        for query in self.remaining_queries:
+            queries_for_each_key.setdefault(self.get_seq_cache_key(self.input_info[query]['seqs'][0]), []).append(query)
+        n_queries = len(self.remaining_queries)
+        cachefnames = glob.glob(self.seq_cache_dir + '/*.yaml')
+        for cachefname in cachefnames:
+            for line in utils.iter_yaml_annotations(cachefname, glfo=self.glfo, dont_add_implicit_info=True):
+                queries = queries_for_each_key.pop(self.get_seq_cache_key(line['input_seqs'][0]), [])  # pop() so if the seq is in more than one cache file we only use the first one
+                for iq, query in enumerate(queries):
+                    qline = line if iq == len(queries) - 1 else copy.deepcopy(line)
+                    qline['unique_ids'] = [query]
+                    qline['duplicates'] = [[]]  # duplicates are per-sample, so we (re)find them in finalize()
+                    utils.add_implicit_info(self.glfo, qline, aligned_gl_seqs=self.aligned_gl_seqs)
+                    if indelutils.has_indels(qline['indelfos'][0]):
+                        self.info['indels'][query] = qline['indelfos'][0]
+                    self.add_to_info(qline)
+                    self.seq_cache_hits.add(query)
+                if len(queries_for_each_key) == 0:
+                    break
+            if len(queries_for_each_key) == 0:
+                break
+        print '        read %d / %d queries from sw sequence cache %s (%d file%s, %.1f sec)' % (len(self.seq_cache_hits), n_queries, self.seq_cache_dir, len(cachefnames), utils.plural(len(cachefnames)), time.time() - start)
+
+    # ----------------------------------------------------------------------------------------
+    def write_seq_cache(self):  # add the queries we just ran through ig-sw to the per-sequence cache (NOTE does *not* write failed or skipped unproductive queries, so they get rerun every time)
+        lines, keys = [], set()
+        for query in [q for q in self.input_info if q in self.info['passed-queries'] and q not in self.seq_cache_hits]:
+            key = self.get_seq_cache_key(self.input_info[query]['seqs'][0])
+            if key not in keys:  # identical sequences only need one entry
+                lines.append(self.info[query])
+                keys.add(key)
+        if len(lines) == 0:
+            return
+        if not os.path.exists(self.seq_cache_dir):
+            os.makedirs(self.seq_cache_dir)
+        cachefname = '%s/%s.yaml' % (self.seq_cache_dir, hashlib.md5(''.join(sorted(keys))).hexdigest())
+        print '        writing %d new sequence%s to sw sequence cache %s' % (len(lines), utils.plural(len(lines)), cachefname)
+        utils.write_yaml_output(cachefname + '.tmp', utils.sw_cache_headers, glfo=self.glfo, annotation_list=lines)  # write and then rename, so other runs reading the cache never see a partial file
+        os.rename(cachefname + '.tmp', cachefname)
+
     # ----------------------------------------------------------------------------------------
     def read_cachefile(self, cachefname):
         start = time.time()
@@ -301,21 +446,20 @@ class Waterer(object):
         self.ig_sw_time = time.time() - start
 
     # ----------------------------------------------------------------------------------------
-    def split_queries_by_match_mismatch(self, input_queries, n_procs, debug=False):
-        def get_query_mfreq(q):
-            return self.vs_info['annotations'][q]['v_mut_freq'] if q in self.vs_info['annotations'] else self.default_mfreq
-        def best_mismatch(q):
-            mfreq_q = self.vs_info['annotations'][q]['v_mut_freq'] if q in self.vs_info['annotations'] else self.default_mfreq
-            def keyfunc(pair):
-                mf, mm = pair
-                return abs(mf - mfreq_q)
-            nearest_mfreq, nearest_mismatch = min(self.mfreq_mismatch_vals, key=keyfunc)  # take the optimized value whose mfreq is closest to this sequence's mfreq
-            return nearest_mismatch
+    def best_mismatch(self, q):
+        mfreq_q = self.vs_info['annotations'][q]['v_mut_freq'] if q in self.vs_info['annotations'] else self.default_mfreq
+        def keyfunc(pair):
+            mf, mm = pair
+            return abs(mf - mfreq_q)
+        nearest_mfreq, nearest_mismatch = min(self.mfreq_mismatch_vals, key=keyfunc)  # take the optimized value whose mfreq is closest to this sequence's mfreq
+        return nearest_mismatch
 
-        query_groups = utils.group_seqs_by_value(input_queries, best_mismatch)
-        mismatch_vals = [best_mismatch(queries[0]) for queries in query_groups]
+    # ----------------------------------------------------------------------------------------
+    def split_queries_by_match_mismatch(self, input_queries, n_procs, debug=False):
+        query_groups = utils.group_seqs_by_value(input_queries, self.best_mismatch)
+        mismatch_vals = [self.best_mismatch(queries[0]) for queries in query_groups]
 
-        # note: it'd be nice to be able to give ig-sw a different match:mismatch for each sequence (rather than running separate procs for each match:mismatch), but it initializes a matrix using the match:mismatch values before looping over sequences, so that's probably infeasible
+        # note: ig-sw initializes its scoring matrix from the command line match:mismatch, so here we run separate procs for each match:mismatch (but see --batched-sw and split_queries_batched(), which instead pass each sequence's scores in its fasta header)
 
         if debug:
             print 'start'
@@ -366,15 +510,33 @@ class Waterer(object):
 
         return mismatches, gap_opens, queries_for_each_proc
 
+    # ----------------------------------------------------------------------------------------
+    def split_queries_batched(self, input_queries, n_procs):  # run (at most) <n_procs> procs, and tell ig-sw each query's mismatch and gap open in its fasta header (rather than running at least one proc for each mismatch value, plus one for each mismatch value among the indel reruns)
+        self.query_scores = {}
+        for query in input_queries:
+            mismatch = self.mismatch if self.vs_info is None else self.best_mismatch(query)
+            gap_open = self.args.no_indel_gap_open_penalty if query in self.indel_reruns else self.gap_open_penalty
+            self.query_scores[query] = (mismatch, gap_open)
+        self.indel_reruns.clear()
+        input_queries = sorted(input_queries, key=lambda q: len(self.input_info[q]['seqs'][0]))  # sort by length before dealing them out, so each proc gets about the same number of bases
+        n_procs = min(n_procs, len(input_queries))
+        queries_for_each_proc = [input_queries[iproc : : n_procs] for iproc in range(n_procs)]
+        mismatches = [self.query_scores[queries[0]][0] for queries in queries_for_each_proc]  # these (and the gap opens) only go on the command line, where ig-sw uses them for any query whose header doesn't have its own
+        gap_opens = [self.gap_open_penalty for _ in mismatches]
+        return mismatches, gap_opens, queries_for_each_proc
+
     # ----------------------------------------------------------------------------------------
     def split_queries(self, n_procs):
         input_queries = list(self.remaining_queries)
-        if self.vs_info is None:
+        if self.args.batched_sw:
+            mismatches, gap_opens, queries_for_each_proc = self.split_queries_batched(input_queries, n_procs)
+        elif self.vs_info is None:
             mismatches, queries_for_each_proc = self.split_queries_evenly_among_procs(input_queries, n_procs)
         else:
             mismatches, queries_for_each_proc = self.split_queries_by_match_mismatch(input_queries, n_procs)
 
-        mismatches, gap_opens, queries_for_each_proc = self.get_gap_opens(mismatches, queries_for_each_proc)  # they're all the same unless we have some indel fails
+        if not self.args.batched_sw:
+            mismatches, gap_opens, queries_for_each_proc = self.get_gap_opens(mismatches, queries_for_each_proc)  # they're all the same unless we have some indel fails
 
         missing_queries = self.remaining_queries - set([q for proc_queries in queries_for_each_proc for q in proc_queries])
         if len(missing_queries) > 0:
@@ -389,14 +551,23 @@ class Waterer(object):
             workdir = self.subworkdir(iproc, n_procs)
             if n_procs > 1:
                 utils.prep_dir(workdir)
-            with open(workdir + '/' + base_infname, 'w') as sub_infile:
-                for query_name in queries_for_each_proc[iproc]:
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    else:
-                        assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
-                        seq = self.input_info[query_name]['seqs'][0]
-                    sub_infile.write('>%s NUKES\n%s\n' % (query_name, seq))
+            self.write_input_file(workdir + '/' + base_infname, queries_for_each_proc[iproc])
+
+    # ----------------------------------------------------------------------------------------
+    def write_input_file(self, infname, queries):
+        with open(infname, 'w') as sub_infile:
+            for query_name in queries:
+                if query_name in self.info['indels']:
+                    seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+                else:
+                    assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
+                    seq = self.input_info[query_name]['seqs'][0]
+                if self.args.batched_sw:
+                    mismatch, gap_open = self.query_scores[query_name]
+                    header = 'match=%d,mismatch=%d,gap-open=%d' % (self.match_score, mismatch, gap_open)  # ig-sw uses these instead of the command line values (see get_ig_sw_cmd_str())
+                else:
+                    header = 'NUKES'
+                sub_infile.write('>%s %s\n%s\n' % (query_name, header, seq))
 
     # # ----------------------------------------------------------------------------------------
     # def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, mismatch):
@@ -421,6 +592,8 @@ class Waterer(object):
         cmd_str += ' -d 50'  # max drop
         cmd_str += ' -m ' + str(self.match_score) + ' -u ' + str(mismatch)
         cmd_str += ' -o ' + str(gap_open)
+        if self.args.batched_sw:
+            cmd_str += ' --per-read-scores'  # each query's header has its own match/mismatch/gap open
         cmd_str += ' -p ' + self.my_gldir + '/' + self.args.locus + '/'  # NOTE needs the trailing slash
         cmd_str += ' ' + workdir + '/' + base_infname + ' ' + workdir + '/' + base_outfname
         return cmd_str
@@ -467,24 +640,41 @@ class Waterer(object):
     #     print '        time to rewrite same file: %.2f' % (time.time() - start)
 
     # ----------------------------------------------------------------------------------------
+    @utils.profiled_stage('waterer-read-output')
     def read_output(self, base_outfname, n_procs=1):
         if self.debug:
             print '%s' % utils.color('green', 'reading output')
 
         queries_read_from_file = set()  # should be able to remove this, eventually
-        for iproc in range(n_procs):
-            outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
-            # self.remove_length_discrepant_matches(outfname)
-            with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
-                grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    try:
-                        readlist = list(reads)
-                    except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
-                        raise Exception('failed to convert sam reads')
-                    qinfo = self.read_query(sam.references, readlist)
-                    self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
-                    queries_read_from_file.add(qinfo['name'])
+        samfnames = [self.subworkdir(iproc, n_procs) + '/' + base_outfname for iproc in range(n_procs)]
+        n_pool_procs = min(self.args.n_procs, len(samfnames), multiprocessing.cpu_count())
+        if n_pool_procs > 1 and self.debug:  # the debug printing would get all mixed up
+            n_pool_procs = 1
+        if n_pool_procs > 1 and multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, and each forked process can end up with its own copy of everything
+            print '    %s not using %d procs to read sw output since we\'re already using a lot of memory' % (utils.color('yellow', 'warning'), n_pool_procs)
+            n_pool_procs = 1
+        if n_pool_procs > 1:  # forked processes inherit <pool_waterer> (i.e. us), so all we send them is a sam file name, and all they send back is what summarize_query() found for each query in that file
+            global pool_waterer
+            pool_waterer = self
+            pool = multiprocessing.Pool(processes=n_pool_procs)
+            for results in pool.imap(read_sam_file_proc, samfnames):
+                for qname, line, indelfo, indel_rerun, skipped_unproductive in results:  # do the same things to <self> that summarize_query() did to the pool process's copy
+                    if indelfo is not None:
+                        self.info['indels'][qname] = indelfo  # if the query passed, this is the same object as line['indelfos'][0] (pickling preserves that, since each file's results get pickled together)
+                    if indel_rerun:
+                        self.indel_reruns.add(qname)
+                    if skipped_unproductive:
+                        self.skipped_unproductive_queries.add(qname)
+                        self.remaining_queries.remove(qname)
+                    if line is not None:
+                        self.add_to_info(line)
+                    queries_read_from_file.add(qname)
+            pool.close()
+            pool.join()
+            pool_waterer = None
+        else:
+            for samfname in samfnames:
+                queries_read_from_file |= set(qname for qname, _, _, _, _ in self.read_sam_file(samfname))
 
         not_read = self.remaining_queries - queries_read_from_file
         if len(not_read) > 0:  # ig-sw (now) doesn't write matches for cases in which cigar and read length differ, which means there are now queries for which it finds zero matches (well, it didn't seem to happen before... but not sure that it couldn't have)
@@ -498,6 +688,23 @@ class Waterer(object):
 
         sys.stdout.flush()
 
+    # ----------------------------------------------------------------------------------------
+    def read_sam_file(self, samfname):  # run summarize_query() on each query in ig-sw output file <samfname>, and return what it found for each one (which read_output() needs if we're in a pool process, since then we're modifying a copy of the parent's <self>)
+        results = []
+        # self.remove_length_discrepant_matches(samfname)
+        with contextlib.closing(pysam.Samfile(samfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
+            grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
+            for _, reads in grouped:  # loop over query sequences
+                try:
+                    readlist = list(reads)
+                except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
+                    raise Exception('failed to convert sam reads')
+                qinfo = self.read_query(sam.references, readlist)
+                qname = qinfo['name']
+                self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
+                results.append((qname, self.info[qname] if qname in self.info['passed-queries'] else None, self.info['indels'].get(qname), qname in self.indel_reruns, qname in self.skipped_unproductive_queries))
+        return results
+
     # ----------------------------------------------------------------------------------------
     def remove_query(self, query):
         # NOTE you're iterating over a deep copy of <self.info['queries']>, right? you better be!
@@ -894,6 +1101,7 @@ class Waterer(object):
         self.remaining_queries.remove(qname)
 
     # ----------------------------------------------------------------------------------------
+    @utils.profiled_stage('waterer-summarize-query')
     def summarize_query(self, qinfo):
         """
         Fiddle with a few things, but mostly decide whether we're satisfied with the current matches.
@@ -1241,17 +1449,22 @@ class Waterer(object):
         # ----------------------------------------------------------------------------------------
         def get_key_seq(uid):  # return the sequence which will serve as the key for <uid>
             seq = getseq(uid)
-            if not self.args.also_remove_duplicate_sequences_with_different_lengths:  # this is probably significantly slower, otherwise I might make it the default
+            if not self.args.also_remove_duplicate_sequences_with_different_lengths or seq in seqs_to_keep:
                 return seq
             else:
-                for kseq, kuids in seqs_to_keep.items():
-                    if self.info[kuids[0]]['cdr3_length'] != self.info[uid]['cdr3_length']:
-                        continue
-                    if seq in kseq or kseq in seq:  # note that this keeps the first one we happen to come across -- it'd be better to keep the longest one, but this is fine for now
-                        if debug:
-                            print '      using keyseq from %s instead of %s' % (kuids, uid)
-                        return kseq
-                return seq  # if we fall through, it didn't match anybody
+                kseq = utils.find_containing_or_contained_seq(containment_index, seq, group=self.info[uid]['cdr3_length'])  # note that this keeps the first one we came across -- it'd be better to keep the longest one, but this is fine for now
+                if kseq is None:  # didn't match anybody
+                    return seq
+                if debug:
+                    print '      using keyseq from %s instead of %s' % (seqs_to_keep[kseq], uid)
+                return kseq
+        # ----------------------------------------------------------------------------------------
+        def keep(keyseq, uid):
+            if keyseq not in seqs_to_keep:
+                seqs_to_keep[keyseq] = []
+                if self.args.also_remove_duplicate_sequences_with_different_lengths:
+                    utils.add_to_containment_index(containment_index, keyseq, group=self.info[uid]['cdr3_length'])
+            seqs_to_keep[keyseq].append(uid)
         # ----------------------------------------------------------------------------------------
         def get_pre_kept_queries():
             pre_kept_uids = set()
@@ -1268,14 +1481,12 @@ class Waterer(object):
             return pre_kept_uids
 
         seqs_to_keep = {}  # seq : [uids that correspond to seq]
+        containment_index = utils.init_containment_index()  # only used for --also-remove-duplicate-sequences-with-different-lengths, to find kept seqs that contain (or are contained in) each new seq
 
         # handle any pre-kept queries, just adding any duplicates to the appropriate list in <seqs_to_keep> *without* actually removing the duplicates
         pre_kept_uids = get_pre_kept_queries()
         for utpk in pre_kept_uids:
-            keyseq = get_key_seq(utpk)
-            if keyseq not in seqs_to_keep:  # it's kind of weird to have duplicates in the pre-kept sequences, but it probably just means the user specified some duplicate sequences with --queries or --queries-to-include
-                seqs_to_keep[keyseq] = []
-            seqs_to_keep[keyseq].append(utpk)
+            keep(get_key_seq(utpk), utpk)  # it's kind of weird to have duplicates in the pre-kept sequences, but it probably just means the user specified some duplicate sequences with --queries or --queries-to-include
         if debug and len(pre_kept_uids) > 0:
             print '  pre-keeping %d uids: %s' % (len(pre_kept_uids), ' '.join(pre_kept_uids))
             if len(seqs_to_keep) < len(pre_kept_uids):
@@ -1285,11 +1496,9 @@ class Waterer(object):
         for uid in set(self.info['queries']) - pre_kept_uids:
             keyseq = get_key_seq(uid)
             if keyseq in seqs_to_keep:
-                seqs_to_keep[keyseq].append(uid)
                 self.remove_query(uid)
                 removed_queries.add(uid)
-            else:
-                seqs_to_keep[keyseq] = [uid]
+            keep(keyseq, uid)
 
         for seq, uids in seqs_to_keep.items():
             kept_uid = uids[0]
@@ -1351,6 +1560,7 @@ class Waterer(object):
         return maxima, per_cdr3_maxima
 
     # ----------------------------------------------------------------------------------------
+    @utils.profiled_stage('waterer-pad-seqs')
     def pad_seqs_to_same_length(self, debug=False):
         """
         Pad all sequences in <seqinfo> to the same length to the left and right of their conserved cysteine positions.
@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+import time
+import random
+import itertools
+import collections
+import shutil
+import subprocess
+import numpy
+import colored_traceback.always
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+def random_seq(seq_len):
+    return ''.join(random.choice(utils.nukes) for _ in range(seq_len))
+
+# ----------------------------------------------------------------------------------------
+def write_fake_cache_file(fname, n_lines, seq_len=400, uid_offset=0):
+    with open(fname, 'w') as cfile:
+        cfile.write(','.join(utils.partition_cachefile_headers) + '\n')
+        for iline in range(n_lines):
+            cfile.write('%s,%f,%s,,\n' % (':'.join('seq-%d' % (uid_offset + iline + i) for i in range(random.randint(1, 3))), -random.uniform(100, 1000), random_seq(seq_len)))
+
+# ----------------------------------------------------------------------------------------
+def shell_merge(infnames, outfname, dereplicate):  # the old way, i.e. what partitiondriver.merge_files() used to do
+    header = ','.join(utils.partition_cachefile_headers)
+    subprocess.check_call('cat %s | grep -v \'%s\' >>%s' % (' '.join(fn for fn in infnames if fn != outfname), header, outfname), shell=True)
+    if dereplicate:
+        subprocess.check_call('echo %s >%s.tmp' % (header, outfname), shell=True)
+        subprocess.check_call('grep -v \'%s\' %s | sort | uniq >>%s.tmp' % (header, outfname, outfname), shell=True)
+        subprocess.check_call(['mv', outfname + '.tmp', outfname])
+
+# ----------------------------------------------------------------------------------------
+def merge_files(args):
+    print '  merging %s hmm cache files' % ('dereplicated' if args.dereplicate else 'non-dereplicated')
+    print '    n_procs  cache lines   shell (s)  python (s)'
+    for cache_size in args.cache_sizes:
+        for n_procs in args.n_procs_list:
+            times = {}
+            for method in ['shell', 'python']:
+                utils.prep_dir(args.workdir, wildlings='*')
+                random.seed(args.seed)
+                mainfname = '%s/main.csv' % args.workdir
+                write_fake_cache_file(mainfname, cache_size)
+                subfnames = ['%s/sub-%d.csv' % (args.workdir, iproc) for iproc in range(n_procs)]
+                for iproc, subfname in enumerate(subfnames):  # each subproc only writes new info, i.e. a small fraction of the size of the main file
+                    write_fake_cache_file(subfname, max(1, cache_size / (10 * n_procs)), uid_offset=cache_size + iproc * cache_size)
+                start = time.time()
+                if method == 'shell':
+                    shell_merge(subfnames + [mainfname], mainfname, args.dereplicate)
+                else:
+                    utils.merge_csv_lines(subfnames + [mainfname], mainfname, dereplicate=args.dereplicate)
+                times[method] = time.time() - start
+            print '    %5d   %9d     %8.3f    %8.3f' % (n_procs, cache_size, times['shell'], times['python'])
+    shutil.rmtree(args.workdir)
+
+# ----------------------------------------------------------------------------------------
+def add_ambiguity(seq, frac=0.02):  # sprinkle in some Ns and gaps, so we also check that they're skipped correctly
+    return ''.join(random.choice(utils.ambiguous_bases + utils.gap_chars) if random.random() < frac else c for c in seq)
+
+# ----------------------------------------------------------------------------------------
+def hamming(args):
+    print '  hamming fractions among %d-nt seqs (python loop vs vectorized)' % args.seq_len
+    print '     n_seqs    one-vs-many (s)        all-vs-all (s)'
+    print '               loop   vectorized     loop   vectorized'
+    for n_seqs in args.n_seqs_list:
+        random.seed(args.seed)
+        seqs = [add_ambiguity(random_seq(args.seq_len)) for _ in range(n_seqs)]
+        times = {}
+        start = time.time()
+        loop_one = [utils.hamming_fraction(seqs[0], s) for s in seqs]
+        times['loop-one'] = time.time() - start
+        start = time.time()
+        vec_one = utils.hamming_distances_to_seq(seqs[0], seqs, return_fractions=True)
+        times['vec-one'] = time.time() - start
+        if n_seqs <= args.max_loop_all_vs_all:
+            start = time.time()
+            loop_all = [utils.hamming_fraction(seqs[i], seqs[j]) for i in range(n_seqs) for j in range(i + 1, n_seqs)]
+            times['loop-all'] = time.time() - start
+        start = time.time()
+        vec_all = utils.hamming_distance_matrix(seqs, return_fractions=True, condensed=True)
+        times['vec-all'] = time.time() - start
+        if loop_one != list(vec_one) or ('loop-all' in times and loop_all != list(vec_all)):
+            raise Exception('vectorized hamming fractions differ from python loop results')
+        print '    %7d   %7.3f   %7.3f      %s   %7.3f' % (n_seqs, times['loop-one'], times['vec-one'], ('%7.3f' % times['loop-all']) if 'loop-all' in times else '    ---', times['vec-all'])
+
+# ----------------------------------------------------------------------------------------
+def naive_glomerate(args):
+    from glomerator import Glomerator
+    print '  naive seq glomeration into %d clusters of %d-nt seqs' % (args.n_clusters, args.seq_len)
+    print '     n_seqs    time (s)'
+    for n_seqs in args.n_seqs_list:
+        random.seed(args.seed)
+        naive_seqs = {'seq-%d' % i : random_seq(args.seq_len) for i in range(n_seqs)}
+        start = time.time()
+        clusters = Glomerator().naive_seq_glomerate(naive_seqs, args.n_clusters)
+        assert sorted(u for c in clusters for u in c) == sorted(naive_seqs)
+        print '    %7d   %7.3f' % (n_seqs, time.time() - start)
+
+# ----------------------------------------------------------------------------------------
+def old_read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):  # the old way, i.e. what utils.read_fastx() used to do
+    if ftype is None:
+        suffix = utils.getsuffix(fname)
+        if suffix == '.fa' or suffix == '.fasta':
+            ftype = 'fa'
+        elif suffix == '.fq' or suffix == '.fastq':
+            ftype = 'fq'
+        else:
+            raise Exception('unhandled file type: %s' % suffix)
+
+    finfo = []
+    iline = -1  # index of the query/seq that we're currently reading in the fasta
+    n_fasta_queries = 0  # number of queries so far added to <finfo> (I guess I could just use len(finfo) at this point)
+    missing_queries = set(queries) if queries is not None else None
+    already_printed_forbidden_character_warning = False
+    with open(fname) as fastafile:
+        startpos = None
+        while True:
+            if startpos is not None:  # rewind since the last time through we had to look to see when the next header line appeared
+                fastafile.seek(startpos)
+            headline = fastafile.readline()
+            if not headline:
+                break
+            if headline.strip() == '':  # skip a blank line
+                headline = fastafile.readline()
+
+            if ftype == 'fa':
+                if headline[0] != '>':
+                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, headline))
+                headline = headline.lstrip('>')
+
+                seqlines = []
+                nextline = fastafile.readline()
+                while True:
+                    if not nextline:
+                        break
+                    if nextline[0] == '>':
+                        break
+                    else:
+                        startpos = fastafile.tell()  # i.e. very line that doesn't begin with '>' increments <startpos>
+                    seqlines.append(nextline)
+                    nextline = fastafile.readline()
+                seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
+            elif ftype == 'fq':
+                if headline[0] != '@':
+                    raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
+                headline = headline.lstrip('@')
+
+                seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
+                plusline = fastafile.readline().strip()
+                if plusline[0] != '+':
+                    raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
+                qualityline = fastafile.readline()
+            else:
+                raise Exception('unhandled ftype %s' % ftype)
+
+            if not seqline:
+                break
+
+            iline += 1
+            if istartstop is not None:
+                if iline < istartstop[0]:
+                    continue
+                elif iline >= istartstop[1]:
+                    continue
+
+            if dont_split_infostrs:  # if this is set, we let the calling fcn handle all the infostr parsing (e.g. for imgt germline fasta files)
+                infostrs = headline
+                uid = infostrs
+            else:  # but by default, we split by everything that could be a separator, which isn't really ideal, but we're reading way too many different kinds of fasta files at this point to change the default
+                if ';' in headline and '=' in headline:  # HOLY SHIT PEOPLE DON"T PUT YOUR META INFO IN YOUR FASTA FILES
+                    infostrs = [s1.split('=') for s1 in headline.strip().split(';')]
+                    uid = infostrs[0][0]
+                    infostrs = dict(s for s in infostrs if len(s) == 2)
+                else:
+                    infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
+                    uid = infostrs[0]
+            if sanitize and any(fc in uid for fc in utils.forbidden_characters):
+                if not already_printed_forbidden_character_warning:
+                    print '  %s: found a forbidden character (one of %s) in sequence id \'%s\'. This means we\'ll be replacing each of these forbidden characters with a single letter from their name (in this case %s). If this will cause problems you should replace the characters with something else beforehand. You may also be able to fix it by setting --parse-fasta-info.' % (utils.color('yellow', 'warning'), ' '.join(["'" + fc + "'" for fc in utils.forbidden_characters]), uid, uid.translate(utils.forbidden_character_translations))
+                    already_printed_forbidden_character_warning = True
+                uid = uid.translate(utils.forbidden_character_translations)
+
+            if queries is not None:
+                if uid not in queries:
+                    continue
+                missing_queries.remove(uid)
+
+            seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
+            if add_info:
+                seqfo['infostrs'] = infostrs
+            finfo.append(seqfo)
+
+            n_fasta_queries += 1
+            if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
+                break
+            if queries is not None and len(missing_queries) == 0:
+                break
+
+    if n_random_queries is not None:
+        finfo = numpy.random.choice(finfo, n_random_queries, replace=False)
+
+    return finfo
+
+# ----------------------------------------------------------------------------------------
+def write_fake_fastx_file(fname, ftype, n_seqs, seq_len):
+    with open(fname, 'w') as fxfile:
+        for iseq in range(n_seqs):
+            seq = random_seq(seq_len)
+            if ftype == 'fa':
+                fxfile.write('>seq-%d\n%s\n%s\n' % (iseq, seq[ : seq_len / 2], seq[seq_len / 2 : ]))  # two lines per sequence, to make sure multi-line fasta works
+            else:
+                fxfile.write('@seq-%d\n%s\n+\n%s\n' % (iseq, seq, 'I' * seq_len))
+
+# ----------------------------------------------------------------------------------------
+def fastx(args):
+    import gzip
+    print '  reading %d-nt sequences from fasta/fastq' % args.seq_len
+    print '    ftype   n_seqs     old (s)   new (s)   new gzipped (s)   old random (s)   new random (s)'
+    for ftype in ['fa', 'fq']:
+        for n_seqs in args.n_seqs_list:
+            utils.prep_dir(args.workdir, wildlings='*')
+            random.seed(args.seed)
+            fname = '%s/seqs.%s' % (args.workdir, ftype)
+            write_fake_fastx_file(fname, ftype, n_seqs, args.seq_len)
+            with open(fname) as infile:
+                gzfile = gzip.open(fname + '.gz', 'wb')
+                gzfile.write(infile.read())
+                gzfile.close()
+            n_random = max(1, n_seqs / 100)
+            times, results = {}, {}
+            for method, fcn in [('old', lambda: old_read_fastx(fname)), ('new', lambda: utils.read_fastx(fname)), ('new-gz', lambda: utils.read_fastx(fname + '.gz')),
+                                ('old-random', lambda: list(old_read_fastx(fname, n_random_queries=n_random))), ('new-random', lambda: utils.read_fastx(fname, n_random_queries=n_random))]:
+                numpy.random.seed(args.seed)
+                start = time.time()
+                results[method] = fcn()
+                times[method] = time.time() - start
+            if not results['old'] == results['new'] == results['new-gz'] or results['old-random'] != results['new-random']:
+                raise Exception('new fastx reader results differ from old results')
+            print '    %3s   %8d    %7.3f   %7.3f       %7.3f           %7.3f          %7.3f' % (ftype, n_seqs, times['old'], times['new'], times['new-gz'], times['old-random'], times['new-random'])
+    shutil.rmtree(args.workdir)
+
+# ----------------------------------------------------------------------------------------
+def fastx_index(args):
+    import seqfileopener
+    def seqfile_args(**kwargs):  # the input file args that seqfileopener.read_sequence_file() looks at
+        sfargs = {k : None for k in ['istartstop', 'queries', 'n_random_queries', 'name_column', 'seq_column', 'reco_ids', 'seed_unique_id', 'seed_seq', 'queries_to_include', 'input_metafname']}
+        sfargs.update({'abbreviate' : False, 'random_seed_seq' : False})
+        sfargs.update(kwargs)
+        return argparse.Namespace(**sfargs)
+    print '  reading subsets of %d-nt sequences from fasta file, with and without the sidecar index' % args.seq_len
+    print '    subset          n_seqs    full scan (s)   build index (s)   with index (s)'
+    for n_seqs in args.n_seqs_list:
+        utils.prep_dir(args.workdir, wildlings='*')
+        random.seed(args.seed)
+        fname = '%s/seqs.fa' % args.workdir
+        write_fake_fastx_file(fname, 'fa', n_seqs, args.seq_len)
+        istart = n_seqs / 2
+        for label, kwargs in [('istartstop', {'istartstop' : [istart, min(n_seqs, istart + 100)]}), ('queries', {'queries' : ['seq-%d' % i for i in range(0, n_seqs, max(1, n_seqs / 100))]}), ('n-random-queries', {'n_random_queries' : max(1, n_seqs / 100)})]:
+            if os.path.exists(utils.get_fastx_index_fname(fname)):
+                os.remove(utils.get_fastx_index_fname(fname))
+            times, results = {}, {}
+            for method, fcn in [('full', lambda: utils.read_fastx(fname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, queries=kwargs.get('queries'), istartstop=kwargs.get('istartstop'))),
+                                ('build', lambda: seqfileopener.read_sequence_file(fname, True, args=seqfile_args(**kwargs), quiet=True)[0]), ('indexed', lambda: seqfileopener.read_sequence_file(fname, True, args=seqfile_args(**kwargs), quiet=True)[0])]:
+                numpy.random.seed(args.seed)
+                start = time.time()
+                results[method] = fcn()
+                times[method] = time.time() - start
+            if label != 'n-random-queries' and [sfo['unique_ids'] for sfo in results['full']] != results['indexed'].keys():  # (n random queries happens after reading, so not really comparable)
+                raise Exception('indexed results differ from full scan')
+            if results['build'].keys() != results['indexed'].keys():
+                raise Exception('results differ when building vs reusing index')
+            print '    %-16s %8d    %7.3f         %7.3f           %7.3f' % (label, n_seqs, times['full'], times['build'], times['indexed'])
+    shutil.rmtree(args.workdir)
+
+# ----------------------------------------------------------------------------------------
+def random_newick_tree(n_leaves, max_branch_length=0.02, zero_length_fraction=0.1):  # random binary tree, made by joining random pairs of subtrees (some branches have length zero, like FastTree trees often do)
+    def blen():
+        return 0. if random.random() < zero_length_fraction else random.uniform(0, max_branch_length)
+    subtrees = ['leaf-%d:%f' % (i, blen()) for i in range(n_leaves)]
+    n_internal = 0
+    while len(subtrees) > 1:
+        random.shuffle(subtrees)
+        left, right = subtrees.pop(), subtrees.pop()
+        subtrees.append('(%s,%s)internal-%d:%f' % (left, right, n_internal, blen()))
+        n_internal += 1
+    return subtrees[0].rsplit(':', 1)[0] + ';'
+
+# ----------------------------------------------------------------------------------------
+def old_get_tree_with_dummy_branches(old_dtree, tau, n_tau_lengths=10):  # the old way, i.e. what treeutils.get_tree_with_dummy_branches() used to do (minus dummy leaves and debug printing): add a long branch above the root, since otherwise we're assuming that root node fitness is zero
+    import dendropy
+    import treeutils
+    new_root_taxon = dendropy.Taxon(treeutils.dummy_str + '-root')
+    old_dtree.taxon_namespace.add_taxon(new_root_taxon)
+    new_root_node = dendropy.Node(taxon=new_root_taxon)
+    new_dtree = dendropy.Tree(seed_node=new_root_node, taxon_namespace=old_dtree.taxon_namespace, is_rooted=True)
+    new_root_node.add_child(old_dtree.seed_node)  # then add the entire old tree under this new tree
+    for edge in new_root_node.child_edge_iter():
+        edge.length = n_tau_lengths * tau
+    new_dtree.update_bipartitions(suppress_unifurcations=False)  # suppress_unifurcations is because otherwise it removes the branch between the old and new root nodes
+    return new_dtree
+
+# ----------------------------------------------------------------------------------------
+def old_remove_dummy_branches(dtree, initial_labels):  # the old way, i.e. what treeutils.remove_dummy_branches() used to do (minus debug printing)
+    import treeutils
+    if len(dtree.seed_node.child_nodes()) != 1:
+        print '  %s root node has more than one child when removing dummy branches: %s' % (utils.color('yellow', 'warning'), ' '.join([n.taxon.label for n in dtree.seed_node.child_nodes()]))
+    assert dtree.is_rooted  # make sure it's rooted, to avoid unifurcations getting suppressed (even with the arg set to false)
+    dtree.reroot_at_node(dtree.seed_node.child_nodes()[0], suppress_unifurcations=False)  # reroot at old root node
+    dtree.prune_taxa_with_labels([treeutils.dummy_str + '-root'], suppress_unifurcations=False)
+    dtree.purge_taxon_namespace()
+    dtree.update_bipartitions(suppress_unifurcations=False)
+    final_labels = set([n.taxon.label for n in dtree.preorder_node_iter()])
+    if initial_labels != final_labels:
+        raise Exception('nodes after dummy branch addition and removal not the same as before (missing: %s  extra: %s)' % (' '.join(initial_labels - final_labels), ' '.join(final_labels - initial_labels)))
+
+# ----------------------------------------------------------------------------------------
+def old_set_lb_values(dtree, tau, only_calc_metric=None, dont_normalize=False, multifo=None):  # the old way, i.e. what treeutils.set_lb_values() used to do (minus debug printing), one tau at a time by traversing the dendropy tree
+    """
+    traverses <dtree> in postorder and preorder to calculate the up and downstream tree length exponentially weighted by distance, then adds them as LBI (and divides as LBR)
+    """
+    import treeutils
+    def getmulti(node):  # number of reads with the same sequence
+        return multifo.get(node.taxon.label, 1) if multifo is not None else 1  # most all of them should be in there, but for instance I'm not adding the dummy branch nodes
+
+    metrics_to_calc = treeutils.lb_metrics.keys() if only_calc_metric is None else [only_calc_metric]
+
+    initial_labels = set([n.taxon.label for n in dtree.preorder_node_iter()])
+    dtree = old_get_tree_with_dummy_branches(dtree, tau)  # this returns a new dtree, but the old tree is a subtree of the new one (or at least its collection of nodes are), and these nodes get modified by the process (hence the reversal fcn below)
+
+    # calculate clock length (i.e. for each node, the distance to that node's parent)
+    for node in dtree.postorder_node_iter():  # postorder vs preorder doesn't matter, but I have to choose one
+        if node.parent_node is None:  # root node
+            node.clock_length = 0.
+        for child in node.child_node_iter():
+            child.clock_length = child.distance_from_root() - node.distance_from_root()
+
+    # lbi is the sum of <node.down_polarizer> (downward message from <node>'s parent) and its children's up_polarizers (upward messages)
+
+    # traverse the tree in postorder (children first) to calculate message to parents (i.e. node.up_polarizer)
+    for node in dtree.postorder_node_iter():
+        node.down_polarizer = 0  # used for <node>'s lbi (this probabably shouldn't be initialized here, since it gets reset in the next loop [at least I think they all do])
+        node.up_polarizer = 0  # used for <node>'s parent's lbi (but not <node>'s lbi)
+        for child in node.child_node_iter():
+            node.up_polarizer += child.up_polarizer
+        bl = node.clock_length / tau
+        node.up_polarizer *= numpy.exp(-bl)  # sum of child <up_polarizer>s weighted by an exponential decayed by the distance to <node>'s parent
+        node.up_polarizer += getmulti(node) * tau * (1 - numpy.exp(-bl))  # add the actual contribution (to <node>'s parent's lbi) of <node>: zero if the two are very close, increasing toward asymptote of <tau> for distances near 1/tau (integral from 0 to l of decaying exponential)
+
+    # traverse the tree in preorder (parents first) to calculate message to children (i.e. child1.down_polarizer)
+    for node in dtree.preorder_internal_node_iter():
+        for child1 in node.child_node_iter():  # calculate down_polarizer for each of <node>'s children
+            child1.down_polarizer = node.down_polarizer  # first sum <node>'s down_polarizer...
+            for child2 in node.child_node_iter():  # and the *up* polarizers of any other children of <node>
+                if child1 != child2:
+                    child1.down_polarizer += child2.up_polarizer  # add the contribution of <child2> to its parent's (<node>'s) lbi (i.e. <child2>'s contribution to the lbi of its *siblings*)
+            bl = child1.clock_length / tau
+            child1.down_polarizer *= numpy.exp(-bl)  # and decay the previous sum by distance between <child1> and its parent (<node>)
+            child1.down_polarizer += getmulti(child1) * tau * (1 - numpy.exp(-bl))  # add contribution of <child1> to its own lbi: zero if it's very close to <node>, increasing to max of <tau> (integral from 0 to l of decaying exponential)
+
+    returnfo = {m : {} for m in metrics_to_calc}
+    # go over all nodes and calculate lb metrics (can be done in any order)
+    for node in dtree.postorder_node_iter():
+        vals = {'lbi' : node.down_polarizer, 'lbr' : 0.}
+        for child in node.child_node_iter():
+            vals['lbi'] += child.up_polarizer
+            vals['lbr'] += child.up_polarizer
+        if node.down_polarizer > 0.:
+            vals['lbr'] /= node.down_polarizer  # it might make more sense to not include the branch between <node> and its parent in either the numerator or denominator (here it's included in the denominator), but this way I don't have to change any of the calculations above
+
+        if treeutils.dummy_str in node.taxon.label:
+            continue
+        if node is dtree.seed_node or node.parent_node is dtree.seed_node:  # second clause is only because of dummy root addition (well, and if we are adding dummy root the first clause doesn't do anything)
+            vals['lbr'] = 0.
+        for metric in metrics_to_calc:
+            returnfo[metric][node.taxon.label] = float(vals[metric]) if dont_normalize else treeutils.normalize_lb_val(metric, float(vals[metric]), tau)
+
+    # this is maybe time consuming, but I want to leave the tree that was passed in as unmodified as I can (especially since a.t.m. I'm running this fcn twice for lbi/lbr)
+    for node in dtree.postorder_node_iter():
+        delattr(node, 'clock_length')
+        delattr(node, 'up_polarizer')
+        delattr(node, 'down_polarizer')
+
+    old_remove_dummy_branches(dtree, initial_labels)
+
+    return returnfo
+
+# ----------------------------------------------------------------------------------------
+def lb_values(args):
+    import treeutils
+    tau, lbr_tau_factor = treeutils.default_lb_tau, treeutils.default_lbr_tau_factor
+    print '  calculating (unnormalized) lbi and lbr on random trees'
+    print '    n_leaves    old (s)    new (s)    max abs diff'
+    for n_leaves in args.n_leaves_list:
+        random.seed(args.seed)
+        treestr = random_newick_tree(n_leaves)
+        dtree = treeutils.get_dendro_tree(treestr=treestr)
+        start = time.time()
+        old_vals = old_set_lb_values(dtree, tau, only_calc_metric='lbi', dont_normalize=True)  # the old way, i.e. what treeutils.calculate_lb_values() used to do
+        old_vals['lbr'] = old_set_lb_values(dtree, tau * lbr_tau_factor, only_calc_metric='lbr', dont_normalize=True)['lbr']
+        old_vals['tree'] = dtree.as_string(schema='newick')
+        old_time = time.time() - start
+        dtree = treeutils.get_dendro_tree(treestr=treestr)
+        start = time.time()
+        new_vals = treeutils.calculate_lb_values(dtree, tau, lbr_tau_factor=lbr_tau_factor, dont_normalize=True, iclust=1)
+        new_time = time.time() - start
+        max_diff = 0.
+        if old_vals['tree'] != new_vals['tree']:
+            raise Exception('old and new tree strings differ')
+        for metric in treeutils.lb_metrics:
+            if set(old_vals[metric]) != set(new_vals[metric]):
+                raise Exception('different nodes in old and new %s values' % metric)
+            max_diff = max([max_diff] + [abs(old_vals[metric][u] - new_vals[metric][u]) for u in old_vals[metric]])
+        if max_diff > 1e-9:
+            raise Exception('new lb values differ from old ones by up to %g' % max_diff)
+        print '    %8d    %7.3f    %7.3f    %.1e' % (n_leaves, old_time, new_time, max_diff)
+
+# ----------------------------------------------------------------------------------------
+def old_merge_shared_clusters(partition):  # the old way, i.e. what partitiondriver.merge_shared_clusters() used to do (minus the debug printing)
+    cluster_groups = []
+    for iclust in range(len(partition)):
+        for jclust in range(iclust + 1, len(partition)):
+            if len(set(partition[iclust]) & set(partition[jclust])) > 0:
+                cluster_groups.append(set([iclust, jclust]))
+    while True:
+        no_more_merges = True
+        for cp1, cp2 in itertools.combinations(cluster_groups, 2):
+            if len(cp1 & cp2) > 0:
+                cluster_groups.append(cp1 | cp2)
+                cluster_groups.remove(cp1)
+                cluster_groups.remove(cp2)
+                no_more_merges = False
+                break
+        if no_more_merges:
+            break
+    new_clusters = []
+    for cgroup in cluster_groups:
+        new_clusters.append(list(set([uid for iclust in cgroup for uid in partition[iclust]])))
+    for iclust in sorted([i for cgroup in cluster_groups for i in cgroup], reverse=True):
+        partition.pop(iclust)
+    for nclust in new_clusters:
+        partition.append(nclust)
+    return partition
+
+# ----------------------------------------------------------------------------------------
+def random_overlapping_partition(n_clusters, max_cluster_size=10, overlap_fraction=0.05):  # random clusters, where each uid has a chance <overlap_fraction> of being a copy of a uid from some earlier cluster (like in the partitions from --max-cluster-size)
+    partition, all_uids = [], []
+    for iclust in range(n_clusters):
+        cluster = []
+        for _ in range(random.randint(1, max_cluster_size)):
+            if len(all_uids) > 0 and random.random() < overlap_fraction:
+                cluster.append(random.choice(all_uids))
+            else:
+                cluster.append('seq-%d' % len(all_uids))
+                all_uids.append(cluster[-1])
+        partition.append(cluster)
+    return partition
+
+# ----------------------------------------------------------------------------------------
+def merge_shared_clusters(args):
+    def cset(ptn):
+        return set(frozenset(c) for c in ptn)
+    print '  merging clusters that share uids in random overlapping partitions'
+    print '    n_clusters    overlap     n_merged    old (s)    new (s)'
+    for n_clusters in args.n_clusters_list:
+        for overlap_fraction in [0.001, 0.01, 0.1]:
+            random.seed(args.seed)
+            partition = random_overlapping_partition(n_clusters, overlap_fraction=overlap_fraction)
+            start = time.time()
+            new_partition = utils.merge_overlapping_clusters(partition)
+            new_time = time.time() - start
+            if set(u for c in partition for u in c) != set(u for c in new_partition for u in c):
+                raise Exception('merged partition has different uids than the original')
+            if len(set(u for c in new_partition for u in c)) != sum(len(set(c)) for c in new_partition):
+                raise Exception('merged partition still has overlapping clusters')
+            old_str = '-'
+            if n_clusters <= args.max_old_merge_clusters:
+                start = time.time()
+                old_partition = old_merge_shared_clusters([list(c) for c in partition])
+                old_str = '%7.3f' % (time.time() - start)
+                if cset(old_partition) != cset(new_partition):
+                    raise Exception('old and new merged partitions differ')
+            print '    %8d      %5.3f     %8d    %7s    %7.3f' % (n_clusters, overlap_fraction, len(partition) - len(new_partition), old_str, new_time)
+
+# ----------------------------------------------------------------------------------------
+def random_truncated_repertoire(n_seqs, seq_len, n_groups=20, family_size=10, dup_fraction=0.2):  # random families of similar sequences, where a fraction of the seqs are truncated copies of earlier ones (like reads that start/end at different points)
+    seqs, groups = [], []
+    while len(seqs) < n_seqs:
+        if len(seqs) > 0 and random.random() < dup_fraction:
+            iseq = random.randint(0, len(seqs) - 1)
+            istart, istop = random.randint(0, 15), len(seqs[iseq]) - random.randint(0, 15)
+            seqs.append(seqs[iseq][istart : istop])
+            groups.append(groups[iseq])
+        else:
+            base_seq, group = random_seq(seq_len), random.randint(0, n_groups - 1)
+            for _ in range(family_size):
+                seqs.append(''.join(random.choice(utils.nukes) if random.random() < 0.02 else n for n in base_seq))
+                groups.append(group)
+    return seqs[:n_seqs], groups[:n_seqs]
+
+# ----------------------------------------------------------------------------------------
+def remove_duplicate_sequences(args):  # finding the key seq for each sequence in waterer.remove_duplicate_sequences() with --also-remove-duplicate-sequences-with-different-lengths
+    def old_get_key_seq(seq, group, seqs_to_keep):  # the old way, i.e. loop over all kept seqs
+        for kseq, kgroup in seqs_to_keep.items():
+            if kgroup == group and (seq in kseq or kseq in seq):
+                return kseq
+        return seq
+    def new_get_key_seq(seq, group, seqs_to_keep, cindex):
+        if seq in seqs_to_keep:
+            return seq
+        kseq = utils.find_containing_or_contained_seq(cindex, seq, group=group)
+        return seq if kseq is None else kseq
+    print '  finding sub/super string duplicates in random families of sequences'
+    print '    n_seqs    n_removed (old new)    old (s)    new (s)'
+    for n_seqs in args.n_seqs_list:
+        random.seed(args.seed)
+        seqs, groups = random_truncated_repertoire(n_seqs, args.seq_len)
+        start = time.time()
+        seqs_to_keep, cindex = {}, utils.init_containment_index()
+        for seq, group in zip(seqs, groups):
+            keyseq = new_get_key_seq(seq, group, seqs_to_keep, cindex)
+            if keyseq != seq and seq not in keyseq and keyseq not in seq:
+                raise Exception('key seq for %s isn\'t a sub/super string:\n    %s' % (seq, keyseq))
+            if keyseq not in seqs_to_keep:
+                seqs_to_keep[keyseq] = group
+                utils.add_to_containment_index(cindex, keyseq, group=group)
+        new_time = time.time() - start
+        n_new_removed = len(seqs) - len(seqs_to_keep)
+        old_str, n_old_str = '-', '-'
+        if n_seqs <= args.max_loop_all_vs_all:
+            start = time.time()
+            seqs_to_keep = collections.OrderedDict()
+            for seq, group in zip(seqs, groups):
+                keyseq = old_get_key_seq(seq, group, seqs_to_keep)
+                if keyseq not in seqs_to_keep:
+                    seqs_to_keep[keyseq] = group
+            old_str, n_old_str = '%7.3f' % (time.time() - start), '%d' % (len(seqs) - len(seqs_to_keep))
+        print '    %7d     %6s %6d           %7s    %7.3f' % (n_seqs, n_old_str, n_new_removed, old_str, new_time)
+
+# ----------------------------------------------------------------------------------------
+benchmarks = {
+    'merge-files' : merge_files,
+    'hamming' : hamming,
+    'naive-glomerate' : naive_glomerate,
+    'fastx' : fastx,
+    'fastx-index' : fastx_index,
+    'lb-values' : lb_values,
+    'merge-shared-clusters' : merge_shared_clusters,
+    'remove-duplicate-sequences' : remove_duplicate_sequences,
+}
+parser = argparse.ArgumentParser()
+parser.add_argument('benchmark', choices=sorted(benchmarks))
+parser.add_argument('--workdir', default=utils.fsdir() + '/partis-benchmark', help='temporary directory for input/output files (removed when finished)')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--n-procs-list', default='2:10:50:200', help='colon-separated list of numbers of (simulated) subprocesses')
+parser.add_argument('--cache-sizes', default='1000:10000:100000', help='colon-separated list of numbers of lines in the main hmm cache file')
+parser.add_argument('--dereplicate', action='store_true', help='dereplicate merged cache files (as is done for --persistent-cachefname)')
+parser.add_argument('--seq-len', type=int, default=400)
+parser.add_argument('--n-seqs-list', default='100:1000:5000', help='colon-separated list of numbers of sequences')
+parser.add_argument('--max-loop-all-vs-all', type=int, default=1000, help='don\'t run the (very slow) python loop all-vs-all version for more sequences than this')
+parser.add_argument('--n-clusters', type=int, default=50, help='number of clusters (i.e. processes) for naive-glomerate')
+parser.add_argument('--n-leaves-list', default='100:1000:10000', help='colon-separated list of numbers of leaves in each tree for lb-values')
+parser.add_argument('--n-clusters-list', default='100:1000:100000', help='colon-separated list of numbers of clusters in each partition for merge-shared-clusters')
+parser.add_argument('--max-old-merge-clusters', type=int, default=1000, help='don\'t run the (very slow) old merge-shared-clusters version for more clusters than this')
+args = parser.parse_args()
+args.n_procs_list = utils.get_arg_list(args.n_procs_list, intify=True)
+args.cache_sizes = utils.get_arg_list(args.cache_sizes, intify=True)
+args.n_seqs_list = utils.get_arg_list(args.n_seqs_list, intify=True)
+args.n_leaves_list = utils.get_arg_list(args.n_leaves_list, intify=True)
+args.n_clusters_list = utils.get_arg_list(args.n_clusters_list, intify=True)
+
+benchmarks[args.benchmark](args)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+import random
+import shutil
+import subprocess
+import colored_traceback.always
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+def run_partis(cmd_str, expect_failure=False, only_reproducible=False):  # returns lines of stdout (plus stderr), optionally removing the ones that depend on run time or file names
+    proc = subprocess.Popen(partis_dir + '/bin/partis ' + cmd_str, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = proc.communicate()
+    if expect_failure != (proc.returncode != 0):
+        print utils.pad_lines(out)
+        raise Exception('partis %s with: %s' % ('succeeded but we expected it to fail' if expect_failure else 'failed', cmd_str))
+    lines = out.split('\n')
+    if only_reproducible:
+        lines = [l for l in lines if 'time' not in l and '.yaml' not in l and '.npz' not in l]
+    return lines
+
+# ----------------------------------------------------------------------------------------
+def npz_output(args):  # check that bin/partis accepts .npz --outfname, and prints the same thing for an .npz file as for the equivalent .yaml file
+    if os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+    os.makedirs(args.workdir)
+    glfo, annotation_list, _ = utils.read_output(args.ref_outfname)
+    partition_lines = utils.read_yaml_output_header(args.ref_outfname)['partitions']
+    outfnames = {sfx : '%s/output%s' % (args.workdir, sfx) for sfx in ['.yaml', '.npz']}
+    for fname in outfnames.values():
+        utils.write_annotations(fname, glfo, annotation_list, utils.annotation_headers, partition_lines=list(partition_lines))
+
+    outputs = {sfx : run_partis('view-output --outfname %s --workdir %s/work-%s' % (fname, args.workdir, sfx.strip('.')), only_reproducible=True) for sfx, fname in outfnames.items()}
+    if outputs['.npz'] != outputs['.yaml']:
+        raise Exception('view-output printed different things for %s and %s' % (outfnames['.yaml'], outfnames['.npz']))
+    failout = run_partis('view-partitions --outfname %s --workdir %s/work-fail' % (outfnames['.npz'], args.workdir), expect_failure=True)
+    if len([l for l in failout if 'have to use \'view-output\' action' in l]) == 0:
+        raise Exception('view-partitions on %s didn\'t fail with the expected message' % outfnames['.npz'])
+    print '  npz output: ok (view-output printed %d identical lines for .yaml and .npz)' % len(outputs['.npz'])
+    shutil.rmtree(args.workdir)
+
+# ----------------------------------------------------------------------------------------
+def split_input_balancing(args):  # check that each --split-input-balancing method gives every proc at least one cluster (as long as there's at least as many clusters as procs), and gives each cluster to exactly one proc
+    from partitiondriver import PartitionDriver
+    pdriver = PartitionDriver.__new__(PartitionDriver)  # skip __init__(), since we only need the fcns that split up the input lines
+    pdriver.current_action = 'partition'
+    pdriver.hmm_cachefname = args.workdir + '/nonexistent-cache.csv'  # so get_input_line_naive_seqs() uses the sw naive seqs
+    n_empty = {}
+    for itrial in range(args.n_trials):
+        n_procs = random.randint(2, 10)
+        n_clusters = random.randint(n_procs, 5 * n_procs)
+        cdr3_lengths = [random.choice([30, 36, 42, 48]) for _ in range(n_clusters)]
+        cluster_sizes = [int(random.paretovariate(1.2)) for _ in range(n_clusters)]  # mostly small, with a few really big ones
+        clusters = [['%d-%d' % (iclust, iseq) for iseq in range(csize)] for iclust, csize in enumerate(cluster_sizes)]
+        pdriver.sw_info = {c[0] : {'naive_seq' : ''.join(random.choice(utils.nukes) for _ in range(20))} for c in clusters}
+        info = [{'names' : ':'.join(c), 'cdr3_length' : cl} for c, cl in zip(clusters, cdr3_lengths)]
+        for method in ['round-robin', 'cluster-size', 'naive-seq']:
+            pdriver.args = argparse.Namespace(split_input_balancing=method)
+            proc_lines = [[] for _ in range(n_procs)]
+            pdriver.distribute_input_lines(proc_lines, info)
+            if sorted(l['names'] for lines in proc_lines for l in lines) != sorted(l['names'] for l in info):
+                raise Exception('%s didn\'t give each cluster to exactly one proc (trial %d)' % (method, itrial))
+            if method not in n_empty:
+                n_empty[method] = 0
+            if any(len(lines) == 0 for lines in proc_lines):
+                n_empty[method] += 1
+                if args.debug:
+                    print '    %s: %d clusters among %d procs gave per-proc cluster counts %s' % (method, n_clusters, n_procs, [len(lines) for lines in proc_lines])
+    for method, n_trials_with_empty in sorted(n_empty.items()):
+        print '  split input balancing %-14s %s' % (method, 'ok' if n_trials_with_empty == 0 else utils.color('red', '%d / %d trials had empty procs' % (n_trials_with_empty, args.n_trials)))
+    if any(n > 0 for n in n_empty.values()):
+        raise Exception('empty procs from split input balancing (see above)')
+
+# ----------------------------------------------------------------------------------------
+checks = {
+    'npz-output' : npz_output,
+    'split-input-balancing' : split_input_balancing,
+}
+parser = argparse.ArgumentParser()
+parser.add_argument('checks', default=':'.join(sorted(checks)), nargs='?', help='colon-separated list of checks to run (default all) from among: %s' % ' '.join(sorted(checks)))
+parser.add_argument('--workdir', default=utils.fsdir() + '/partis-checks', help='temporary directory for input/output files (removed when finished)')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--n-trials', type=int, default=5000, help='number of random inputs for split-input-balancing')
+parser.add_argument('--debug', action='store_true')
+parser.add_argument('--ref-outfname', default=partis_dir + '/test/reference-results/partition-new-simu.yaml', help='partition output file from which to make the files for npz-output')
+args = parser.parse_args()
+args.checks = utils.get_arg_list(args.checks)
+
+for check in args.checks:
+    random.seed(args.seed)
+    checks[check](args)